@@ -167,10 +167,41 @@ CELERYBEAT_SCHEDULE = {
         'task': 'posts.tasks.clear_expired_posts',
         'schedule': timedelta(seconds=60*5),
     },
+    'prune-expired-posts': {
+        'task': 'posts.tasks.prune_expired_posts',
+        'schedule': timedelta(seconds=60),
+    },
+    'collect-media-garbage': {
+        'task': 'posts.tasks.collect_media_garbage',
+        'schedule': timedelta(seconds=60*10),  # Retries files missed by scheduled collections
+    },
     'send-notifications': {
         'task': 'posts.tasks.send_expire_notifications',
-        'schedule': timedelta(seconds=60)  # Should to use redis notification
-    }
+        'schedule': timedelta(seconds=60)  # Pops due posts of posts.ending_soon schedule
+    },
+    'schedule-ending-soon-posts': {
+        'task': 'posts.tasks.schedule_ending_soon_posts',
+        'schedule': timedelta(seconds=60*60),  # Restores schedule lost by redis flush or eviction
+    },
+    'apply-cache-events': {
+        'task': 'core.tasks.apply_cache_events',
+        'schedule': timedelta(seconds=60),  # Applies events missed by scheduled consumers and retries failed ones
+    },
+    'flush-counters': {
+        'task': 'core.tasks.flush_counters',
+        'schedule': timedelta(seconds=60),  # Flushes counters missed by scheduled flushes
+    },
+}
+
+# Votes are applied to expiration time of posts in bulk, so viral posts are not locked by each vote.
+# See posts.models.vote_post
+VOTE_COALESCING = False
+
+# Shared redis client settings, other options and their defaults are in core.redis_client.REDIS_DEFAULTS
+REDIS = {
+    'HOST': 'localhost',
+    'PORT': 6379,
+    'DB': 0,
 }
 
 # CELERY SETTINGS
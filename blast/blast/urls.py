@@ -41,6 +41,7 @@ from posts.views import (PostsViewSet, CommentsViewSet, VotedPostsViewSet,
                          SharePostByLocationView)
 
 from posts.feeds import MainFeedView, RecentFeedView
+from core.views import CacheStatsView
 
 api_1 = DefaultRouter()
 api_1.register(r'feeds/first', MainFeedView, base_name='feed-first')
@@ -85,5 +86,7 @@ urlpatterns = [
     url(r'^api/v1/phone/verification', SinchPhoneConfirmationView.as_view(),
         name='sinch-phone-confirmation'),
 
+    url(r'^api/v1/cache/stats/$', CacheStatsView.as_view(), name='cache-stats'),
+
     url(r'^api/v1/', include(api_1.urls)),
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
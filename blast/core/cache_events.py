@@ -0,0 +1,189 @@
+import json
+import logging
+from collections import OrderedDict
+from typing import Dict, List
+
+from django.db import transaction
+from redis.exceptions import LockError, RedisError
+
+from core.redis_client import r, pipeline, on_result
+
+logger = logging.getLogger(__name__)
+
+CACHE_EVENTS_KEY = u'cache:events'
+CACHE_EVENTS_SCHEDULED_KEY = u'cache:events:scheduled'
+# Batch being applied, it is applied again by next consumer if consumer crashed
+CACHE_EVENTS_PROCESSING_KEY = u'cache:events:processing'
+# Events of failed handlers, they are queued again by next consumer
+CACHE_EVENTS_RETRY_KEY = u'cache:events:retry'
+
+# Only one consumer applies events, lock is prolonged after each batch
+CACHE_EVENTS_LOCK_KEY = u'cache:events:lock'
+CACHE_EVENTS_LOCK_TIMEOUT = 60 * 5
+
+# Max count of events applied in one batch
+CACHE_EVENTS_BATCH_SIZE = 500
+
+# Attempts to apply event before it is dropped
+CACHE_EVENTS_MAX_RETRIES = 5
+
+# Seconds after which lost consumer task is scheduled again
+CACHE_EVENTS_SCHEDULE_TIMEOUT = 60
+
+# KEYS: source list, destination list. ARGV: count of moved items
+_LUA_MOVE = '''
+local items = redis.call('LRANGE', KEYS[1], 0, tonumber(ARGV[1]) - 1)
+if #items > 0 then
+    redis.call('RPUSH', KEYS[2], unpack(items))
+    redis.call('LTRIM', KEYS[1], #items, -1)
+end
+return items
+'''
+
+_move_script = r.register_script(_LUA_MOVE)
+
+_handlers = OrderedDict()
+
+
+def cache_event_handler(event_type: str):
+    """
+    Registers consumer of event type. Consumer gets list of unique event payloads
+    and should be idempotent: it reconciles caches with database instead of applying deltas.
+    """
+    def wrap(f):
+        _handlers[event_type] = f
+        return f
+    return wrap
+
+
+def schedule_consumer(is_scheduled: bool):
+    from core.tasks import apply_cache_events
+
+    if is_scheduled:
+        apply_cache_events.delay()
+
+
+def emit_committed(event_type: str, payload: dict):
+    try:
+        with pipeline() as pipe:
+            emit(event_type, pipe, **payload)
+    except RedisError:
+        # Write must not fail, caches are reconciled by next events or rebuilt on read
+        logger.exception('Failed to emit {} event'.format(event_type))
+
+
+def emit(event_type: str, pipe=None, **payload):
+    """
+    Queues cache maintenance event and schedules consumer task.
+    Consumers read database, so event is queued after commit of current transaction.
+    :param pipe: pipe of core.redis_client.pipeline() commands are queued to, caller handles its errors
+    and executes pipe after commit
+    """
+    if pipe is None:
+        transaction.on_commit(lambda: emit_committed(event_type, payload))
+        return
+
+    event = json.dumps([event_type, payload], sort_keys=True)
+    pipe.rpush(CACHE_EVENTS_KEY, event)
+    pipe.set(CACHE_EVENTS_SCHEDULED_KEY, 1, ex=CACHE_EVENTS_SCHEDULE_TIMEOUT, nx=True)
+    on_result(pipe, schedule_consumer)
+
+
+def move_events(source: str, destination: str, count: int) -> List:
+    """Moves events from head of source list to destination list atomically"""
+    events = _move_script(keys=[source, destination], args=[count])
+    return [json.loads(it.decode('utf-8')) for it in events]
+
+
+def pop_events(count: int) -> List:
+    """Returns batch left by crashed consumer or moves next batch to processing list"""
+    events = r.lrange(CACHE_EVENTS_PROCESSING_KEY, 0, -1)
+    if events:
+        logger.info('Apply again {} cache events of interrupted consumer'.format(len(events)))
+        return [json.loads(it.decode('utf-8')) for it in events]
+
+    return move_events(CACHE_EVENTS_KEY, CACHE_EVENTS_PROCESSING_KEY, count)
+
+
+def finish_events(events: List, failed_types: set):
+    """Removes applied batch, keeps events of failed handlers for retry by next consumer"""
+    retries = []
+    for event_type, payload, *rest in events:
+        if event_type not in failed_types:
+            continue
+
+        attempts = (rest[0] if rest else 0) + 1
+        if attempts >= CACHE_EVENTS_MAX_RETRIES:
+            logger.error('Give up {} event {}'.format(event_type, payload))
+        else:
+            retries.append(json.dumps([event_type, payload, attempts], sort_keys=True))
+
+    pipe = r.pipeline()
+    pipe.delete(CACHE_EVENTS_PROCESSING_KEY)
+    if retries:
+        pipe.rpush(CACHE_EVENTS_RETRY_KEY, *retries)
+    pipe.expire(CACHE_EVENTS_LOCK_KEY, CACHE_EVENTS_LOCK_TIMEOUT)
+    pipe.execute()
+
+
+def apply_events(events: List) -> Dict[str, int]:
+    """Applies events grouped by type, returns count of unique payloads of each applied type"""
+    grouped = OrderedDict((it, []) for it in _handlers)
+    seen = set()
+    for event_type, payload, *_ in events:
+        if event_type not in grouped:
+            logger.error('Unknown cache event {}'.format(event_type))
+            continue
+
+        key = (event_type, json.dumps(payload, sort_keys=True))
+        if key not in seen:
+            seen.add(key)
+            grouped[event_type].append(payload)
+
+    result = {}
+    for event_type, payloads in grouped.items():
+        if not payloads:
+            continue
+
+        try:
+            _handlers[event_type](payloads)
+            result[event_type] = len(payloads)
+        except Exception:
+            logger.exception('Failed to apply {} {} events'.format(len(payloads), event_type))
+
+    return result
+
+
+def consume_events(batch_size: int = CACHE_EVENTS_BATCH_SIZE) -> int:
+    """Applies queued events by batches until queue is empty"""
+    lock = r.lock(CACHE_EVENTS_LOCK_KEY, timeout=CACHE_EVENTS_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info('Cache events are applied by other consumer')
+        return 0
+
+    try:
+        r.delete(CACHE_EVENTS_SCHEDULED_KEY)
+
+        # Events failed by previous consumers are retried after queued ones
+        while move_events(CACHE_EVENTS_RETRY_KEY, CACHE_EVENTS_KEY, batch_size):
+            pass
+
+        count = 0
+        while True:
+            events = pop_events(batch_size)
+            if not events:
+                break
+
+            applied = apply_events(events)
+            logger.info('Apply cache events {}'.format(applied))
+
+            failed_types = {it[0] for it in events if it[0] in _handlers} - set(applied)
+            finish_events(events, failed_types)
+            count += len(events)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Lock of cache events consumer expired')
+
+    return count
@@ -0,0 +1,173 @@
+import json
+import logging
+import re
+import time
+from collections import Counter, defaultdict
+from typing import Dict, Iterable
+
+from celery.signals import task_postrun
+from django.core.signals import request_finished
+from django.dispatch import receiver
+from redis.exceptions import RedisError
+
+from core.redis_client import r, memory_usage_many
+
+logger = logging.getLogger(__name__)
+
+# Hash of counters of key pattern, shared by all processes
+CACHE_STATS_KEY = u'cache:stats:{}'
+
+# Seconds between flushes of process counters to redis inside long requests and tasks,
+# counters are also flushed at end of each request and task, so idle processes keep none
+CACHE_STATS_FLUSH_INTERVAL = 10
+
+# Upper bounds of histogram buckets
+DURATION_BUCKETS = (1, 5, 10, 50, 100, 500, 1000, 5000)  # Milliseconds
+SIZE_BUCKETS = (10, 100, 1000, 10000, 100000)  # Members of zset or list
+
+# Count of random keys sampled for memory usage estimation
+MEMORY_SAMPLE_SIZE = 200
+
+_patterns = []
+_counters = defaultdict(Counter)
+_flushed_at = time.time()
+
+
+def register(key_pattern: str):
+    """Registers key pattern of memoized function"""
+    if key_pattern not in _patterns:
+        _patterns.append(key_pattern)
+
+
+def match_pattern(key: str) -> str or None:
+    for it in _patterns:
+        if re.match(u'^{}$'.format(re.escape(it).replace(r'\{\}', '[^:]+')), key):
+            return it
+
+    return None
+
+
+def get_bucket(value: float, buckets: tuple) -> str:
+    for it in buckets:
+        if value <= it:
+            return str(it)
+
+    return u'inf'
+
+
+def maybe_flush():
+    if time.time() - _flushed_at >= CACHE_STATS_FLUSH_INTERVAL:
+        flush()
+
+
+def incr(key_pattern: str, field: str, amount: int = 1):
+    _counters[key_pattern][field] += amount
+    maybe_flush()
+
+
+def hit(key_pattern: str, count: int = 1):
+    if count:
+        incr(key_pattern, 'hits', count)
+
+
+def miss(key_pattern: str, count: int = 1):
+    if count:
+        incr(key_pattern, 'misses', count)
+
+
+def observe_heat_up(key_pattern: str, started_at: float, size: int):
+    """Records duration of heat up started at started_at and size of built result"""
+    duration = (time.time() - started_at) * 1000
+
+    counter = _counters[key_pattern]
+    counter['heat_ups'] += 1
+    counter['heat_up_ms'] += int(duration)
+    counter['heat_up_ms_le_{}'.format(get_bucket(duration, DURATION_BUCKETS))] += 1
+    counter['size'] += size
+    counter['size_le_{}'.format(get_bucket(size, SIZE_BUCKETS))] += 1
+    maybe_flush()
+
+
+def flush():
+    """Adds process counters to shared stats and logs them in scrapable format"""
+    global _flushed_at
+    _flushed_at = time.time()
+
+    counters = {k: dict(v) for k, v in _counters.items() if v}
+    _counters.clear()
+    if not counters:
+        return
+
+    try:
+        pipe = r.pipeline(transaction=False)
+        for key_pattern, fields in counters.items():
+            for field, amount in fields.items():
+                pipe.hincrby(CACHE_STATS_KEY.format(key_pattern), field, amount)
+        pipe.execute()
+    except RedisError:
+        logger.exception('Failed to flush cache stats')
+
+    logger.info('cache_stats {}'.format(json.dumps(counters, sort_keys=True)))
+
+
+@receiver(request_finished, dispatch_uid='flush_cache_stats_on_request_finished')
+def flush_on_request_finished(**kwargs):
+    flush()
+
+
+@task_postrun.connect(dispatch_uid='flush_cache_stats_on_task_postrun')
+def flush_on_task_postrun(**kwargs):
+    flush()
+
+
+def get_memory_usage(sample_size: int = MEMORY_SAMPLE_SIZE) -> Dict[str, int] or None:
+    """Estimates bytes used by keys of each pattern by random sample of keys, None if it is unavailable"""
+    total = r.dbsize()
+    if not total:
+        return {}
+
+    pipe = r.pipeline(transaction=False)
+    for _ in range(sample_size):
+        pipe.randomkey()
+    keys = [it.decode('utf-8') for it in pipe.execute() if it]
+    if not keys:
+        return {}
+
+    sizes = memory_usage_many(keys)
+    if sizes is None:
+        return None
+
+    sampled = Counter()
+    for key, size in zip(keys, sizes):
+        sampled[match_pattern(key) or u'other'] += size
+
+    return {k: v * total // len(keys) for k, v in sampled.items()}
+
+
+def get_stats(key_patterns: Iterable[str] = None) -> Dict[str, Dict]:
+    """Returns shared counters and estimated memory usage of key patterns"""
+    flush()
+
+    key_patterns = list(key_patterns or _patterns)
+    pipe = r.pipeline(transaction=False)
+    for it in key_patterns:
+        pipe.hgetall(CACHE_STATS_KEY.format(it))
+
+    result = {}
+    for key_pattern, fields in zip(key_patterns, pipe.execute()):
+        stats = {k.decode('utf-8'): int(v) for k, v in fields.items()}
+        requests = stats.get('hits', 0) + stats.get('misses', 0)
+        stats['hit_ratio'] = round(stats.get('hits', 0) / requests, 4) if requests else None
+        result[key_pattern] = stats
+
+    memory = get_memory_usage()
+    if memory is None:
+        # MEMORY USAGE needs Redis 4.0
+        for stats in result.values():
+            stats['memory'] = None
+        return result
+
+    for key_pattern, size in memory.items():
+        result.setdefault(key_pattern, {})['memory'] = size
+
+    return result
@@ -0,0 +1,188 @@
+"""
+Write-behind counters of model fields.
+
+Increments are accumulated in redis hashes of pk to pending delta and flushed
+to database in bulk by core.tasks.flush_counters, so hot rows are not locked
+by each event. Reads add pending deltas to database values.
+
+Flush of counter holds its lock. Flushing hash gets id which is saved to CounterFlush
+in transaction of applied deltas, so flush retried after crash does not apply them twice.
+"""
+import logging
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+from typing import Dict, Iterable
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+from redis.exceptions import LockError, ResponseError
+
+from core.models import CounterFlush
+from core.redis_client import r, pipeline, on_result
+
+logger = logging.getLogger(__name__)
+
+# Hash of pk to pending delta of model field
+COUNTER_KEY = u'counters:{}:{}'
+COUNTER_FLUSHING_KEY = u'counters:{}:{}:flushing'
+COUNTER_LOCK_KEY = u'counters:{}:{}:lock'
+
+# Field of flushing hash with id of flush
+FLUSH_ID_FIELD = u'flush_id'
+
+COUNTER_LOCK_TIMEOUT = 60 * 5
+
+# Applied flushes are kept while their flushing hashes can be left by crashed flush
+COUNTER_FLUSHES_TTL = timedelta(days=1)
+
+COUNTERS_SCHEDULED_KEY = u'counters:scheduled'
+
+# Seconds increments are accumulated before flush
+COUNTERS_FLUSH_DELAY = 5
+
+_counters = OrderedDict()
+
+
+def get_key(model, field: str) -> str:
+    return COUNTER_KEY.format(model._meta.label_lower, field)
+
+
+def get_flushing_key(model, field: str) -> str:
+    return COUNTER_FLUSHING_KEY.format(model._meta.label_lower, field)
+
+
+def get_lock_key(model, field: str) -> str:
+    return COUNTER_LOCK_KEY.format(model._meta.label_lower, field)
+
+
+def register(model, field: str, update=None):
+    """
+    Registers counter field of model, registered counters are flushed by task.
+    :param update: function of pks and delta applying delta to rows instead of adding it to field,
+    pending deltas of such counters are not read
+    """
+    _counters[get_key(model, field)] = (model, field, update)
+
+
+def schedule_flush(is_scheduled: bool):
+    from core.tasks import flush_counters
+
+    if is_scheduled:
+        flush_counters.apply_async(countdown=COUNTERS_FLUSH_DELAY)
+
+
+def incr(model, field: str, pks: Iterable, amount: int = 1, pipe=None):
+    """
+    Adds amount to counter of each pk and schedules flush.
+    :param pipe: pipe of core.redis_client.pipeline() commands are queued to
+    """
+    pks = list(pks)
+    if not pks:
+        return
+
+    key = get_key(model, field)
+    assert key in _counters, 'Counter {} is not registered'.format(key)
+
+    if pipe is None:
+        with pipeline() as pipe:
+            incr(model, field, pks, amount, pipe)
+        return
+
+    for pk in pks:
+        pipe.hincrby(key, pk, amount)
+    pipe.set(COUNTERS_SCHEDULED_KEY, 1, ex=COUNTERS_FLUSH_DELAY * 10, nx=True)
+    on_result(pipe, schedule_flush)
+
+
+def get_pending(model, field: str, pks: Iterable) -> Dict:
+    """Returns map of pk to delta not flushed to database yet"""
+    pks = list(pks)
+    if not pks:
+        return {}
+
+    pipe = r.pipeline(transaction=False)
+    pipe.hmget(get_key(model, field), pks)
+    pipe.hmget(get_flushing_key(model, field), pks)
+    pending, flushing = pipe.execute()
+
+    return {pk: int(a or 0) + int(b or 0) for pk, a, b in zip(pks, pending, flushing)}
+
+
+def get_values(model, field: str, values: Dict) -> Dict:
+    """Adds pending deltas to map of pk to database value"""
+    pending = get_pending(model, field, values.keys())
+    return {pk: value + pending[pk] for pk, value in values.items()}
+
+
+def apply_flushing(model, field: str, update=None) -> int:
+    """Applies deltas of flushing hash to database once, returns count of updated rows"""
+    key, flushing_key = get_key(model, field), get_flushing_key(model, field)
+
+    # Deltas of interrupted flush are applied first
+    if not r.exists(flushing_key):
+        try:
+            r.rename(key, flushing_key)  # New increments go to new hash
+        except ResponseError:
+            return 0  # Nothing to flush
+
+    # Retries of interrupted flush keep its id
+    r.hsetnx(flushing_key, FLUSH_ID_FIELD, uuid.uuid4().hex)
+    deltas = r.hgetall(flushing_key)
+    flush_id = deltas.pop(FLUSH_ID_FIELD.encode('utf-8')).decode('utf-8')
+
+    to_pk = model._meta.pk.to_python
+    pks_by_delta = defaultdict(list)
+    for pk, delta in deltas.items():
+        if int(delta):
+            pks_by_delta[int(delta)].append(to_pk(pk.decode('utf-8')))
+
+    count = sum(len(it) for it in pks_by_delta.values())
+    with transaction.atomic():
+        if CounterFlush.objects.filter(flush_id=flush_id).exists():
+            logger.info('Flush {} of {} counters of {} is applied already'.format(flush_id, field, model._meta.label))
+            count = 0
+        else:
+            CounterFlush.objects.create(flush_id=flush_id)
+            for delta, pks in pks_by_delta.items():
+                if update:
+                    update(pks, delta)
+                else:
+                    model.objects.filter(pk__in=pks).update(**{field: F(field) + delta})
+
+    r.delete(flushing_key)
+
+    logger.info('Flushed {} {} counters of {}'.format(count, field, model._meta.label))
+    return count
+
+
+def flush_counter(model, field: str, update=None) -> int:
+    """Applies pending deltas of counter to database, returns count of updated rows"""
+    lock = r.lock(get_lock_key(model, field), timeout=COUNTER_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info('{} counters of {} are flushed by other worker'.format(field, model._meta.label))
+        return 0
+
+    try:
+        return apply_flushing(model, field, update)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Lock of {} counters of {} expired during flush'.format(field, model._meta.label))
+
+
+def flush() -> int:
+    """Flushes all registered counters"""
+    r.delete(COUNTERS_SCHEDULED_KEY)
+    CounterFlush.objects.filter(created_at__lt=timezone.now() - COUNTER_FLUSHES_TTL).delete()
+
+    count = 0
+    for model, field, update in _counters.values():
+        try:
+            count += flush_counter(model, field, update)
+        except Exception:
+            logger.exception('Failed to flush {} counters of {}'.format(field, model._meta.label))
+
+    return count
@@ -1,51 +1,249 @@
 import logging
-import redis
+import time
+from typing import Dict, Iterable, List
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+from redis.exceptions import LockError
+
+from core import cache_stats
+from core.redis_client import r, pipeline
+from core.zset_store import ZsetStore, get_pairs, get_store
 
 logger = logging.getLogger(__name__)
 
 
+# Lock of sorted set key held by process which heats it up
+HEAT_UP_LOCK_KEY = u'{}:lock'
+
+# Max seconds heat up lock is held
+HEAT_UP_LOCK_TIMEOUT = 30
+
+# Max seconds to wait for heat up in other process
+HEAT_UP_WAIT_TIMEOUT = 5
+
+
+def is_valid_zset_result(key: str, result: list) -> bool:
+    if not result:
+        logger.debug('Nothing to cache. Key is {}'.format(key))
+        return False
+
+    if len(result) % 2:
+        logger.error('Invalid result size for {}. Size is {}'.format(key, len(result)))
+        return False
+
+    return True
+
+
+def zrevrange_result(result: list, start: int, end: int) -> list:
+    """Returns members of not cached result like ZREVRANGE does"""
+    members = [int(member) for score, member in get_pairs(result)]
+    return members[start:] if end == -1 else members[start:end + 1]
+
+
+def heat_up_zset(store: ZsetStore, pk, build) -> list or None:
+    """
+    Builds sorted set by one process at a time, others wait for it.
+    :param build: function returns list of score and member pairs
+    :return: None if key is cached, built result otherwise
+    """
+    key = store.key(pk)
+    lock = r.lock(HEAT_UP_LOCK_KEY.format(key), timeout=HEAT_UP_LOCK_TIMEOUT,
+                  blocking_timeout=HEAT_UP_WAIT_TIMEOUT)
+    if not lock.acquire():
+        if store.exists(pk):
+            return None
+
+        logger.warning('Heat up of {} is timed out, build it without caching'.format(key))
+        return build()
+
+    try:
+        if store.exists(pk):  # Was heated up while waiting
+            return None
+
+        logger.debug('Heat up cache for {}'.format(key))
+        result = build()
+        if not is_valid_zset_result(key, result):
+            return result
+
+        with pipeline(transaction=True) as pipe:
+            store.write(pipe, pk, result)
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Heat up lock of {} is expired'.format(key))
+
+
+def heat_up_zsets(store: ZsetStore, pks: Iterable, build_many) -> List:
+    """
+    Heats up many "cold" sorted sets in one pass.
+    Sets locked by other processes are skipped, they are heated up by lock holders.
+    :param build_many: function returns map of pk to list of score and member pairs
+    :return: list of heated up pks
+    """
+    key_pattern = store.key_pattern
+    pks = list(pks)
+    hot = store.exists_many(pks)
+    cold = [it for it in pks if it not in hot]
+    cache_stats.hit(key_pattern, len(hot))
+    cache_stats.miss(key_pattern, len(cold))
+    if not cold:
+        return []
+
+    locks = {}
+    for pk in cold:
+        lock = r.lock(HEAT_UP_LOCK_KEY.format(store.key(pk)), timeout=HEAT_UP_LOCK_TIMEOUT)
+        if lock.acquire(blocking=False):
+            locks[pk] = lock
+
+    heated = []
+    try:
+        # Sets could be heated up before locking
+        hot = store.exists_many(locks)
+        cold = [it for it in locks if it not in hot]
+        if not cold:
+            return []
+
+        started_at = time.time()
+        results = build_many(cold)
+        cache_stats.observe_heat_up(key_pattern, started_at, sum(len(it) // 2 for it in results.values()))
+
+        with pipeline() as pipe:
+            for pk in cold:
+                result = results.get(pk)
+                if is_valid_zset_result(store.key(pk), result):
+                    store.write(pipe, pk, result)
+                    heated.append(pk)
+    finally:
+        for pk, lock in locks.items():
+            try:
+                lock.release()
+            except LockError:
+                logger.warning('Heat up lock of {} is expired'.format(store.key(pk)))
+
+    logger.info('Heat up {} keys of {}'.format(len(heated), key_pattern))
+    return heated
+
+
 # FIXME: Rename to memoize_zset?
-def save_to_zset(key_pattern: str):
+def save_to_zset(key_pattern: str, ttl: int = None, compact: bool = False, scored: bool = True):
+    """
+    Caches sorted set returned by function as flat list of score and member pairs.
+    Decorated function gets store for changing cached sets, see core.zset_store.
+    :param compact: allows compact storage enabled by COMPACT_ZSETS setting
+    :param scored: False if members are scores of itself
+    """
+    store = get_store(key_pattern, ttl, compact, scored)
+
     def wrap(f):
+        def build(pk, start: int, end: int) -> list:
+            started_at = time.time()
+            result = f(pk, start, end)
+            cache_stats.observe_heat_up(key_pattern, started_at, len(result or []) // 2)
+            return result
+
         def wrapped_function(pk, start: int, end: int):
-            key = key_pattern.format(pk)
-            if not r.exists(key):
-                logger.debug('Heat up cache for {}'.format(key))
-                result = f(pk, start, end)
+            if not store.exists(pk):
+                cache_stats.miss(key_pattern)
+                result = heat_up_zset(store, pk, lambda: build(pk, start, end))
+                if result is not None:
+                    # Result is not cached
+                    if not result or len(result) % 2:
+                        return []
 
-                if not result:
-                    logger.debug('Nothing to cache. Key is {}'.format(key))
-                    return []
+                    return zrevrange_result(result, start, end)
+            else:
+                cache_stats.hit(key_pattern)
 
-                if len(result) % 2:
-                    logger.error('Invalid result size for {}. Size is {}'.format(key, len(result)))
-                    return []
+            return store.range(pk, start, end)
 
-                r.zadd(key, *result)
-            result = r.zrevrange(key, start, end)
-            return [int(it) for it in result]
+        cache_stats.register(key_pattern)
+        wrapped_function.key_pattern = key_pattern
+        wrapped_function.store = store
         return wrapped_function
     return wrap
 
 
-def memoize_list(key_pattern: str):
+def memoize_list(key_pattern: str, max_length: int = None, ttl: int = None):
+    """
+    Caches list returned by function in redis list, head of list goes first.
+    Decorated function gets push(pk, value) for adding value to head of "hot" list
+    and get_many(pks, start, end) for reading many lists in one round trip.
+    :param max_length: max length of cached list, tail is trimmed
+    :param ttl: time to live of cached list in seconds
+    """
     def wrap(f):
+        def heat_up(pk) -> list:
+            key = key_pattern.format(pk)
+            logger.debug('Heat up cache for %s', key)
+
+            started_at = time.time()
+            result = list(f(pk, 0, -1))
+            if max_length:
+                result = result[:max_length]
+            cache_stats.observe_heat_up(key_pattern, started_at, len(result))
+
+            if not result:
+                logger.debug('Nothing to cache for %s key', key)
+                return []
+
+            with pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                pipe.rpush(key, *result)
+                if ttl:
+                    pipe.expire(key, ttl)
+
+            return result
+
         def wrapped_function(pk: int, start: int, end: int):
             key = key_pattern.format(pk)
             if not r.exists(key):
-                logger.debug('Heat up cache for %s', key)
-                result = f(pk, start, end)
+                cache_stats.miss(key_pattern)
+                result = heat_up(pk)
+                result = result[start:] if end == -1 else result[start:end + 1]
+                return [int(it) for it in result]
 
-                if not result:
-                    logger.debug('Nothing to cache for %s key', key)
-                    return []
+            cache_stats.hit(key_pattern)
+            cached = r.lrange(key, start, end)
+            return [int(it) for it in cached]
 
-                for it in result:
-                    r.lpush(key, it)
+        def get_many(pks: Iterable, start: int, end: int) -> Dict:
+            """Returns map of pk to cached list, "cold" lists are heated up one by one"""
+            pks = list(pks)
 
-            cached = r.lrange(key, start, end)
-            return (int(it) for it in cached)
+            pipe = r.pipeline(transaction=False)
+            for pk in pks:
+                pipe.lrange(key_pattern.format(pk), start, end)
+
+            result, hits = {}, 0
+            for pk, cached in zip(pks, pipe.execute()):
+                if cached:
+                    result[pk] = [int(it) for it in cached]
+                    hits += 1
+                else:
+                    result[pk] = wrapped_function(pk, start, end)
+
+            cache_stats.hit(key_pattern, hits)
+            return result
+
+        def push(pk: int, value, client=None):
+            """
+            Adds value to head of "hot" list and trims its tail, repeated push moves value to head.
+            :param client: pipe commands are queued to, they are sent at once otherwise
+            """
+            if client is None:
+                with pipeline() as pipe:
+                    push(pk, value, pipe)
+                return
+
+            key = key_pattern.format(pk)
+            client.lrem(key, 0, value)
+            client.lpushx(key, value)
+            if max_length:
+                client.ltrim(key, 0, max_length - 1)
+
+        cache_stats.register(key_pattern)
+        wrapped_function.key_pattern = key_pattern
+        wrapped_function.get_many = get_many
+        wrapped_function.push = push
         return wrapped_function
     return wrap
@@ -0,0 +1,98 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from redis.exceptions import RedisError
+
+from core import cache_stats
+from core.redis_client import r
+
+logger = logging.getLogger(__name__)
+
+# Version of local cache, incremented by invalidation in any process
+LOCAL_CACHE_VERSION_KEY = u'local:cache:{}:version'
+
+# Max seconds other processes serve invalidated values
+LOCAL_CACHE_VERSION_CHECK_INTERVAL = 5
+
+_caches = []
+
+
+def clear_all():
+    """Drops entries of all local caches of current process"""
+    for it in _caches:
+        it.clear()
+
+
+def local_cache(name: str, ttl: int = 300, max_size: int = 128):
+    """
+    Memoizes near-static lookups in process memory by positional arguments,
+    least recently used entries are evicted when cache is full.
+    Decorated function gets invalidate() dropping entries in all processes:
+    other processes notice bumped version key within LOCAL_CACHE_VERSION_CHECK_INTERVAL.
+    Returned objects are shared, callers must not modify them.
+    """
+    def wrap(f):
+        entries = OrderedDict()
+        lock = threading.RLock()
+        state = {'version': None, 'checked_at': 0}
+        version_key = LOCAL_CACHE_VERSION_KEY.format(name)
+        stats_key = u'local:{}'.format(name)
+
+        def check_version():
+            now = time.time()
+            if now - state['checked_at'] < LOCAL_CACHE_VERSION_CHECK_INTERVAL:
+                return
+
+            state['checked_at'] = now
+            try:
+                version = int(r.get(version_key) or 0)
+            except RedisError:
+                logger.exception('Failed to check version of {} local cache'.format(name))
+                return
+
+            if version != state['version']:
+                entries.clear()
+                state['version'] = version
+
+        @wraps(f)
+        def wrapped_function(*args):
+            with lock:
+                check_version()
+
+                entry = entries.get(args)
+                if entry is not None and entry[1] > time.time():
+                    entries.move_to_end(args)
+                    cache_stats.hit(stats_key)
+                    return entry[0]
+
+            cache_stats.miss(stats_key)
+            value = f(*args)
+
+            with lock:
+                entries[args] = (value, time.time() + ttl)
+                entries.move_to_end(args)
+                while len(entries) > max_size:
+                    entries.popitem(last=False)
+
+            return value
+
+        def clear():
+            with lock:
+                entries.clear()
+                state['checked_at'] = 0
+
+        def invalidate():
+            clear()
+            try:
+                r.incr(version_key)
+            except RedisError:
+                logger.exception('Failed to invalidate {} local cache'.format(name))
+
+        wrapped_function.clear = clear
+        wrapped_function.invalidate = invalidate
+        _caches.append(wrapped_function)
+        return wrapped_function
+    return wrap
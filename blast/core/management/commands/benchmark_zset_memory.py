@@ -0,0 +1,94 @@
+"""
+Compares redis memory used by sorted set per pk and compact storage on synthetic graph.
+
+    ./manage.py benchmark_zset_memory --users 100000 --degree 20 --posts 5
+
+Benchmark keys are written under "benchmark:" prefix and deleted when done.
+"""
+import random
+
+from django.core.management.base import BaseCommand
+
+from core.redis_client import r, get_config, pipeline
+from core.zset_store import ZsetStore, CompactZsetStore, get_bucket_count
+
+BENCHMARK_KEY_PREFIX = u'benchmark:'
+
+BENCHMARK_CHUNK_SIZE = 1000
+
+
+def generate_sets(users: int, degree: int, posts: int, seed: int) -> dict:
+    """Returns map of set name to map of user id to flat list of score and member pairs"""
+    rng = random.Random(seed)
+
+    followers, user_posts = {}, {}
+    post_id = 0
+    for pk in range(1, users + 1):
+        count = min(users - 1, int(rng.expovariate(1 / degree)))
+        members = rng.sample(range(1, users + 1), count)
+        followers[pk] = [it for member in members for it in (member, member)]
+
+        user_posts[pk] = []
+        for _ in range(int(rng.expovariate(1 / posts)) if posts else 0):
+            post_id += 1
+            user_posts[pk].extend([rng.randint(-10, 100), post_id])
+
+    return {'followers': followers, 'posts': user_posts}
+
+
+def delete_benchmark_keys():
+    keys = list(r.scan_iter(match=u'{}*'.format(BENCHMARK_KEY_PREFIX), count=BENCHMARK_CHUNK_SIZE))
+    for i in range(0, len(keys), BENCHMARK_CHUNK_SIZE):
+        r.delete(*keys[i:i + BENCHMARK_CHUNK_SIZE])
+
+
+def measure(store, sets: dict) -> tuple:
+    """Writes sets to store, returns count of keys and bytes used"""
+    delete_benchmark_keys()
+    before = r.info('memory')['used_memory']
+
+    items = [(pk, result) for pk, result in sets.items() if result]
+    for i in range(0, len(items), BENCHMARK_CHUNK_SIZE):
+        with pipeline() as pipe:
+            for pk, result in items[i:i + BENCHMARK_CHUNK_SIZE]:
+                store.write(pipe, pk, result)
+
+    keys = sum(1 for _ in r.scan_iter(match=u'{}*'.format(BENCHMARK_KEY_PREFIX), count=BENCHMARK_CHUNK_SIZE))
+    used = r.info('memory')['used_memory'] - before
+    delete_benchmark_keys()
+
+    return keys, used
+
+
+class Command(BaseCommand):
+    help = 'Compares redis memory of sorted set per pk and compact storage on synthetic graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=10000)
+        parser.add_argument('--degree', type=int, default=20, help='Average count of followers')
+        parser.add_argument('--posts', type=int, default=5, help='Average count of live posts')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        config = get_config()
+        ziplist = r.config_get('hash-max-ziplist-*')
+        self.stdout.write('hash-max-ziplist-entries {}, hash-max-ziplist-value {}, max members {}'.format(
+            ziplist.get('hash-max-ziplist-entries'), ziplist.get('hash-max-ziplist-value'),
+            config['COMPACT_ZSET_MAX_MEMBERS']))
+
+        sets = generate_sets(options['users'], options['degree'], options['posts'], options['seed'])
+        for name, scored in (('followers', False), ('posts', True)):
+            members = sum(len(it) // 2 for it in sets[name].values())
+            key_pattern = BENCHMARK_KEY_PREFIX + u'{}:{{}}:{}'
+            layouts = (
+                ('zset', ZsetStore(key_pattern.format('zset', name))),
+                ('compact', CompactZsetStore(key_pattern.format('compact', name), scored=scored,
+                                             buckets=get_bucket_count(options['users'],
+                                                                      config['COMPACT_ZSET_BUCKET_SIZE']),
+                                             max_members=config['COMPACT_ZSET_MAX_MEMBERS'])),
+            )
+
+            for layout, store in layouts:
+                keys, used = measure(store, sets[name])
+                self.stdout.write('{} {}: {} members, {} keys, {} bytes, {:.1f} bytes per member'.format(
+                    name, layout, members, keys, used, used / members if members else 0))
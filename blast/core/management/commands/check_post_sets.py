@@ -0,0 +1,106 @@
+"""
+Compares cached posts sets of users and tags with live posts in database.
+
+    ./manage.py check_post_sets                 # report drift
+    ./manage.py check_post_sets tags --repair   # rebuild drifted sets of tags
+
+Only "hot" sets are checked, "cold" ones are built from database on first read.
+Expired posts waiting for removal by clear_expired_posts task are not counted as drift.
+"""
+import logging
+from collections import OrderedDict, namedtuple
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from core.management.commands.warm_up_cache import iter_chunks, WARM_UP_CHUNK_SIZE
+from core.redis_client import pipeline, zscore_many
+from posts.models import Post, POSTS_INDEXED_EXPIRES_KEY, get_indexed_member
+from tags.models import Tag
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+# lookup is field of Post filtering posts of set pk, index is name of set in expiration index
+PostSet = namedtuple('PostSet', ['queryset', 'store', 'lookup', 'heat_up', 'index'])
+
+POST_SETS = OrderedDict([
+    ('users', PostSet(User.objects.all, User.get_posts.store, 'user', User.heat_up_posts, 'user')),
+    ('tags', PostSet(Tag.objects.all, Tag.get_posts.store, 'tags', Tag.heat_up_posts, 'tag')),
+])
+
+
+def get_live_posts(post_set: PostSet, pks: list) -> dict:
+    """Returns map of pk to set of ids of live posts"""
+    posts = Post.objects.actual().filter(**{'{}__in'.format(post_set.lookup): pks})
+
+    result = {pk: set() for pk in pks}
+    for pk, post_id in posts.values_list(post_set.lookup, 'pk'):
+        result[pk].add(post_id)
+
+    return result
+
+
+def get_expired_members(post_set: PostSet, members: list) -> set:
+    """Returns (pk, post_id) members of sets indexed as expired by now, they are pruned by clear_expired_posts"""
+    indexed = {it: get_indexed_member(post_set.index, *it) for it in members}
+    scores = zscore_many(POSTS_INDEXED_EXPIRES_KEY, indexed.values())
+
+    now = timezone.now().timestamp()
+    return {it for it, member in indexed.items() if scores[member] is not None and scores[member] <= now}
+
+
+class Command(BaseCommand):
+    help = 'Reports and repairs drift of cached posts sets of users and tags from database'
+
+    def add_arguments(self, parser):
+        parser.add_argument('sets', nargs='*', help='Sets to check: {}'.format(', '.join(POST_SETS)))
+        parser.add_argument('--repair', action='store_true', default=False,
+                            help='Rebuild drifted sets from database')
+        parser.add_argument('--chunk-size', type=int, default=WARM_UP_CHUNK_SIZE,
+                            help='Count of rows loaded from database at once')
+
+    def handle(self, *args, **options):
+        names = options['sets'] or list(POST_SETS)
+        unknown = set(names) - set(POST_SETS)
+        if unknown:
+            raise CommandError('Unknown sets: {}'.format(', '.join(sorted(unknown))))
+
+        for name in names:
+            self.check(name, options['chunk_size'], options['repair'])
+
+    def check(self, name: str, chunk_size: int, repair: bool):
+        post_set = POST_SETS[name]
+
+        checked, drifted, stale, missing = 0, 0, 0, 0
+        for pks in iter_chunks(post_set.queryset(), None, chunk_size):
+            hot = post_set.store.exists_many(pks)
+            hot_pks = [it for it in pks if it in hot]
+            live = get_live_posts(post_set, hot_pks)
+
+            cached = {pk: set(post_set.store.range(pk, 0, -1)) for pk in hot_pks}
+            expired = get_expired_members(post_set, [(pk, it) for pk in hot_pks for it in cached[pk] - live[pk]])
+
+            drifted_pks = []
+            for pk in hot_pks:
+                stale_posts = {it for it in cached[pk] - live[pk] if (pk, it) not in expired}
+                missing_posts = live[pk] - cached[pk]
+                if stale_posts or missing_posts:
+                    drifted_pks.append(pk)
+                    stale += len(stale_posts)
+                    missing += len(missing_posts)
+
+            checked += len(hot_pks)
+            drifted += len(drifted_pks)
+
+            if repair and drifted_pks:
+                with pipeline() as pipe:
+                    for pk in drifted_pks:
+                        post_set.store.delete(pk, client=pipe)
+                post_set.heat_up(drifted_pks)
+
+        if repair and drifted:
+            logger.info('Rebuilt {} drifted {} posts sets'.format(drifted, name))
+
+        self.stdout.write('{}: {} checked, {} drifted, {} stale posts, {} missing posts{}'.format(
+            name, checked, drifted, stale, missing, ', repaired' if repair and drifted else ''))
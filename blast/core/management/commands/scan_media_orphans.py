@@ -0,0 +1,34 @@
+"""
+Finds media files of posts not referenced by any post, e.g. left by crashed deletes.
+
+    ./manage.py scan_media_orphans              # report orphans
+    ./manage.py scan_media_orphans --enqueue    # queue orphans to media collector
+
+Files modified during last hour are skipped, they can belong to post which is being created.
+"""
+import logging
+
+from django.core.management.base import BaseCommand
+
+from posts import media_gc
+
+logger = logging.getLogger(__name__)
+
+
+class Command(BaseCommand):
+    help = 'Reports media files of posts not referenced by any post'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--enqueue', action='store_true', default=False,
+                            help='Queue orphans to media collector')
+
+    def handle(self, *args, **options):
+        orphans = list(media_gc.iter_orphans())
+        for name in orphans:
+            self.stdout.write(name)
+
+        if options['enqueue'] and orphans:
+            media_gc.enqueue([name] for name in orphans)
+            logger.info('Queued {} orphan media files'.format(len(orphans)))
+
+        self.stdout.write('{} orphans'.format(len(orphans)))
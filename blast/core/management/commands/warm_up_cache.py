@@ -0,0 +1,197 @@
+"""
+Rebuilds "cold" redis caches in bulk, so cold start after redis flush or restart does not hit users.
+
+    ./manage.py warm_up_cache                       # all caches
+    ./manage.py warm_up_cache posts tags -p 4       # some caches by 4 processes
+    ./manage.py warm_up_cache --dry-run             # report of keys and memory
+
+Schedule of ending soon notifications is rebuilt too, posts scheduled already are kept.
+"""
+import logging
+import multiprocessing
+from collections import OrderedDict, namedtuple
+from typing import Iterable, List
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from core import counters
+from core.redis_client import r, pipeline, exists_many, memory_usage_many
+from posts.ending_soon import ENDING_SOON_KEY
+from posts.models import Post, schedule_ending_soon
+from tags.models import Tag
+from users.models import User
+
+logger = logging.getLogger(__name__)
+
+# Hash of cache name to last warmed up pk, command continues from it when restarted
+WARM_UP_PROGRESS_KEY = u'cache:warm_up:progress'
+
+WARM_UP_CHUNK_SIZE = 500
+
+# Users set and zset are built aside and renamed when complete
+USERS_KEYS = (User.USERS_SET_KEY, User.USERS_ZSET_KEY)
+USERS_BUILD_KEY = u'{}:warm_up'
+
+
+def add_users(user_ids: Iterable[int]) -> List[int]:
+    users = dict(User.objects.filter(pk__in=user_ids).values_list('pk', 'popularity'))
+    if not users:
+        return []
+
+    scores = []
+    for pk, popularity in counters.get_values(User, 'popularity', users).items():
+        scores.extend([popularity, pk])
+
+    with pipeline() as pipe:
+        pipe.sadd(USERS_BUILD_KEY.format(User.USERS_SET_KEY), *users)
+        pipe.zadd(USERS_BUILD_KEY.format(User.USERS_ZSET_KEY), *scores)
+
+    return list(users)
+
+
+def reset_users():
+    r.delete(*[USERS_BUILD_KEY.format(it) for it in USERS_KEYS])
+
+
+def finish_users():
+    build_keys = exists_many(USERS_BUILD_KEY.format(it) for it in USERS_KEYS)
+    with pipeline(transaction=True) as pipe:
+        for key in USERS_KEYS:
+            if USERS_BUILD_KEY.format(key) in build_keys:
+                pipe.rename(USERS_BUILD_KEY.format(key), key)
+
+
+# store is None for caches of all rows in keys, they are rebuilt even if "hot"
+Cache = namedtuple('Cache', ['queryset', 'store', 'heat_up', 'reset', 'finish', 'keys'])
+
+CACHES = OrderedDict([
+    ('users', Cache(User.objects.all, None, add_users, reset_users, finish_users, USERS_KEYS)),
+    ('posts', Cache(User.objects.all, User.get_posts.store, User.heat_up_posts, None, None, None)),
+    ('followers', Cache(User.objects.all, User.get_followers.store, User.heat_up_followers, None, None, None)),
+    ('followees', Cache(User.objects.all, User.get_followees.store, User.heat_up_followees, None, None, None)),
+    ('tags', Cache(Tag.objects.all, Tag.get_posts.store, Tag.heat_up_posts, None, None, None)),
+    ('ending_soon', Cache(Post.objects.actual, None, schedule_ending_soon, None, None, (ENDING_SOON_KEY,))),
+])
+
+
+def iter_chunks(queryset, last_pk, chunk_size: int):
+    """Streams primary keys ordered by pk after last_pk"""
+    queryset = queryset.order_by('pk').values_list('pk', flat=True)
+    while True:
+        chunk_qs = queryset if last_pk is None else queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def warm_up_chunk(args) -> tuple:
+    """Runs in worker process, returns last pk of chunk and count of built keys"""
+    name, pks = args
+    return pks[-1], len(CACHES[name].heat_up(pks))
+
+
+def format_bytes(size: int or None) -> str:
+    """Memory is unavailable before Redis 4.0"""
+    return 'unknown' if size is None else '{}'.format(size)
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds "cold" redis caches of users, followers, followees, tags and ending soon schedule in bulk'
+
+    def add_arguments(self, parser):
+        parser.add_argument('caches', nargs='*', help='Caches to warm up: {}'.format(', '.join(CACHES)))
+        parser.add_argument('-p', '--processes', type=int, default=multiprocessing.cpu_count(),
+                            help='Count of worker processes')
+        parser.add_argument('--chunk-size', type=int, default=WARM_UP_CHUNK_SIZE,
+                            help='Count of rows loaded from database at once')
+        parser.add_argument('--restart', action='store_true', default=False,
+                            help='Ignore progress of previous interrupted run')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Report counts and memory of keys without building them')
+
+    def handle(self, *args, **options):
+        names = options['caches'] or list(CACHES)
+        unknown = set(names) - set(CACHES)
+        if unknown:
+            raise CommandError('Unknown caches: {}'.format(', '.join(sorted(unknown))))
+
+        for name in names:
+            if options['dry_run']:
+                self.report(name, options['chunk_size'])
+            else:
+                self.warm_up(name, options['chunk_size'], options['processes'], options['restart'])
+
+    def get_last_pk(self, name: str, restart: bool):
+        last_pk = r.hget(WARM_UP_PROGRESS_KEY, name)
+        if restart or last_pk is None:
+            return None
+
+        return CACHES[name].queryset().model._meta.pk.to_python(last_pk.decode('utf-8'))
+
+    def warm_up(self, name: str, chunk_size: int, processes: int, restart: bool):
+        cache = CACHES[name]
+        last_pk = self.get_last_pk(name, restart)
+        if last_pk is None:
+            r.hdel(WARM_UP_PROGRESS_KEY, name)
+            if cache.reset:
+                cache.reset()
+        else:
+            self.stdout.write('{}: resume after {}'.format(name, last_pk))
+
+        tasks = ((name, it) for it in iter_chunks(cache.queryset(), last_pk, chunk_size))
+
+        pool = None
+        if processes > 1:
+            # Workers open own database connections, redis pool is reset after fork
+            connections.close_all()
+            pool = multiprocessing.Pool(processes)
+
+        built = 0
+        try:
+            results = pool.imap(warm_up_chunk, tasks) if pool else map(warm_up_chunk, tasks)
+            for chunk_last_pk, count in results:
+                # Results are ordered, so all chunks up to this one are done
+                r.hset(WARM_UP_PROGRESS_KEY, name, chunk_last_pk)
+                built += count
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if cache.finish:
+            cache.finish()
+
+        r.hdel(WARM_UP_PROGRESS_KEY, name)
+        logger.info('Warmed up {} keys of {} cache'.format(built, name))
+        self.stdout.write('{}: built {}'.format(name, built))
+
+    def report(self, name: str, chunk_size: int):
+        cache = CACHES[name]
+
+        if cache.store is None:
+            rows = cache.queryset().count()
+            hot_keys = exists_many(cache.keys)
+            sizes = memory_usage_many(hot_keys)
+            self.stdout.write('{}: {} keys, {} hot, {} rows, {} bytes'.format(
+                name, len(cache.keys), len(hot_keys), rows, format_bytes(None if sizes is None else sum(sizes))))
+            return
+
+        total, hot, memory = 0, 0, 0
+        for pks in iter_chunks(cache.queryset(), None, chunk_size):
+            hot_pks = cache.store.exists_many(pks)
+            total += len(pks)
+            hot += len(hot_pks)
+            if memory is not None:
+                size = cache.store.memory_usage(hot_pks)
+                memory = None if size is None else memory + size
+
+        # Cold keys are estimated by average size of hot ones
+        estimate = None
+        if memory is not None:
+            estimate = (total - hot) * memory // hot if hot else 0
+        self.stdout.write('{}: {} keys, {} hot, {} cold, {} bytes, ~{} bytes to build'.format(
+            name, total, hot, total - hot, format_bytes(memory), format_bytes(estimate)))
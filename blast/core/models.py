@@ -1,3 +1,13 @@
 from django.db import models
 
-# Create your models here.
+
+class CounterFlush(models.Model):
+    """
+    Flush of pending deltas of core.counters counter applied to database.
+    Saved in transaction of applied deltas, so retried flush does not apply them twice.
+    """
+    flush_id = models.CharField(max_length=32, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    def __str__(self):
+        return self.flush_id
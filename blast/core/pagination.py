@@ -1,10 +1,15 @@
-from datetime import datetime
+import functools
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 
+from django.core.exceptions import ValidationError
+from django.db.models import Q
 from django.template import loader
 from rest_framework.compat import template_render
+from rest_framework.exceptions import NotFound
 from rest_framework.pagination import PageNumberPagination, _positive_int, BasePagination
 from rest_framework.request import Request
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from collections import OrderedDict
 
 
@@ -14,15 +19,32 @@ class StandardResultsSetPagination(PageNumberPagination):
     max_page_size = 250
 
 
-class DateTimePaginator(BasePagination):
+class CursorPaginator(BasePagination):
+    """
+    Keyset paginator over (ordering field, id) pairs in descending order.
+
+    Returns opaque cursors for the next and the previous pages, so deep pages
+    cost the same as the first one. Views can override `cursor_ordering` field,
+    `cursor_field` for ordering by not model field attribute,
+    `get_cursor_chunk` to page over other sources than queryset,
+    `filter_cursor_chunk` to drop items from pages, `extend_cursor_page`
+    to merge other items into pages keeping their state in cursors and
+    `get_cursor_page_size` to leave room for merged items.
+    """
     page_size = 50
     page_size_query_param = 'page_size'
     max_page_size = 100
 
-    page_parameter = 'date'
+    cursor_query_param = 'cursor'
+    ordering = 'created_at'
+
+    # Max count of chunks pulled for filling page with filtered items
+    max_chunks = 10
 
     template = 'rest_framework/pagination/numbers.html'
 
+    invalid_cursor_message = 'Invalid cursor'
+
     def get_page_size(self, request):
         if self.page_size_query_param:
             try:
@@ -34,19 +56,118 @@ class DateTimePaginator(BasePagination):
 
         return self.page_size
 
-    def get_page_parameter(self, request: Request):
-        return request.query_params.get(self.page_parameter, datetime.now())
-
-    def paginate_queryset(self, queryset, request, view=None):  # pragma: no cover
-        page_size = self.get_page_size(request)
-        date = self.get_page_parameter(request)
-
-        qs = queryset.filter(created_at__lt=date)
-
-        return qs[:page_size]
+    def encode_cursor(self, position: tuple, reverse: bool, state: str = None):
+        value, pk = position
+        value = value.isoformat() if hasattr(value, 'isoformat') else str(value)
+        cursor = u'{}|{}|{}'.format(value, pk, int(reverse))
+        if state is not None:
+            cursor = u'{}|{}'.format(cursor, state)
+        cursor = urlsafe_b64encode(cursor.encode('utf-8')).decode('ascii')
+
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, cursor)
+
+    def decode_cursor(self, request: Request, field):
+        """Returns position and reverse flag from cursor query param, sets cursor_state"""
+        self.cursor_state = None
+
+        cursor = request.query_params.get(self.cursor_query_param)
+        if not cursor:
+            return None, False
+
+        try:
+            cursor = urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+            value, pk, reverse, *state = cursor.split('|', 3)
+            self.cursor_state = state[0] if state else None
+            return (field.to_python(value), int(pk)), bool(int(reverse))
+        except (TypeError, ValueError, UnicodeError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def get_position(self, item):
+        return getattr(item, self.ordering), item.pk
+
+    def get_chunk(self, queryset, position: tuple or None, size: int, reverse: bool) -> list:
+        """Returns items after position ordered in paging direction"""
+        if position is not None:
+            value, pk = position
+            if reverse:
+                queryset = queryset.filter(Q(**{self.ordering + '__gt': value}) |
+                                           Q(**{self.ordering: value, 'pk__gt': pk}))
+            else:
+                queryset = queryset.filter(Q(**{self.ordering + '__lt': value}) |
+                                           Q(**{self.ordering: value, 'pk__lt': pk}))
+
+        if reverse:
+            queryset = queryset.order_by(self.ordering, 'pk')
+        else:
+            queryset = queryset.order_by('-' + self.ordering, '-pk')
+
+        return list(queryset[:size])
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = getattr(view, 'cursor_ordering', self.ordering)
+
+        field = getattr(view, 'cursor_field', None) or queryset.model._meta.get_field(self.ordering)
+        size = self.get_page_size(request)
+        get_page_size = getattr(view, 'get_cursor_page_size', None)
+        if get_page_size is not None:
+            size = get_page_size(size)
+        position, reverse = self.decode_cursor(request, field)
+
+        get_chunk = getattr(view, 'get_cursor_chunk', None)
+        if get_chunk is None:
+            get_chunk = functools.partial(self.get_chunk, queryset)
+        filter_chunk = getattr(view, 'filter_cursor_chunk', None)
+
+        page = []
+        has_more = False
+        chunk_position = position
+        for it in range(self.max_chunks):
+            chunk = get_chunk(chunk_position, size + 1, reverse)
+            has_more = len(chunk) > size
+            chunk = chunk[:size]
+            if chunk:
+                chunk_position = self.get_position(chunk[-1])
+
+            page.extend(filter_chunk(chunk) if filter_chunk else chunk)
+            if len(page) >= size or not has_more:
+                break
+
+        if len(page) > size:
+            page = page[:size]
+            has_more = True
+
+        if reverse:
+            page.reverse()
+
+        self.next = None
+        self.previous = None
+        if page:
+            first, last = self.get_position(page[0]), self.get_position(page[-1])
+
+            first_state = last_state = self.cursor_state
+            extend_page = getattr(view, 'extend_cursor_page', None)
+            if extend_page is not None:
+                page, first_state, last_state = extend_page(page, self.cursor_state, reverse)
+
+            if has_more or reverse:
+                self.next = self.encode_cursor(last, False, last_state)
+            if has_more and reverse or position is not None and not reverse:
+                self.previous = self.encode_cursor(first, True, first_state)
+        elif position is not None:
+            # Empty page still allows to go back
+            if reverse:
+                self.next = self.encode_cursor(position, False, self.cursor_state)
+            else:
+                self.previous = self.encode_cursor(position, True, self.cursor_state)
+
+        return page
 
     def get_paginated_response(self, data):
         return Response(OrderedDict([
+            ('next', self.next),
+            ('previous', self.previous),
             ('results', data)
         ]))
 
@@ -57,3 +178,22 @@ class DateTimePaginator(BasePagination):
 
     def get_results(self, data):
         return data['results']
+
+
+class CountedCursorPaginator(CursorPaginator):
+    """
+    Cursor paginator which also returns total count of items like StandardResultsSetPagination,
+    for endpoints whose clients read count. Counting scans all items, so feeds do not use it.
+    Count is returned on the first page only, pages of cursors are not counted.
+    """
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None if request.query_params.get(self.cursor_query_param) else queryset.count()
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data['count'] = self.count
+            response.data.move_to_end('count', last=False)
+
+        return response
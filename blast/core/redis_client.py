@@ -0,0 +1,100 @@
+from contextlib import contextmanager
+from typing import Dict, Iterable, List
+
+import redis
+from django.conf import settings
+from redis.exceptions import ResponseError
+
+REDIS_DEFAULTS = {
+    'HOST': 'localhost',
+    'PORT': 6379,
+    'DB': 0,
+    'MAX_CONNECTIONS': 10,  # Per uWSGI or Celery worker process
+    'POOL_TIMEOUT': 20,  # Seconds to wait for free connection
+    'SOCKET_TIMEOUT': None,
+    'COMPACT_ZSETS': False,  # Packs small cached sets into bucketed hashes, see core.zset_store
+    'COMPACT_ZSET_EXPECTED_SETS': 8192 * 256,  # Expected count of sets of each key pattern
+    'COMPACT_ZSET_BUCKET_SIZE': 256,  # Sets per bucket hash, should not exceed hash-max-ziplist-entries
+    'COMPACT_ZSET_BUCKETS': None,  # Count of bucket hashes of each key pattern, derived from expected sets if None
+    'COMPACT_ZSET_MAX_MEMBERS': 64,  # Larger sets are stored as sorted sets
+}
+
+
+def get_config() -> dict:
+    config = dict(REDIS_DEFAULTS)
+    config.update(getattr(settings, 'REDIS', {}))
+
+    return config
+
+
+def create_pool() -> redis.ConnectionPool:
+    """Returns connection pool shared by all clients of process, pool is reset after fork"""
+    config = get_config()
+    return redis.BlockingConnectionPool(host=config['HOST'], port=config['PORT'], db=config['DB'],
+                                        max_connections=config['MAX_CONNECTIONS'],
+                                        timeout=config['POOL_TIMEOUT'],
+                                        socket_timeout=config['SOCKET_TIMEOUT'])
+
+
+pool = create_pool()
+r = redis.StrictRedis(connection_pool=pool)
+
+
+@contextmanager
+def pipeline(transaction: bool = False):
+    """
+    Collects commands and sends them in one round trip on exit.
+    Nothing is sent if block raises exception.
+    """
+    pipe = r.pipeline(transaction=transaction)
+    pipe.result_callbacks = []
+    try:
+        yield pipe
+        results = pipe.execute()
+        for index, callback in pipe.result_callbacks:
+            callback(results[index])
+    finally:
+        pipe.reset()
+
+
+def on_result(pipe, callback):
+    """Calls callback with result of last queued command when pipe of pipeline() is executed"""
+    pipe.result_callbacks.append((len(pipe.command_stack) - 1, callback))
+
+
+def exists_many(keys: Iterable[str]) -> List[str]:
+    """Returns "hot" keys from keys"""
+    keys = list(keys)
+
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.exists(key)
+
+    return [key for key, exists in zip(keys, pipe.execute()) if exists]
+
+
+def memory_usage_many(keys: Iterable[str]) -> List[int] or None:
+    """Returns bytes used by each of keys, None if server has no MEMORY USAGE command (Redis < 4.0)"""
+    keys = list(keys)
+    if not keys:
+        return []
+
+    pipe = r.pipeline(transaction=False)
+    for key in keys:
+        pipe.execute_command('MEMORY', 'USAGE', key)
+
+    try:
+        return [it or 0 for it in pipe.execute()]
+    except ResponseError:
+        return None
+
+
+def zscore_many(key: str, members: Iterable) -> Dict:
+    """Returns map of member to its score or None"""
+    members = list(members)
+
+    pipe = r.pipeline(transaction=False)
+    for it in members:
+        pipe.zscore(key, it)
+
+    return dict(zip(members, pipe.execute()))
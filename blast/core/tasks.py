@@ -0,0 +1,13 @@
+from celery import shared_task
+
+from core import cache_events, counters
+
+
+@shared_task(bind=False)
+def apply_cache_events():
+    cache_events.consume_events()
+
+
+@shared_task(bind=False)
+def flush_counters():
+    counters.flush()
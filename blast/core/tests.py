@@ -1,18 +1,29 @@
 import json
 import logging
+import time
 import uuid
 
 
-from io import BytesIO
+from io import BytesIO, StringIO
 
-import redis
 from PIL import Image
+from redis.exceptions import ResponseError
 from unittest import mock
+from celery.signals import task_postrun
 from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.core.signals import request_finished
 from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import transaction
 from django.test import TestCase, TransactionTestCase, override_settings
 from django.core.urlresolvers import reverse_lazy
 
+from core import cache_events, cache_stats, counters, local_cache
+from core.decorators import save_to_zset, heat_up_zsets, memoize_list
+from core.management.commands.warm_up_cache import WARM_UP_PROGRESS_KEY
+from core.models import CounterFlush
+from core.redis_client import r, pipeline, on_result, exists_many, memory_usage_many, zscore_many
+from core.zset_store import ZsetStore, CompactZsetStore, get_bucket_count
 from countries.models import Country
 from users.models import User
 
@@ -36,6 +47,13 @@ def create_file(name, content_file=True):
         return SimpleUploadedFile(name, file.read(), content_type='image/png')
 
 
+def run_on_commit(test_case: TestCase):
+    """Runs transaction.on_commit callbacks at once, test transaction is never committed"""
+    patcher = mock.patch('django.db.transaction.on_commit', lambda func: func())
+    patcher.start()
+    test_case.addCleanup(patcher.stop)
+
+
 @mock.patch('core.smsconfirmation.tasks.sinch_request_mok', sinch_request_mok)
 @override_settings(CELERY_ALWAYS_EAGER=True)
 class BaseTestCaseUnauth(TestCase):
@@ -65,8 +83,10 @@ class BaseTestCaseUnauth(TestCase):
         self.client.defaults.update(self.headers)
 
     def setUp(self):
-        self.r = redis.StrictRedis(host='localhost', port=6379, db=0)
+        self.r = r
         self.r.flushdb()
+        local_cache.clear_all()
+        run_on_commit(self)
 
         data = {
             'phone': self.phone,
@@ -123,4 +143,556 @@ class BaseTestCase(BaseTestCaseUnauth):
         self.headers = {
             'HTTP_AUTHORIZATION': 'Token {0}'.format(self.auth_token)
         }
-        self.client.defaults.update(self.headers)
\ No newline at end of file
+        self.client.defaults.update(self.headers)
+
+
+class RedisClientTest(TestCase):
+    def setUp(self):
+        r.flushdb()
+
+    def test_pipeline(self):
+        with pipeline() as pipe:
+            pipe.set('first', 1)
+            pipe.set('second', 2)
+            self.assertFalse(r.exists('first'))
+
+        self.assertEqual(exists_many(['first', 'second', 'third']), ['first', 'second'])
+
+    def test_pipeline_error(self):
+        with self.assertRaises(ValueError):
+            with pipeline() as pipe:
+                pipe.set('first', 1)
+                raise ValueError()
+
+        self.assertFalse(r.exists('first'))
+
+    def test_on_result(self):
+        results = []
+        with pipeline() as pipe:
+            pipe.set('first', 1, nx=True)
+            on_result(pipe, results.append)
+            pipe.set('first', 2, nx=True)
+            on_result(pipe, results.append)
+
+        self.assertEqual(results, [True, None])
+
+    def test_zscore_many(self):
+        r.zadd('zset', 1, 'first')
+        self.assertEqual(zscore_many('zset', ['first', 'second']), {'first': 1, 'second': None})
+
+
+class SaveToZsetTest(TestCase):
+    key_pattern = u'test:{}:zset'
+
+    def setUp(self):
+        r.flushdb()
+
+        self.calls = 0
+
+        @save_to_zset(self.key_pattern, ttl=60)
+        def get_items(pk, start, end):
+            self.calls += 1
+            return [1, 10, 2, 20, 3, 30]
+
+        self.get_items = get_items
+
+    def test_heat_up(self):
+        self.assertEqual(self.get_items(1, 0, -1), [30, 20, 10])
+        self.assertEqual(self.get_items(1, 0, 0), [30])
+        self.assertEqual(self.calls, 1)
+
+        key = self.key_pattern.format(1)
+        self.assertTrue(0 < r.ttl(key) <= 60)
+        self.assertEqual(r.keys(key + ':*'), [])
+
+    @mock.patch('core.decorators.HEAT_UP_WAIT_TIMEOUT', 0.1)
+    def test_locked_heat_up(self):
+        key = self.key_pattern.format(1)
+        lock = r.lock(key + ':lock', timeout=10)
+        lock.acquire()
+
+        # Result is built without caching while other process holds lock
+        self.assertEqual(self.get_items(1, 1, -1), [20, 10])
+        self.assertFalse(r.exists(key))
+
+        lock.release()
+        self.get_items(1, 0, -1)
+        self.assertTrue(r.exists(key))
+
+    def test_heat_up_many(self):
+        r.zadd(self.key_pattern.format(1), 1, 1)
+
+        heated = heat_up_zsets(self.get_items.store, [1, 2, 3], lambda pks: {pk: [pk, pk] for pk in pks if pk != 3})
+        self.assertEqual(heated, [2])
+        self.assertEqual(r.zrange(self.key_pattern.format(2), 0, -1), [b'2'])
+        self.assertFalse(r.exists(self.key_pattern.format(3)))
+
+    def test_locked_heat_up_many(self):
+        lock = r.lock(self.key_pattern.format(2) + ':lock', timeout=10)
+        lock.acquire()
+
+        # Set locked by other process is left to it
+        heated = heat_up_zsets(self.get_items.store, [1, 2], lambda pks: {pk: [pk, pk] for pk in pks})
+        self.assertEqual(heated, [1])
+        self.assertFalse(r.exists(self.key_pattern.format(2)))
+        lock.release()  # Lock of other process is kept
+
+
+class CompactZsetStoreTest(TestCase):
+    key_pattern = u'test:{}:compact'
+
+    def setUp(self):
+        r.flushdb()
+
+        self.store = CompactZsetStore(self.key_pattern, max_members=4)
+        self.plain = ZsetStore(u'test:{}:plain')
+
+    def write(self, store, pk, result):
+        with pipeline() as pipe:
+            store.write(pipe, pk, result)
+
+    def test_packed(self):
+        result = [2, 9, 2, 12, 5, 1]
+        self.write(self.store, 1, result)
+        self.write(self.plain, 1, result)
+
+        # Packed in bucket hash in ZREVRANGE order
+        self.assertFalse(r.exists(self.store.key(1)))
+        self.assertEqual(self.store.range(1, 0, -1), self.plain.range(1, 0, -1))
+        self.assertEqual(self.store.range(1, 1, 1), [9])
+        self.assertEqual(self.store.exists_many([1, 2]), {1})
+        self.assertEqual(self.store.card(1), 3)
+        self.assertEqual(self.store.score(1, 12), 2)
+
+    def test_int32_bounds(self):
+        with self.assertRaises(AssertionError):
+            self.write(self.store, 1, [2 ** 31, 1])
+        with self.assertRaises(AssertionError):
+            self.store.add(1, 1, 2 ** 32)
+
+    def test_bucket_count(self):
+        self.assertEqual(self.store.buckets, 8192)
+        self.assertEqual(get_bucket_count(10 ** 7), 39063)
+        self.assertEqual(get_bucket_count(10), 1)
+
+        with override_settings(REDIS={'COMPACT_ZSET_EXPECTED_SETS': 1000, 'COMPACT_ZSET_BUCKET_SIZE': 100}):
+            self.assertEqual(CompactZsetStore(self.key_pattern).buckets, 10)
+
+    def test_add_remove(self):
+        self.write(self.store, 1, [1, 1])
+
+        self.store.add(1, 3, 2)
+        self.store.add(1, 5, 1, xx=True)
+        self.store.add(1, 5, 3, xx=True)  # Not member
+        self.store.add(2, 1, 1)  # "Cold" set
+        self.assertEqual(self.store.range(1, 0, -1), [1, 2])
+        self.assertEqual(self.store.score(1, 1), 5)
+        self.assertEqual(self.store.exists_many([2]), set())
+
+        self.store.remove(1, 1)
+        self.assertEqual(self.store.range(1, 0, -1), [2])
+
+        # Empty set is "cold"
+        self.store.remove(1, 2)
+        self.assertFalse(self.store.exists(1))
+
+    def test_overflow(self):
+        self.write(self.store, 1, [1, 1, 2, 2, 3, 3, 4, 4])
+        with pipeline() as pipe:
+            self.store.add(1, 5, 5, client=pipe)
+
+        # Large set is moved to sorted set
+        self.assertEqual(r.zrevrange(self.store.key(1), 0, -1), [b'5', b'4', b'3', b'2', b'1'])
+        self.assertEqual(self.store.range(1, 0, 1), [5, 4])
+        self.assertEqual(self.store.card(1), 5)
+
+        self.write(self.store, 2, list(range(10)))
+        self.assertTrue(r.exists(self.store.key(2)))
+
+    def test_not_scored(self):
+        store = CompactZsetStore(self.key_pattern, scored=False)
+        self.write(store, 1, [3, 3, 7, 7])
+        store.add(1, 5, 5)
+
+        self.assertEqual(store.range(1, 0, -1), [7, 5, 3])
+        self.assertEqual(store.memory_usage([1]), 12)
+
+    @override_settings(REDIS={'COMPACT_ZSETS': True})
+    def test_save_to_zset(self):
+        @save_to_zset(self.key_pattern, compact=True)
+        def get_items(pk, start, end):
+            return [1, 10, 2, 20]
+
+        self.assertIsInstance(get_items.store, CompactZsetStore)
+        self.assertEqual(get_items(1, 0, -1), [20, 10])
+        self.assertEqual(get_items(1, 0, -1), [20, 10])
+        self.assertFalse(r.exists(self.key_pattern.format(1)))
+
+
+class MemoizeListTest(TestCase):
+    key_pattern = u'test:{}:list'
+
+    def setUp(self):
+        r.flushdb()
+
+        @memoize_list(self.key_pattern, max_length=3, ttl=60)
+        def get_items(pk, start, end):
+            return [pk * 10 + it for it in range(5)]
+
+        self.get_items = get_items
+
+    def test_bounded(self):
+        key = self.key_pattern.format(1)
+
+        self.assertEqual(self.get_items(1, 0, -1), [10, 11, 12])
+        self.assertEqual(r.llen(key), 3)
+        self.assertTrue(0 < r.ttl(key) <= 60)
+
+        self.get_items.push(1, 9)
+        self.assertEqual(self.get_items(1, 0, -1), [9, 10, 11])
+
+        # Cold list is not created by push
+        self.get_items.push(2, 9)
+        self.assertFalse(r.exists(self.key_pattern.format(2)))
+
+    def test_get_many(self):
+        self.get_items(1, 0, -1)
+
+        result = self.get_items.get_many([1, 2], 0, 1)
+        self.assertEqual(result, {1: [10, 11], 2: [20, 21]})
+
+
+class CacheEventsTest(TestCase):
+    def setUp(self):
+        r.flushdb()
+        run_on_commit(self)
+
+        self.applied = []
+        handlers = {'test': self.applied.append, 'broken': mock.Mock(side_effect=ValueError)}
+        patcher = mock.patch.dict(cache_events._handlers, handlers, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    def test_emit(self, delay):
+        cache_events.emit('test', pk=1)
+        cache_events.emit('test', pk=2)
+
+        # Consumer is scheduled once for queued events
+        self.assertEqual(delay.call_count, 1)
+        self.assertEqual(r.llen(cache_events.CACHE_EVENTS_KEY), 2)
+
+        self.assertEqual(cache_events.consume_events(batch_size=1), 2)
+        self.assertEqual(self.applied, [[{'pk': 1}], [{'pk': 2}]])
+        self.assertFalse(r.exists(cache_events.CACHE_EVENTS_KEY))
+        self.assertFalse(r.exists(cache_events.CACHE_EVENTS_SCHEDULED_KEY))
+
+    def test_apply_events(self):
+        events = [['broken', {'pk': 1}], ['test', {'pk': 1}], ['test', {'pk': 1}], ['unknown', {}]]
+
+        # Failed handler does not stop others, duplicated payloads are applied once
+        self.assertEqual(cache_events.apply_events(events), {'test': 1})
+        self.assertEqual(self.applied, [[{'pk': 1}]])
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    def test_retry_failed(self, delay):
+        cache_events.emit('broken', pk=1)
+        cache_events.emit('test', pk=1)
+
+        # Failed events are kept for next consumers until attempts are exhausted
+        for it in range(cache_events.CACHE_EVENTS_MAX_RETRIES - 1):
+            cache_events.consume_events()
+            self.assertEqual(r.llen(cache_events.CACHE_EVENTS_RETRY_KEY), 1)
+
+        cache_events.consume_events()
+        self.assertFalse(r.exists(cache_events.CACHE_EVENTS_RETRY_KEY))
+        self.assertEqual(self.applied, [[{'pk': 1}]])
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    def test_interrupted(self, delay):
+        cache_events.emit('test', pk=1)
+        cache_events.emit('test', pk=2)
+        cache_events.move_events(cache_events.CACHE_EVENTS_KEY, cache_events.CACHE_EVENTS_PROCESSING_KEY, 1)
+
+        # Batch of crashed consumer is applied first
+        self.assertEqual(cache_events.consume_events(), 2)
+        self.assertEqual(self.applied, [[{'pk': 1}], [{'pk': 2}]])
+        self.assertFalse(r.exists(cache_events.CACHE_EVENTS_PROCESSING_KEY))
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    def test_locked(self, delay):
+        cache_events.emit('test', pk=1)
+
+        with r.lock(cache_events.CACHE_EVENTS_LOCK_KEY):
+            self.assertEqual(cache_events.consume_events(), 0)
+
+        self.assertEqual(cache_events.consume_events(), 1)
+
+
+class CacheEventsCommitTest(TransactionTestCase):
+    def setUp(self):
+        r.flushdb()
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    def test_emit_on_commit(self, delay):
+        with transaction.atomic():
+            cache_events.emit('test', pk=1)
+            self.assertFalse(r.exists(cache_events.CACHE_EVENTS_KEY))
+
+        self.assertEqual(r.llen(cache_events.CACHE_EVENTS_KEY), 1)
+
+        # Events of rolled back transaction are not queued
+        with self.assertRaises(ValueError), transaction.atomic():
+            cache_events.emit('test', pk=2)
+            raise ValueError
+
+        self.assertEqual(r.llen(cache_events.CACHE_EVENTS_KEY), 1)
+
+
+class WarmUpCacheTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        from posts.models import Post
+        from users.models import Follower
+
+        self.other = self.generate_user('other')
+        Follower.objects.create(follower=self.user, followee=self.other)
+        self.post = Post.objects.create(user=self.other, text='#warm')
+        self.r.flushdb()
+
+    def call_command(self, *args, **kwargs):
+        out = StringIO()
+        call_command('warm_up_cache', *args, processes=1, stdout=out, **kwargs)
+        return out.getvalue()
+
+    def test_warm_up(self):
+        self.call_command()
+
+        from tags.models import Tag
+
+        self.assertEqual(User.get_posts.store.range(self.other.pk, 0, -1), [self.post.pk])
+        self.assertIsNotNone(User.get_followers.store.score(self.other.pk, self.user.pk))
+        self.assertIsNotNone(User.get_followees.store.score(self.user.pk, self.other.pk))
+        self.assertEqual(Tag.get_posts.store.card('warm'), 1)
+        self.assertEqual(self.r.scard(User.USERS_SET_KEY), User.objects.count())
+        self.assertEqual(self.r.zcard(User.USERS_ZSET_KEY), User.objects.count())
+        self.assertFalse(self.r.exists(WARM_UP_PROGRESS_KEY))
+
+    def test_resume(self):
+        self.r.hset(WARM_UP_PROGRESS_KEY, 'followers', self.user.pk)
+        self.call_command('followers', chunk_size=1)
+
+        # Users up to saved progress are skipped
+        self.assertFalse(User.get_followers.store.exists(self.anonymous.pk))
+        self.assertTrue(User.get_followers.store.exists(self.other.pk))
+
+    def test_dry_run(self):
+        User.get_posts(self.other.pk, 0, -1)
+
+        out = self.call_command('posts', 'users', dry_run=True)
+        self.assertIn('posts: 3 keys, 1 hot, 2 cold', out)
+        self.assertIn('users: 2 keys, 0 hot, 3 rows', out)
+        self.assertEqual(self.r.dbsize(), 2)  # Posts set and its expiration index
+
+    @mock.patch('redis.client.BasePipeline.execute', side_effect=ResponseError('unknown command'))
+    def test_memory_unavailable(self, execute):
+        self.assertIsNone(memory_usage_many([User.USERS_SET_KEY]))
+        self.assertIsNone(User.get_posts.store.memory_usage([self.user.pk]))
+
+    @mock.patch('core.zset_store.memory_usage_many', return_value=None)
+    @mock.patch('core.management.commands.warm_up_cache.memory_usage_many', return_value=None)
+    def test_dry_run_memory_unavailable(self, *mocks):
+        User.get_posts(self.other.pk, 0, -1)
+
+        out = self.call_command('posts', 'users', dry_run=True)
+        self.assertIn('posts: 3 keys, 1 hot, 2 cold, unknown bytes, ~unknown bytes to build', out)
+        self.assertIn('users: 2 keys, 0 hot, 3 rows, unknown bytes', out)
+
+
+class CacheStatsTest(BaseTestCase):
+    key_pattern = u'test:{}:stats'
+
+    def setUp(self):
+        super().setUp()
+        cache_stats.flush()
+        self.r.flushdb()
+
+        @save_to_zset(self.key_pattern)
+        def get_items(pk, start, end):
+            return [1, 1, 2, 2]
+
+        self.get_items = get_items
+
+    def test_counters(self):
+        self.get_items(1, 0, -1)
+        self.get_items(1, 0, -1)
+        self.get_items(2, 0, -1)
+
+        stats = cache_stats.get_stats([self.key_pattern])[self.key_pattern]
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['heat_ups'], 2)
+        self.assertEqual(stats['size'], 4)
+        self.assertEqual(stats['size_le_10'], 2)
+        self.assertEqual(stats['hit_ratio'], round(1 / 3, 4))
+
+    def test_flush_on_request_finished(self):
+        self.get_items(1, 0, -1)
+        self.assertFalse(self.r.exists(cache_stats.CACHE_STATS_KEY.format(self.key_pattern)))
+
+        request_finished.send(sender=self.__class__)
+        self.assertEqual(self.r.hget(cache_stats.CACHE_STATS_KEY.format(self.key_pattern), 'misses'), b'1')
+
+    def test_flush_on_task_postrun(self):
+        self.get_items(1, 0, -1)
+
+        task_postrun.send(sender=self.__class__)
+        self.assertEqual(self.r.hget(cache_stats.CACHE_STATS_KEY.format(self.key_pattern), 'misses'), b'1')
+
+    def test_memory(self):
+        self.get_items(1, 0, -1)
+
+        self.assertEqual(cache_stats.match_pattern(self.key_pattern.format(1)), self.key_pattern)
+        self.assertGreater(cache_stats.get_memory_usage()[self.key_pattern], 0)
+
+    @mock.patch('core.cache_stats.memory_usage_many', return_value=None)
+    def test_memory_unavailable(self, memory_usage_many):
+        self.get_items(1, 0, -1)
+
+        stats = cache_stats.get_stats([self.key_pattern])[self.key_pattern]
+        self.assertIsNone(stats['memory'])
+
+    def test_view(self):
+        url = reverse_lazy('cache-stats')
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 403)
+
+        User.objects.filter(pk=self.user.pk).update(is_admin=True)
+        self.get_items(1, 0, -1)
+
+        response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data[self.key_pattern]['misses'], 1)
+
+
+class LocalCacheTest(TestCase):
+    def setUp(self):
+        r.flushdb()
+
+        self.calls = []
+
+        @local_cache.local_cache('test', ttl=60, max_size=2)
+        def get_item(pk):
+            self.calls.append(pk)
+            return pk * 10
+
+        self.get_item = get_item
+
+    def test_lru(self):
+        self.assertEqual([self.get_item(it) for it in (1, 2, 1, 3, 1, 2)], [10, 20, 10, 30, 10, 20])
+
+        # 2 is evicted by 3 as least recently used
+        self.assertEqual(self.calls, [1, 2, 3, 2])
+
+    def test_ttl(self):
+        self.get_item(1)
+        with mock.patch('core.local_cache.time.time', return_value=time.time() + 61):
+            self.get_item(1)
+
+        self.assertEqual(self.calls, [1, 1])
+
+    @mock.patch('core.local_cache.LOCAL_CACHE_VERSION_CHECK_INTERVAL', 0)
+    def test_invalidate(self):
+        self.get_item(1)
+
+        # Version is bumped by other process
+        r.incr(local_cache.LOCAL_CACHE_VERSION_KEY.format('test'))
+        self.get_item(1)
+        self.get_item(1)
+
+        self.assertEqual(self.calls, [1, 1])
+
+    def test_countries(self):
+        from countries.models import get_countries
+
+        Country.objects.create(name='Russia', code='+7')
+        self.assertEqual([it.name for it in get_countries()], ['Russia'])
+
+        Country.objects.create(name='Belarus', code='+375')
+        self.assertEqual([it.name for it in get_countries()], ['Belarus', 'Russia'])
+
+    def test_anonymous_user(self):
+        country = Country.objects.create(name='Russia', code='+7')
+        User.objects.create(pk=User.objects.anonymous_id, username='Anonymous', phone='+', country=country)
+
+        anonymous = User.objects.anonymous
+        anonymous.username = 'changed'
+
+        # Instance is not shared, fields are read from process memory
+        with self.assertNumQueries(0):
+            self.assertEqual(User.objects.anonymous.username, 'Anonymous')
+        self.assertIsNot(User.objects.anonymous, anonymous)
+        self.assertEqual(User.objects.anonymous.country_id, country.pk)
+
+
+@mock.patch('core.tasks.flush_counters.apply_async')
+class CountersTest(BaseTestCase):
+    def test_write_behind(self, apply_async):
+        from tags.models import Tag
+
+        other = self.generate_user()
+        Tag.objects.create(title='tag')
+        counters.flush()  # Follower of anonymous user
+
+        counters.incr(User, 'popularity', [self.user.pk, other.pk])
+        counters.incr(User, 'popularity', [self.user.pk], 2)
+        counters.incr(Tag, 'total_posts', ['tag'])
+        self.assertEqual(apply_async.call_count, 2)
+
+        # Database is updated by flush only
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, 0)
+        self.assertEqual(counters.get_pending(User, 'popularity', [self.user.pk, other.pk]),
+                         {self.user.pk: 3, other.pk: 1})
+        self.assertEqual(counters.get_values(User, 'popularity', {self.user.pk: 10}), {self.user.pk: 13})
+
+        self.assertEqual(counters.flush(), 3)
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, 3)
+        self.assertEqual(User.objects.get(pk=other.pk).popularity, 1)
+        self.assertEqual(Tag.objects.get(pk='tag').total_posts, 1)
+        self.assertEqual(counters.get_pending(User, 'popularity', [self.user.pk]), {self.user.pk: 0})
+
+    def test_interrupted_flush(self, apply_async):
+        counters.incr(User, 'popularity', [self.user.pk])
+        self.r.rename(counters.get_key(User, 'popularity'), counters.get_flushing_key(User, 'popularity'))
+        counters.incr(User, 'popularity', [self.user.pk])
+
+        # Deltas of both flushes are pending
+        self.assertEqual(counters.get_pending(User, 'popularity', [self.user.pk]), {self.user.pk: 2})
+
+        counters.flush()
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, 1)
+
+        counters.flush()
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, 2)
+
+    def test_applied_flush(self, apply_async):
+        counters.incr(User, 'popularity', [self.user.pk])
+        counters.flush_counter(User, 'popularity')
+
+        # Flush crashed after commit, its hash is left
+        flush_id = CounterFlush.objects.latest('pk').flush_id
+        self.r.hmset(counters.get_flushing_key(User, 'popularity'),
+                     {self.user.pk: 1, counters.FLUSH_ID_FIELD: flush_id})
+
+        self.assertEqual(counters.flush_counter(User, 'popularity'), 0)
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, 1)
+        self.assertFalse(self.r.exists(counters.get_flushing_key(User, 'popularity')))
+
+    def test_locked_flush(self, apply_async):
+        counters.incr(User, 'popularity', [self.user.pk])
+
+        with self.r.lock(counters.get_lock_key(User, 'popularity')):
+            self.assertEqual(counters.flush_counter(User, 'popularity'), 0)
+
+        self.assertEqual(counters.flush_counter(User, 'popularity'), 1)
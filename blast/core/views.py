@@ -1,5 +1,38 @@
+import hashlib
+import json
+import logging
+
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.http import parse_etags
 from django.shortcuts import render
-from rest_framework import viewsets
+from rest_framework import viewsets, status, views, permissions
+from rest_framework.response import Response
+from rest_framework.utils.encoders import JSONEncoder
+
+from core import cache_stats
+from core.redis_client import r
+
+logger = logging.getLogger(__name__)
+
+PUBLIC_RESPONSE_KEY = u'public:response:{}:{}'
+PUBLIC_RESPONSE_VERSION_KEY = u'public:response:version'
+
+# Max time to live of cached public response in seconds.
+PUBLIC_RESPONSE_TTL = 30
+
+
+def invalidate_public_responses(client=r):
+    """Makes all cached public responses stale"""
+    client.incr(PUBLIC_RESPONSE_VERSION_KEY)
+
+
+def etag_matches(etag: str, if_none_match: str) -> bool:
+    """Checks quoted etag against list of etags of If-None-Match header"""
+    if not if_none_match:
+        return False
+
+    return if_none_match.strip() == '*' or etag.strip('"') in parse_etags(if_none_match)
 
 
 class ExtendableModelMixin(object):
@@ -22,3 +55,71 @@ class ExtendableModelMixin(object):
         self.extend_response_data([response.data])
 
         return response
+
+
+class PublicResponseCacheMixin(object):
+    """
+    Caches list responses of unauthenticated requests shared by all anonymous callers.
+    Cached responses are stale after PUBLIC_RESPONSE_TTL, expiration of any listed post
+    or invalidate_public_responses call. Counts of votes are refreshed by TTL only.
+    Supports conditional requests by ETag.
+    """
+    public_response_ttl = PUBLIC_RESPONSE_TTL
+
+    def get_public_response_key(self, request) -> str:
+        version = r.get(PUBLIC_RESPONSE_VERSION_KEY) or b'0'
+        uri = request.build_absolute_uri()
+        return PUBLIC_RESPONSE_KEY.format(int(version), hashlib.md5(uri.encode('utf-8')).hexdigest())
+
+    def get_public_response_ttl(self, data) -> int:
+        """Returns time to live of response limited by the nearest post expiration"""
+        ttl = self.public_response_ttl
+
+        results = data.get('results', []) if isinstance(data, dict) else []
+        for it in results:
+            expired_at = it.get('expired_at') if isinstance(it, dict) else None
+            expired_at = parse_datetime(expired_at) if expired_at else None
+            if expired_at:
+                ttl = min(ttl, int((expired_at - timezone.now()).total_seconds()))
+
+        return ttl
+
+    def list(self, request, *args, **kwargs):
+        if request.user.is_authenticated():
+            return super().list(request, *args, **kwargs)
+
+        key = self.get_public_response_key(request)
+        etag, content = r.hmget(key, 'etag', 'content')
+        if etag:
+            etag = etag.decode('utf-8')
+            if etag_matches(etag, request.META.get('HTTP_IF_NONE_MATCH', '')):
+                return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
+            return Response(json.loads(content.decode('utf-8')), headers={'ETag': etag})
+
+        response = super().list(request, *args, **kwargs)
+        if response.status_code != status.HTTP_200_OK:
+            return response
+
+        content = json.dumps(response.data, cls=JSONEncoder)
+        etag = '"{}"'.format(hashlib.md5(content.encode('utf-8')).hexdigest())
+        response['ETag'] = etag
+
+        ttl = self.get_public_response_ttl(response.data)
+        if ttl > 0:
+            pipe = r.pipeline()
+            pipe.hmset(key, {'etag': etag, 'content': content})
+            pipe.expire(key, ttl)
+            pipe.execute()
+
+        return response
+
+
+class CacheStatsView(views.APIView):
+    """
+    Returns hits, misses, heat up histograms and estimated memory usage of memoized redis caches.
+    """
+    permission_classes = (permissions.IsAdminUser,)
+
+    def get(self, request):
+        return Response(cache_stats.get_stats())
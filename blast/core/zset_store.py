@@ -0,0 +1,392 @@
+"""
+Storages of cached sorted sets of int members, one set per pk.
+
+ZsetStore keeps redis sorted set per pk. CompactZsetStore packs small sets
+into fields of bucketed hashes, so per-key overhead of redis is paid once per bucket.
+Sets outgrowing COMPACT_ZSET_MAX_MEMBERS setting are moved to sorted sets.
+Bucket hashes are compact while they fit ziplist encoding, so redis should be
+configured with hash-max-ziplist-entries >= COMPACT_ZSET_BUCKET_SIZE (256) and
+hash-max-ziplist-value >= 512. Count of buckets is derived from COMPACT_ZSET_EXPECTED_SETS,
+buckets of more sets than expected still work with larger hashtable encoding.
+Changed count of buckets moves sets to other buckets, so compact keys should be deleted then.
+"""
+import math
+import struct
+import uuid
+import zlib
+from typing import Dict, Iterable, List, Set
+
+from core.redis_client import r, get_config, memory_usage_many, REDIS_DEFAULTS
+
+# Loads packed set of score and member pairs, or members scored by itself
+_LUA_UNPACK = '''
+local scored = ARGV[1] == '1'
+local size = scored and 8 or 4
+local function unpack_items(packed)
+    local items = {}
+    for i = 1, #packed, size do
+        if scored then
+            local score, member = struct.unpack('>i4I4', packed, i)
+            table.insert(items, {score, member})
+        else
+            local member = struct.unpack('>I4', packed, i)
+            table.insert(items, {member, member})
+        end
+    end
+    return items
+end
+
+local function pack_items(items)
+    table.sort(items, function(a, b)
+        if a[1] ~= b[1] then
+            return a[1] > b[1]
+        end
+        return tostring(a[2]) > tostring(b[2])
+    end)
+
+    local parts = {}
+    for i, it in ipairs(items) do
+        parts[i] = scored and struct.pack('>i4I4', it[1], it[2]) or struct.pack('>I4', it[2])
+    end
+    return table.concat(parts)
+end
+'''
+
+# KEYS: bucket hash, sorted set. ARGV: scored, field, score, member, xx, max members
+_LUA_ADD = _LUA_UNPACK + '''
+local score, member = tonumber(ARGV[3]), tonumber(ARGV[4])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    if ARGV[5] == '1' then
+        return redis.call('ZADD', KEYS[2], 'XX', score, member)
+    end
+    return redis.call('ZADD', KEYS[2], score, member)
+end
+
+local packed = redis.call('HGET', KEYS[1], ARGV[2])
+if not packed then
+    return 0  -- Set is "cold"
+end
+
+local items, found = {}, false
+for _, it in ipairs(unpack_items(packed)) do
+    if it[2] == member then
+        found = true
+    else
+        table.insert(items, it)
+    end
+end
+
+if ARGV[5] == '1' and not found then
+    return 0
+end
+table.insert(items, {score, member})
+
+if #items > tonumber(ARGV[6]) then
+    local args = {}
+    for _, it in ipairs(items) do
+        table.insert(args, it[1])
+        table.insert(args, it[2])
+    end
+    redis.call('ZADD', KEYS[2], unpack(args))
+    redis.call('HDEL', KEYS[1], ARGV[2])
+else
+    redis.call('HSET', KEYS[1], ARGV[2], pack_items(items))
+end
+return found and 0 or 1
+'''
+
+# KEYS: bucket hash, sorted set. ARGV: scored, field, member
+_LUA_REMOVE = _LUA_UNPACK + '''
+local member = tonumber(ARGV[3])
+if redis.call('EXISTS', KEYS[2]) == 1 then
+    return redis.call('ZREM', KEYS[2], member)
+end
+
+local packed = redis.call('HGET', KEYS[1], ARGV[2])
+if not packed then
+    return 0
+end
+
+local items = {}
+for _, it in ipairs(unpack_items(packed)) do
+    if it[2] ~= member then
+        table.insert(items, it)
+    end
+end
+
+if #items == 0 then
+    redis.call('HDEL', KEYS[1], ARGV[2])  -- Empty sets are not cached
+else
+    redis.call('HSET', KEYS[1], ARGV[2], pack_items(items))
+end
+return 1
+'''
+
+
+# KEYS: sorted set. ARGV: score, member
+_LUA_ZADD_HOT = '''
+if redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0  -- Set is "cold"
+end
+return redis.call('ZADD', KEYS[1], ARGV[1], ARGV[2])
+'''
+
+
+def write_zset(pipe, key: str, result: list, ttl: int = None):
+    """Writes result into temp key and renames it to key, so readers never see partial set"""
+    temp_key = u'{}:tmp:{}'.format(key, uuid.uuid4().hex)
+    pipe.zadd(temp_key, *result)
+    if ttl:
+        pipe.expire(temp_key, ttl)
+    pipe.rename(temp_key, key)
+
+
+def get_pairs(result: list) -> list:
+    """Returns score and member pairs of flat result in ZREVRANGE order"""
+    pairs = zip(result[::2], result[1::2])
+    return sorted(pairs, key=lambda it: (it[0], str(it[1])), reverse=True)
+
+
+class ZsetStore(object):
+    """Sorted set per pk"""
+    _add_hot_script = r.register_script(_LUA_ZADD_HOT)
+
+    def __init__(self, key_pattern: str, ttl: int = None):
+        self.key_pattern = key_pattern
+        self.ttl = ttl
+
+    def key(self, pk) -> str:
+        return self.key_pattern.format(pk)
+
+    def exists(self, pk) -> bool:
+        return bool(self.exists_many([pk]))
+
+    def exists_many(self, pks: Iterable) -> Set:
+        """Returns "hot" pks"""
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.exists(self.key(pk))
+
+        return {pk for pk, exists in zip(pks, pipe.execute()) if exists}
+
+    def range(self, pk, start: int, end: int) -> List[int]:
+        """Returns members from highest to lowest score like ZREVRANGE"""
+        return [int(it) for it in r.zrevrange(self.key(pk), start, end)]
+
+    def range_many(self, pks: Iterable) -> Dict:
+        """Returns map of pk to all members of set in one round trip, "cold" sets are empty"""
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.zrevrange(self.key(pk), 0, -1)
+
+        return {pk: [int(it) for it in members] for pk, members in zip(pks, pipe.execute())}
+
+    def load_many(self, pks: list) -> Dict:
+        """Returns map of pk to score and member pairs in ZREVRANGE order, None for "cold" sets"""
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.zrevrange(self.key(pk), 0, -1, withscores=True)
+
+        return {pk: [(score, int(member)) for member, score in pairs] or None
+                for pk, pairs in zip(pks, pipe.execute())}
+
+    def card(self, pk) -> int:
+        return self.card_many([pk])[pk]
+
+    def card_many(self, pks: Iterable) -> Dict:
+        """Returns map of pk to count of members in one round trip"""
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.zcard(self.key(pk))
+
+        return dict(zip(pks, pipe.execute()))
+
+    def score(self, pk, member: int) -> float or None:
+        return r.zscore(self.key(pk), member)
+
+    def write(self, pipe, pk, result: list):
+        """Replaces set by flat list of score and member pairs"""
+        write_zset(pipe, self.key(pk), result, self.ttl)
+
+    def add(self, pk, score, member: int, xx: bool = False, client=r):
+        """
+        Adds member to "hot" set or updates its score, "cold" sets are built by heat up.
+        :param xx: updates existing members only
+        """
+        if xx:
+            client.execute_command('ZADD', self.key(pk), 'XX', score, member)
+        else:
+            self._add_hot_script(keys=[self.key(pk)], args=[score, member], client=client)
+
+    def remove(self, pk, member: int, client=r):
+        client.zrem(self.key(pk), member)
+
+    def delete(self, pk, client=r):
+        client.delete(self.key(pk))
+
+    def memory_usage(self, pks: Iterable) -> int or None:
+        """Returns bytes used by sets of pks, None if it is unavailable"""
+        sizes = memory_usage_many(self.key(pk) for pk in pks)
+        return None if sizes is None else sum(sizes)
+
+
+INT32_MIN, INT32_MAX = -2 ** 31, 2 ** 31 - 1
+UINT32_MAX = 2 ** 32 - 1
+
+
+def get_bucket_count(expected_sets: int, bucket_size: int = REDIS_DEFAULTS['COMPACT_ZSET_BUCKET_SIZE']) -> int:
+    """Returns count of bucket hashes, so each bucket keeps about bucket_size sets"""
+    return max(1, math.ceil(expected_sets / bucket_size))
+
+
+class CompactZsetStore(ZsetStore):
+    """
+    Small sets packed into fields of bucketed hashes. Members are unsigned 32 bit ints,
+    scores are signed 32 bit ints or are equal to members if set is not scored.
+    Count of buckets and max members are read from REDIS setting if they are not given.
+    """
+    _add_script = r.register_script(_LUA_ADD)
+    _remove_script = r.register_script(_LUA_REMOVE)
+
+    def __init__(self, key_pattern: str, ttl: int = None, scored: bool = True, buckets: int = None,
+                 max_members: int = None):
+        assert ttl is None, 'Fields of hashes can not expire'
+        super().__init__(key_pattern, ttl)
+        config = get_config()
+        self.scored = scored
+        self.buckets = buckets or get_bucket_count(config['COMPACT_ZSET_EXPECTED_SETS'],
+                                                   config['COMPACT_ZSET_BUCKET_SIZE'])
+        self.max_members = max_members or config['COMPACT_ZSET_MAX_MEMBERS']
+        self.format = '>iI' if scored else '>I'
+
+    def bucket_key(self, pk) -> str:
+        bucket = zlib.crc32(str(pk).encode('utf-8')) % self.buckets
+        return self.key_pattern.format(u'~{}'.format(bucket))
+
+    def check_item(self, score, member):
+        assert not self.scored or INT32_MIN <= int(score) <= INT32_MAX, 'Score {} is out of int32'.format(score)
+        assert 0 <= int(member) <= UINT32_MAX, 'Member {} is out of uint32'.format(member)
+
+    def pack(self, pairs: list) -> bytes:
+        for score, member in pairs:
+            self.check_item(score, member)
+
+        if self.scored:
+            return b''.join(struct.pack(self.format, int(score), int(member)) for score, member in pairs)
+
+        return b''.join(struct.pack(self.format, int(member)) for score, member in pairs)
+
+    def unpack(self, packed: bytes) -> list:
+        """Returns score and member pairs"""
+        items = struct.iter_unpack(self.format, packed)
+        return list(items) if self.scored else [(it[0], it[0]) for it in items]
+
+    def load_many(self, pks: list) -> Dict:
+        """Returns map of pk to pairs, None for "cold" sets"""
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.hget(self.bucket_key(pk), pk)
+            pipe.zrevrange(self.key(pk), 0, -1, withscores=True)
+        results = pipe.execute()
+
+        loaded = {}
+        for pk, packed, pairs in zip(pks, results[::2], results[1::2]):
+            if packed is not None:
+                loaded[pk] = self.unpack(packed)
+            elif pairs:
+                loaded[pk] = [(score, int(member)) for member, score in pairs]
+            else:
+                loaded[pk] = None
+
+        return loaded
+
+    def exists_many(self, pks: Iterable) -> Set:
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.hexists(self.bucket_key(pk), pk)
+            pipe.exists(self.key(pk))
+        results = pipe.execute()
+
+        return {pk for pk, packed, exists in zip(pks, results[::2], results[1::2]) if packed or exists}
+
+    def range(self, pk, start: int, end: int) -> List[int]:
+        pipe = r.pipeline(transaction=False)
+        pipe.hget(self.bucket_key(pk), pk)
+        pipe.zrevrange(self.key(pk), start, end)
+        packed, members = pipe.execute()
+
+        if packed is None:
+            return [int(it) for it in members]
+
+        members = [member for score, member in self.unpack(packed)]
+        return members[start:] if end == -1 else members[start:end + 1]
+
+    def range_many(self, pks: Iterable) -> Dict:
+        return {pk: [member for score, member in pairs or []] for pk, pairs in self.load_many(list(pks)).items()}
+
+    def card_many(self, pks: Iterable) -> Dict:
+        # Packed set is read instead of HSTRLEN, it needs Redis 3.2
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.hget(self.bucket_key(pk), pk)
+            pipe.zcard(self.key(pk))
+        results = pipe.execute()
+
+        size = struct.calcsize(self.format)
+        return {pk: len(packed) // size if packed is not None else count
+                for pk, packed, count in zip(pks, results[::2], results[1::2])}
+
+    def score(self, pk, member: int) -> float or None:
+        pairs = self.load_many([pk])[pk] or []
+        for score, it in pairs:
+            if it == member:
+                return float(score)
+
+        return None
+
+    def write(self, pipe, pk, result: list):
+        if len(result) // 2 > self.max_members:
+            pipe.hdel(self.bucket_key(pk), pk)
+            super().write(pipe, pk, result)
+            return
+
+        pipe.hset(self.bucket_key(pk), pk, self.pack(get_pairs(result)))
+        pipe.delete(self.key(pk))
+
+    def add(self, pk, score, member: int, xx: bool = False, client=r):
+        self.check_item(score, member)
+        args = [int(self.scored), pk, int(score), member, int(xx), self.max_members]
+        self._add_script(keys=[self.bucket_key(pk), self.key(pk)], args=args, client=client)
+
+    def remove(self, pk, member: int, client=r):
+        args = [int(self.scored), pk, member]
+        self._remove_script(keys=[self.bucket_key(pk), self.key(pk)], args=args, client=client)
+
+    def delete(self, pk, client=r):
+        client.hdel(self.bucket_key(pk), pk)
+        client.delete(self.key(pk))
+
+    def memory_usage(self, pks: Iterable) -> int or None:
+        """Returns bytes of packed sets and sizes of sorted sets, None if it is unavailable"""
+        pks = list(pks)
+        pipe = r.pipeline(transaction=False)
+        for pk in pks:
+            pipe.hget(self.bucket_key(pk), pk)
+        packed = sum(len(it or b'') for it in pipe.execute())
+
+        unpacked = super().memory_usage(pks)
+        return None if unpacked is None else packed + unpacked
+
+
+def get_store(key_pattern: str, ttl: int = None, compact: bool = False, scored: bool = True) -> ZsetStore:
+    """Returns compact store if it is allowed for key pattern and enabled by COMPACT_ZSETS setting"""
+    config = get_config()
+    if compact and config['COMPACT_ZSETS']:
+        return CompactZsetStore(key_pattern, ttl, scored=scored, buckets=config['COMPACT_ZSET_BUCKETS'])
+
+    return ZsetStore(key_pattern, ttl)
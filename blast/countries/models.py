@@ -1,6 +1,10 @@
 from __future__ import unicode_literals
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from core.local_cache import local_cache
 
 
 class Country(models.Model):
@@ -11,4 +15,21 @@ class Country(models.Model):
         return '{}'.format(self.name)
 
     class Meta:
-        ordering = ('name',)
\ No newline at end of file
+        ordering = ('name',)
+
+
+@local_cache('countries:all')
+def get_countries() -> list:
+    """Returns list of all countries ordered by name"""
+    return list(Country.objects.all())
+
+
+@local_cache('countries:by_name')
+def get_country_by_name(name: str) -> Country:
+    return Country.objects.get(name=name)
+
+
+@receiver([post_save, post_delete], sender=Country, dispatch_uid='invalidate_countries')
+def invalidate_countries(sender, **kwargs):
+    get_countries.invalidate()
+    get_country_by_name.invalidate()
@@ -5,6 +5,7 @@ from django.db.models import Q
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 
+from core import counters
 from posts.models import Post, PostComment
 from tags.models import Tag
 from users.models import User, UserSettings, Follower
@@ -260,26 +261,30 @@ def save_comment_notifications(sender, instance: PostComment, **kwargs):
             notification.send_push_message()
 
 
-@receiver(post_save, sender=Post, dispatch_uid='notifications_posts')
-def blast_save_notifications(sender, instance: Post, **kwargs):
-    """Handles changing of votes counter and creates notification"""
-    votes = instance.voted_count
-
-    users = instance.notified_users
-    notify_users(users, instance, None, instance.user)
-
+def notify_votes_reached(post: Post, votes: int):
+    """Creates notification if post reached round count of votes"""
     if votes == 0 or votes % 10:
         return
 
     if (votes <= 100 and votes % 10 == 0) or (votes >= 1000 and votes % 1000 == 0):
-        logger.info('Post {} reached {} votes'.format(instance, votes))
-        notification = Notification.objects.create(user_id=instance.user_id, other_id=instance.user_id,
-                                                   post_id=instance.pk, votes=votes, type=Notification.VOTES_REACHED)
+        logger.info('Post {} reached {} votes'.format(post, votes))
+        notification = Notification.objects.create(user_id=post.user_id, other_id=post.user_id,
+                                                   post_id=post.pk, votes=votes, type=Notification.VOTES_REACHED)
 
-        if instance.user.settings.notify_votes:
+        if post.user.settings.notify_votes:
             notification.send_push_message()
 
 
+@receiver(post_save, sender=Post, dispatch_uid='notifications_posts')
+def blast_save_notifications(sender, instance: Post, **kwargs):
+    """Handles changing of votes counter and creates notification"""
+    users = instance.notified_users
+    notify_users(users, instance, None, instance.user)
+
+    votes = counters.get_values(Post, 'voted_count', {instance.pk: instance.voted_count})[instance.pk]
+    notify_votes_reached(instance, votes)
+
+
 @receiver(post_save, sender=Follower, dispatch_uid='notifications_follow')
 def start_following_handler(sender, instance: Follower, **kwargs):
     """Handles following event"""
@@ -9,8 +9,9 @@ from notifications.serializers import NotificationPublicSerializer, FollowReques
     FollowRequestSerializer
 
 from  users.models import User, Follower
-from users.serializers import OwnerSerializer
+from users.serializers import get_author_cards
 from users.utils import mark_followee, mark_requested
+from users.viewer import get_viewer
 import datetime
 from django.utils import timezone
 
@@ -19,26 +20,23 @@ class NotificationsViewSet(ExtendableModelMixin,
     def extend_response_data(self, data):
         request = self.request
 
-        users = {it['other'] for it in data if it['other']}
-        users = list(User.objects.filter(pk__in=users))
-        users = {it.pk: it for it in users}
+        users = get_author_cards((it['other'] for it in data), request)
 
-        context = {'request': request}
         serialized_users = []
         for it in data:
             if not it['other']:
                 continue
 
-            user = users[it['other']]
-            user = OwnerSerializer(instance=user, context=context).data
+            user = dict(users[it['other']])
             serialized_users.append(user)
 
             it['user'] = user
 
             del it['other']
 
-        mark_followee(serialized_users, self.request.user)
-        mark_requested(serialized_users, self.request.user)
+        viewer = get_viewer(self.request)
+        mark_followee(serialized_users, viewer)
+        mark_requested(serialized_users, viewer)
 
         return data
 
@@ -0,0 +1,101 @@
+"""
+Schedule of "ending soon" notifications of posts.
+
+Posts are scheduled by creation to redis sorted set scored by time they become "ending soon",
+ENDING_SOON_MINUTES before expiration. Changes of expiration time move scheduled posts only,
+so post is not scheduled again after it was processed.
+
+pop_due() moves due posts to processing set atomically, each post is handed to one worker.
+Worker acknowledges posts by ack() when they are processed. Posts of crashed worker are
+handed out again after ENDING_SOON_VISIBILITY_TIMEOUT, notifications skip users notified already.
+
+Schedule is redis state only, so it is rebuilt by schedule_many() of live posts
+by warm_up_cache command and hourly task.
+"""
+from datetime import datetime, timedelta
+from typing import Iterable, List
+
+from django.utils import timezone
+
+from core.redis_client import r
+
+ENDING_SOON_KEY = u'posts:ending_soon'
+# Posts handed to workers scored by time they are handed out again
+ENDING_SOON_PROCESSING_KEY = u'posts:ending_soon:processing'
+
+# Minutes before expiration users are notified about post
+ENDING_SOON_MINUTES = 10
+
+ENDING_SOON_BATCH_SIZE = 500
+
+# Seconds worker has for processing of popped posts
+ENDING_SOON_VISIBILITY_TIMEOUT = 60 * 5
+
+# KEYS: schedule, processing set. ARGV: now, visibility deadline, count
+_LUA_POP_DUE = '''
+local count = tonumber(ARGV[3])
+local post_ids = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1], 'LIMIT', 0, count)
+if #post_ids < count then
+    local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, count - #post_ids)
+    if #due > 0 then
+        redis.call('ZREM', KEYS[1], unpack(due))
+    end
+    for _, it in ipairs(due) do
+        table.insert(post_ids, it)
+    end
+end
+
+for _, it in ipairs(post_ids) do
+    redis.call('ZADD', KEYS[2], ARGV[2], it)
+end
+return post_ids
+'''
+
+_pop_due_script = r.register_script(_LUA_POP_DUE)
+
+
+def get_due_time(expired_at: datetime) -> float:
+    return (expired_at - timedelta(minutes=ENDING_SOON_MINUTES)).timestamp()
+
+
+def schedule(post_id: int, expired_at: datetime, client=r):
+    client.zadd(ENDING_SOON_KEY, get_due_time(expired_at), post_id)
+
+
+def schedule_many(posts: Iterable[tuple], client=r) -> int:
+    """Schedules (post_id, expired_at) of posts not scheduled yet, returns count of posts"""
+    args = []
+    for post_id, expired_at in posts:
+        args.extend([get_due_time(expired_at), post_id])
+
+    if args:
+        client.execute_command('ZADD', ENDING_SOON_KEY, 'NX', *args)
+
+    return len(args) // 2
+
+
+def reschedule(post_id: int, expired_at: datetime, client=r):
+    """Moves post if it is scheduled, processed posts are not scheduled again"""
+    client.execute_command('ZADD', ENDING_SOON_KEY, 'XX', get_due_time(expired_at), post_id)
+
+
+def unschedule(post_ids: Iterable[int], client=r):
+    post_ids = list(post_ids)
+    if post_ids:
+        client.zrem(ENDING_SOON_KEY, *post_ids)
+        client.zrem(ENDING_SOON_PROCESSING_KEY, *post_ids)
+
+
+def pop_due(count: int = ENDING_SOON_BATCH_SIZE) -> List[int]:
+    """Hands out ids of posts due by now and posts of crashed workers, they should be acknowledged"""
+    now = timezone.now().timestamp()
+    args = [now, now + ENDING_SOON_VISIBILITY_TIMEOUT, count]
+    result = _pop_due_script(keys=[ENDING_SOON_KEY, ENDING_SOON_PROCESSING_KEY], args=args)
+    return [int(it) for it in result]
+
+
+def ack(post_ids: Iterable[int]):
+    """Marks handed out posts as processed"""
+    post_ids = list(post_ids)
+    if post_ids:
+        r.zrem(ENDING_SOON_PROCESSING_KEY, *post_ids)
@@ -0,0 +1,155 @@
+"""
+Bulk deletion of expired posts.
+
+Expired posts are streamed by chunks of ids. Each chunk is deleted with its dependents by few
+statements, work of delete signals of posts is done for whole chunk in one redis pipeline
+after commit.
+Media files are deleted by posts.media_gc collector.
+Last deleted pk is recorded, so interrupted run continues after it.
+"""
+import logging
+from collections import Counter, defaultdict
+from typing import Dict, List
+
+from django.db import connection, transaction
+from django.db.models import Q
+from redis.exceptions import LockError, RedisError
+
+from core import cache_events, counters
+from core.redis_client import r, pipeline
+from core.views import invalidate_public_responses
+from notifications.models import Notification
+from posts import media_gc
+from posts.models import Post, PostComment, PostVote, get_media_groups, get_excluding_users
+from tags.models import Tag
+from users.models import User, PinnedPosts
+
+logger = logging.getLogger(__name__)
+
+# Hash of last deleted pk and count of deleted posts of current run
+EXPIRY_PROGRESS_KEY = u'posts:expiry:progress'
+
+# Only one worker deletes expired posts, lock is prolonged after each chunk
+EXPIRY_LOCK_KEY = u'posts:expiry:lock'
+EXPIRY_LOCK_TIMEOUT = 60 * 10
+
+EXPIRY_CHUNK_SIZE = 200
+
+
+def iter_expired_chunks(last_pk: int or None, chunk_size: int):
+    """Streams ids of posts expired by start of run ordered by pk after last_pk"""
+    posts = Post.objects.expired().order_by('pk').values_list('pk', flat=True)
+    while True:
+        chunk_qs = posts if last_pk is None else posts.filter(pk__gt=last_pk)
+        chunk = list(chunk_qs[:chunk_size])
+        if not chunk:
+            return
+
+        yield chunk
+        last_pk = chunk[-1]
+
+
+def decr_counts(model, field: str, counts: Counter, pipe):
+    """Subtracts counts from counters grouped by amount"""
+    pks_by_amount = defaultdict(list)
+    for pk, count in counts.items():
+        pks_by_amount[count].append(pk)
+
+    for amount, pks in pks_by_amount.items():
+        counters.incr(model, field, pks, -amount, pipe=pipe)
+
+
+def raw_delete(model, field: str, values: List[int]):
+    """Deletes rows by field values with one statement, delete signals and cascades are not run"""
+    quote = connection.ops.quote_name
+    sql = 'DELETE FROM {} WHERE {} IN ({})'.format(quote(model._meta.db_table),
+                                                   quote(model._meta.get_field(field).column),
+                                                   ', '.join(['%s'] * len(values)))
+    with connection.cursor() as cursor:
+        cursor.execute(sql, values)
+
+
+def apply_deleted_posts(posts: List[tuple], tags: Dict[int, list], excluded_users: Dict[int, set]):
+    """Does work of delete signals of posts in one redis pipeline, runs after commit of deletion"""
+    try:
+        with pipeline() as pipe:
+            decr_counts(User, 'popularity', Counter(it[1] for it in posts), pipe)
+            decr_counts(Tag, 'total_posts', Counter(title for it in tags.values() for title in it), pipe)
+
+            for pk, user_id, _, _ in posts:
+                cache_events.emit('post_deleted', pipe, post=pk, user=user_id,
+                                  excluded_users=sorted(excluded_users[pk]), tags=sorted(tags[pk]))
+
+            invalidate_public_responses(pipe)
+
+            groups = [get_media_groups(Post(pk=pk, image=image, video=video)) for pk, _, image, video in posts]
+            media_gc.enqueue([it for post_groups in groups for it in post_groups], pipe)
+    except RedisError:
+        # Posts are deleted already, so failure is logged only, orphan media is found by scan_media_orphans
+        logger.exception('Failed to apply deletion of posts {}'.format([it[0] for it in posts]))
+
+
+def delete_posts(post_ids: List[int]) -> int:
+    """Deletes posts and their dependents in bulk, returns count of deleted posts"""
+    posts = list(Post.objects.filter(pk__in=post_ids).values_list('pk', 'user_id', 'image', 'video'))
+    post_ids = [it[0] for it in posts]
+    if not post_ids:
+        return 0
+
+    tags = defaultdict(list)
+    for post_id, title in Post.tags.through.objects.filter(post__in=post_ids).values_list('post_id', 'tag_id'):
+        tags[post_id].append(title)
+    excluded_users = get_excluding_users(post_ids)
+
+    with transaction.atomic():
+        comments = PostComment.objects.filter(post__in=post_ids)
+        Notification.objects.filter(Q(post__in=post_ids) | Q(comment__in=comments) |
+                                    Q(parent_comment__in=comments)).delete()
+        comments.delete()
+        PostVote.objects.filter(post__in=post_ids).delete()
+        Post.tags.through.objects.filter(post__in=post_ids).delete()
+        User.hidden_posts.through.objects.filter(post__in=post_ids).delete()
+
+        # Work of delete signals of pins and posts is done after commit for all posts at once
+        raw_delete(PinnedPosts, 'post', post_ids)
+        raw_delete(Post, 'id', post_ids)
+
+        transaction.on_commit(lambda: apply_deleted_posts(posts, tags, excluded_users))
+
+    return len(posts)
+
+
+def delete_expired_posts(chunk_size: int = EXPIRY_CHUNK_SIZE) -> int:
+    """Deletes expired posts by chunks, returns count of deleted posts"""
+    lock = r.lock(EXPIRY_LOCK_KEY, timeout=EXPIRY_LOCK_TIMEOUT)
+    if not lock.acquire(blocking=False):
+        logger.info('Expired posts are deleted by other worker')
+        return 0
+
+    try:
+        last_pk = r.hget(EXPIRY_PROGRESS_KEY, 'last_pk')
+        last_pk = int(last_pk) if last_pk else None
+        if last_pk:
+            logger.info('Resume deleting of expired posts after {}'.format(last_pk))
+
+        count = 0
+        for chunk in iter_expired_chunks(last_pk, chunk_size):
+            deleted = delete_posts(chunk)
+            count += deleted
+
+            pipe = r.pipeline()
+            pipe.hset(EXPIRY_PROGRESS_KEY, 'last_pk', chunk[-1])
+            pipe.hincrby(EXPIRY_PROGRESS_KEY, 'deleted', deleted)
+            pipe.expire(EXPIRY_LOCK_KEY, EXPIRY_LOCK_TIMEOUT)
+            pipe.execute()
+
+        total = int(r.hget(EXPIRY_PROGRESS_KEY, 'deleted') or 0)
+        r.delete(EXPIRY_PROGRESS_KEY)
+        logger.info('Deleted {} expired posts'.format(total))
+    finally:
+        try:
+            lock.release()
+        except LockError:
+            logger.warning('Lock of expired posts deletion expired')
+
+    return count
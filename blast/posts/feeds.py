@@ -1,15 +1,26 @@
+import random
 from datetime import timezone
 
-from django.db.models import Q
+from django.db import models
 from rest_framework import viewsets
+from rest_framework.exceptions import NotFound
 
-from core.pagination import DateTimePaginator
-from core.views import ExtendableModelMixin
-from posts.models import Post, PostVote
+from core.pagination import CursorPaginator
+from core.redis_client import r
+from core.views import ExtendableModelMixin, PublicResponseCacheMixin
+from posts.models import Post, POSTS_POPULAR_KEY, POSTS_ANONYMOUS_KEY, heat_up_popular, heat_up_anonymous
 from posts.serializers import PostPublicSerializer
 from posts.utils import extend_posts
-from users.models import User, BlockedUsers, PinnedPosts
+from users.models import User
 from users.utils import mark_followee, mark_requested
+from users.viewer import get_viewer
+
+
+# Max count of home feed chunks pulled for skipping expired posts
+FEED_MAX_CHUNKS = 10
+
+# One of FEED_ANONYMOUS_RATIO feed items is anonymous post
+FEED_ANONYMOUS_RATIO = 10
 
 # TODO (VM): Add feeds test, check author, hidden posts and voted posts
 # Order of posts should be by date, with newest appearing at the top:  
@@ -26,61 +37,196 @@ from users.utils import mark_followee, mark_requested
 #   the same manner as described above.
 
 
+def seek_rank(key: str, score, pk: int) -> int:
+    """
+    Returns rank of the first member after (score, pk) position of member which has gone from sorted set.
+    Members of equal score are ordered by member bytes in ZREVRANGE.
+    """
+    pipe = r.pipeline(transaction=False)
+    pipe.zcount(key, '({}'.format(score), '+inf')
+    pipe.zrevrangebyscore(key, score, score)
+    higher, tied = pipe.execute()
+
+    member = str(pk).encode('utf-8')
+    return higher + sum(1 for it in tied if it > member)
+
+
+def get_ranked_ids(key: str, position: tuple or None, count: int, reverse: bool = False,
+                   withscores: bool = False) -> list:
+    """
+    Returns ids of sorted set members after (score, id) position, or (id, score) pairs for withscores.
+    Members are ordered by descending score or vice versa for reverse.
+    """
+    rank = 0
+    if position is not None:
+        score, pk = position
+        rank = r.zrevrank(key, pk)
+        if rank is not None:
+            rank = rank if reverse else rank + 1
+        elif score is not None:
+            rank = seek_rank(key, score, pk)
+        else:
+            return []
+
+    if reverse:
+        items = r.zrevrange(key, max(0, rank - count), rank - 1, withscores=True) if rank else []
+        items.reverse()
+    else:
+        items = r.zrevrange(key, rank, rank + count - 1, withscores=True)
+
+    if withscores:
+        return [(int(member), score) for member, score in items]
+
+    return [int(member) for member, score in items]
+
+
+def get_feed_ids(user_id: int, position: tuple or None, count: int, reverse: bool = False,
+                 withscores: bool = False) -> list:
+    """
+    Returns ids of home feed posts after (created_at or its timestamp, id) position.
+    Posts are ordered from newest to oldest or vice versa for reverse.
+    """
+    key = User.redis_feed_key(user_id)
+    if not r.exists(key):
+        User.get_feed(user_id, 0, 1)  # Heat up cache
+
+    if position is not None:
+        created_at, pk = position
+        position = (created_at.timestamp() if hasattr(created_at, 'timestamp') else created_at, pk)
+
+    return get_ranked_ids(key, position, count, reverse, withscores)
+
+
+def get_popular_ids(position: tuple or None, count: int, reverse: bool = False, withscores: bool = False) -> list:
+    """
+    Returns ids of live public posts after (popularity, id) position.
+    Posts are ordered from the most popular or vice versa for reverse.
+    """
+    heat_up_popular()
+    return get_ranked_ids(POSTS_POPULAR_KEY, position, count, reverse, withscores)
+
+
+def get_anonymous_ids(post_id: int or None, count: int, reverse: bool = False) -> list:
+    """
+    Returns ids of live anonymous posts after post_id.
+    Posts are ordered from newest to oldest or vice versa for reverse.
+    """
+    heat_up_anonymous()
+
+    position = (None, post_id) if post_id else None
+    return get_ranked_ids(POSTS_ANONYMOUS_KEY, position, count, reverse)
+
+
+class AnonymousInterleaveMixin(object):
+    """
+    Merges anonymous posts into feed pages as one of anonymous_ratio items at random position,
+    page is not larger than requested page size.
+    Id of the last anonymous post merged before cursor and seed of positions are kept as cursor state,
+    so pages are stable in both directions. Seed is viewer id, or 0 for anonymous viewers.
+    """
+    anonymous_ratio = FEED_ANONYMOUS_RATIO
+
+    def get_cursor_page_size(self, size: int) -> int:
+        """Leaves room for anonymous posts"""
+        return max(size - size // self.anonymous_ratio, 1)
+
+    def get_anonymous_offset(self, seed: int, post_id: int) -> int:
+        """Returns index of feed item anonymous post follows in its group, it is the same for each request"""
+        return random.Random((seed << 32) + post_id).randrange(self.anonymous_ratio - 1)
+
+    def decode_anonymous_state(self, state: str or None) -> tuple:
+        """Returns id of the last merged anonymous post and seed of positions"""
+        if not state:
+            # First page is the same for each request of viewer, so it can be cached
+            viewer = get_viewer(self.request)
+            return None, viewer.user.pk if viewer.is_authenticated() else 0
+
+        try:
+            last, seed = state.split(':')
+            return int(last) if last else None, int(seed)
+        except ValueError:
+            raise NotFound(CursorPaginator.invalid_cursor_message)
+
+    def get_anonymous_posts(self, ids: list) -> list:
+        posts = Post.objects.actual().in_bulk(ids)
+        excluded = get_viewer(self.request).excluded(posts.keys())
+
+        return [posts[pk] for pk in ids if pk in posts and pk not in excluded]
+
+    def extend_cursor_page(self, page: list, state: str or None, reverse: bool) -> tuple:
+        """Returns merged page and states of cursors before and after it"""
+        last, seed = self.decode_anonymous_state(state)
+
+        def encode(pk: int or None) -> str:
+            return u'{}:{}'.format(pk or '', seed)
+
+        step = self.anonymous_ratio - 1
+        count = len(page) // step
+        if not count:
+            return page, encode(last), encode(last)
+
+        first = last
+        if reverse:
+            # Page ends by last anonymous post merged before the next page
+            ids = list(reversed(get_anonymous_ids(last, count, True)))
+            ids += [last] if last else []
+            if len(ids) > count:
+                first, ids = ids[0], ids[1:]
+            else:
+                first = None
+        else:
+            ids = get_anonymous_ids(last, count)
+            last = ids[-1] if ids else last
+
+        anonymous = self.get_anonymous_posts(ids)
+
+        result = []
+        for i in range(0, len(page), step):
+            group = page[i:i + step]
+            if len(group) == step and anonymous:
+                post = anonymous.pop(0)
+                offset = self.get_anonymous_offset(seed, post.pk) + 1
+                group = group[:offset] + [post] + group[offset:]
+            result.extend(group)
+
+        return result, encode(first), encode(last)
+
+
 class BaseFeedView(ExtendableModelMixin, viewsets.ReadOnlyModelViewSet):
     serializer_class = PostPublicSerializer
-    pagination_class = DateTimePaginator
+    pagination_class = CursorPaginator
 
     def extend_response_data(self, data):
-        extend_posts(data, self.request.user, self.request)
+        viewer = get_viewer(self.request)
+        extend_posts(data, viewer, self.request)
 
         # Adds is_requested and is_followee flags
         authors = [it['author'] for it in data if it['author']]
-        mark_followee(authors, self.request.user)
-        mark_requested(authors, self.request.user)
+        mark_followee(authors, viewer)
+        mark_requested(authors, viewer)
 
     def get_queryset(self):
-        qs = Post.objects.actual()
+        return Post.objects.actual()
 
-        user = self.request.user
+    def get_blocked(self) -> set:
+        return get_viewer(self.request).blocked
 
-        if not user.is_authenticated():
-            return qs
-
-        # Exclude blocked users
-        # FIXME (VM): cache list in redis?
-        blocked = BlockedUsers.objects.filter(user=user)
-        blocked = {it.blocked_id for it in blocked}
-        qs = qs.exclude(user__in=blocked)
-
-        # Exclude hidden posts
-        # FIXME (VM): cache list in redis?
-        hidden = user.hidden_posts.all().values('pk')
-        hidden = {it['pk'] for it in hidden}
-        qs = qs.exclude(pk__in=hidden)
-
-        # Exclude voted posts
-        # FIXME (VM): votes list can be very large
-        # FIXME (VM): cache list in redis?
-        voted = PostVote.objects.filter(user=user.pk).values('post')
-        voted = {it['post'] for it in voted}
-        qs = qs.exclude(pk__in=voted)
-
-        # Exclude pinned posts
-        # FIXME (VM): pinned list can be very large
-        # FIXME (VM): cache list in redis?
-        pinned = PinnedPosts.objects.filter(user=user.pk).values('post')
-        pinned = {it['post'] for it in pinned}
-        qs = qs.exclude(pk__in=pinned)
-
-        return qs.order_by('-created_at')
-
-    def followees(self):
-        user = self.request.user
-        # FIXME: write method for getting all followees
-        return User.get_followees(user.pk, 0, 1000)
+    def filter_cursor_chunk(self, posts: list) -> list:
+        """Excludes posts of blocked users, voted, hidden and pinned posts"""
+        viewer = get_viewer(self.request)
+        if not viewer.is_authenticated() or not posts:
+            return posts
+
+        blocked = viewer.blocked
+        excluded = viewer.excluded(it.pk for it in posts)
+
+        return [it for it in posts if it.pk not in excluded and it.user_id not in blocked]
 
+    def followees(self) -> list:
+        return list(get_viewer(self.request).followees)
 
-class MainFeedView(BaseFeedView):
+
+class MainFeedView(AnonymousInterleaveMixin, BaseFeedView):
     """
     Returns list of posts from user followees
     """
@@ -90,35 +236,79 @@ class MainFeedView(BaseFeedView):
         if not user.is_authenticated():
             return Post.objects.filter(id__lt=0)  # Empty response :(
 
-        qs = super().get_queryset()
-        qs = qs.filter(Q(user__in=self.followees()) | Q(user_id=user.pk))
+        return super().get_queryset()
+
+    def get_cursor_chunk(self, position: tuple or None, size: int, reverse: bool) -> list:
+        user = self.request.user
+        if not user.is_authenticated():
+            return []
+
+        queryset = self.get_queryset()
 
-        if user.pk != User.objects.anonymous_id:
-            qs = qs.exclude(user_id=User.objects.anonymous_id)
+        posts = []
+        for it in range(FEED_MAX_CHUNKS):
+            items = get_feed_ids(user.pk, position, size, reverse, withscores=True)
+            if not items:
+                break
 
-        return qs
+            # Expired posts can stay in feed until clear_expired_posts
+            ids = [pk for pk, score in items]
+            found = queryset.in_bulk(ids)
+            posts.extend(found[pk] for pk in ids if pk in found)
 
+            if len(posts) >= size or len(ids) < size:
+                break
+
+            # Score is kept, so next chunk is found even if the last post is pruned meanwhile
+            position = tuple(reversed(items[-1]))
+
+        return posts
+
+
+class RecentFeedView(PublicResponseCacheMixin, AnonymousInterleaveMixin, BaseFeedView):
+    """
+    Returns list of public posts of not followed users ordered by popularity
+    """
+    # Score of post in index of live posts, it includes votes not flushed to database yet
+    cursor_ordering = 'indexed_popularity'
+    cursor_field = models.IntegerField()
 
-class RecentFeedView(BaseFeedView):
     def get_queryset(self):
-        qs = super().get_queryset()
+        return Post.objects.public()
 
-        user = self.request.user
-        if not user.is_authenticated():
-            return qs
+    def get_cursor_chunk(self, position: tuple or None, size: int, reverse: bool) -> list:
+        queryset = self.get_queryset()
+
+        posts = []
+        for it in range(FEED_MAX_CHUNKS):
+            items = get_popular_ids(position, size, reverse, withscores=True)
+            if not items:
+                break
+
+            # Expired posts stay in index until clear_expired_posts
+            found = queryset.in_bulk([pk for pk, score in items])
+            for pk, score in items:
+                if pk in found:
+                    found[pk].indexed_popularity = int(score)
+                    posts.append(found[pk])
+
+            if len(posts) >= size or len(items) < size:
+                break
+
+            # Score is kept, so next chunk is found even if the last post is pruned meanwhile
+            position = tuple(reversed(items[-1]))
 
-        followees = self.followees()
-        if User.objects.anonymous_id in followees:
-            followees.remove(User.objects.anonymous_id)
+        return posts
 
-        show_anonymous = User.objects.anonymous_id in followees
+    def filter_cursor_chunk(self, posts: list) -> list:
+        """Excludes own posts, posts of followees and anonymous posts merged separately"""
+        posts = super().filter_cursor_chunk(posts)
 
-        if show_anonymous:
-            qs = qs.filter(user_id=user.pk)
-            followees.remove(User.objects.anonymous_id)
+        excluded_users = {User.objects.anonymous_id}
 
-        qs = qs.exclude(Q(user_id__in=followees))
-        qs = qs.filter(user__is_private=False)
-        qs = qs.exclude(user_id=user.pk)
+        viewer = get_viewer(self.request)
+        if viewer.is_authenticated():
+            excluded_users |= viewer.followees
+            excluded_users.add(viewer.user.pk)
 
-        return qs
+        return [it for it in posts if it.user_id not in excluded_users]
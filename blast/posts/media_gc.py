@@ -0,0 +1,195 @@
+"""
+Garbage collector of media files of posts.
+
+Deleted posts enqueue storage names of their files and generated ImageKit specs, so requests
+and expiry of posts do not wait for storage. Queue is redis set of JSON lists of names,
+original file first. collect() deletes queued files in batches; groups which failed or whose
+original is still referenced by post (delete was rolled back or is not committed yet) are
+retried by next runs up to MEDIA_GC_MAX_RETRIES times.
+
+iter_orphans() finds files of post media directories not referenced by any post.
+"""
+import json
+import logging
+import os
+from datetime import datetime, timedelta
+from typing import Iterable, List, Set
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db.models import Q
+
+from core.redis_client import r, pipeline, on_result
+
+logger = logging.getLogger(__name__)
+
+MEDIA_GC_KEY = u'media:gc'
+# Hash of queued group to count of failed attempts
+MEDIA_GC_RETRIES_KEY = u'media:gc:retries'
+MEDIA_GC_SCHEDULED_KEY = u'media:gc:scheduled'
+
+# Seconds files are kept after delete of post, so delete transaction is committed
+MEDIA_GC_DELAY = 60
+
+MEDIA_GC_BATCH_SIZE = 200
+MEDIA_GC_MAX_RETRIES = 5
+
+# Files uploaded recently can belong to post which is being created
+MEDIA_GC_ORPHAN_MIN_AGE = timedelta(hours=1)
+
+
+def get_cache_dir() -> str:
+    return getattr(settings, 'IMAGEKIT_CACHEFILE_DIR', 'CACHE/images')
+
+
+def get_media_dirs() -> List[str]:
+    """Returns storage directories of files of posts and their generated specs"""
+    return ['user/images', 'user/videos', os.path.join(get_cache_dir(), 'user/images')]
+
+
+def schedule_collect(is_scheduled: bool):
+    from posts.tasks import collect_media_garbage
+
+    if is_scheduled:
+        collect_media_garbage.apply_async(countdown=MEDIA_GC_DELAY)
+
+
+def enqueue(groups: Iterable[List[str]], pipe=None):
+    """
+    Queues groups of storage names for deletion and schedules collector.
+    :param pipe: pipe of core.redis_client.pipeline() commands are queued to
+    """
+    members = [json.dumps(it) for it in groups if it]
+    if not members:
+        return
+
+    if pipe is None:
+        with pipeline() as pipe:
+            enqueue([json.loads(it) for it in members], pipe)
+        return
+
+    pipe.sadd(MEDIA_GC_KEY, *members)
+    pipe.set(MEDIA_GC_SCHEDULED_KEY, 1, ex=MEDIA_GC_DELAY * 10, nx=True)
+    on_result(pipe, schedule_collect)
+
+
+def get_referenced(names: Iterable[str]) -> Set[str]:
+    """Returns names of files of existing posts"""
+    from posts.models import Post
+
+    names = set(names)
+    posts = Post.objects.filter(Q(image__in=names) | Q(video__in=names)).values_list('image', 'video')
+    return {name for it in posts for name in it if name in names}
+
+
+def remove_empty_dir(name: str):
+    """Removes directory of generated specs of deleted file"""
+    if not name.startswith(get_cache_dir()):
+        return
+
+    try:
+        path = os.path.dirname(default_storage.path(name))
+    except NotImplementedError:
+        return  # Storage has no directories
+
+    try:
+        os.rmdir(path)
+    except OSError:
+        pass  # Directory is not empty or was removed
+
+
+def collect_batch(members: List[bytes]) -> int:
+    """Deletes files of queued groups, returns count of deleted files"""
+    groups = {it: json.loads(it.decode('utf-8')) for it in members}
+    referenced = get_referenced(names[0] for names in groups.values())
+
+    count, done, failed = 0, [], []
+    for member, names in groups.items():
+        if names[0] in referenced:
+            failed.append(member)
+            continue
+
+        try:
+            for name in names:
+                default_storage.delete(name)
+                remove_empty_dir(name)
+        except OSError:
+            logger.exception('Failed to delete {}'.format(names))
+            failed.append(member)
+            continue
+
+        done.append(member)
+        count += len(names)
+
+    pipe = r.pipeline()
+    if done:
+        pipe.srem(MEDIA_GC_KEY, *done)
+        pipe.hdel(MEDIA_GC_RETRIES_KEY, *done)
+    for it in failed:
+        pipe.hincrby(MEDIA_GC_RETRIES_KEY, it, 1)
+    results = pipe.execute()
+    retries = results[-len(failed):] if failed else []
+
+    given_up = [member for member, it in zip(failed, retries) if it >= MEDIA_GC_MAX_RETRIES]
+    if given_up:
+        logger.error('Give up deleting of {}'.format([groups[it] for it in given_up]))
+        pipe = r.pipeline()
+        pipe.srem(MEDIA_GC_KEY, *given_up)
+        pipe.hdel(MEDIA_GC_RETRIES_KEY, *given_up)
+        pipe.execute()
+
+    return count
+
+
+def collect(batch_size: int = MEDIA_GC_BATCH_SIZE) -> int:
+    """Deletes queued files in batches, returns count of deleted files"""
+    r.delete(MEDIA_GC_SCHEDULED_KEY)
+
+    count, batch = 0, []
+    for member in r.sscan_iter(MEDIA_GC_KEY, count=batch_size):
+        batch.append(member)
+        if len(batch) >= batch_size:
+            count += collect_batch(batch)
+            batch = []
+
+    if batch:
+        count += collect_batch(batch)
+
+    logger.info('Deleted {} media files of posts'.format(count))
+    return count
+
+
+def iter_files(path: str):
+    """Streams storage names of files in directory and its subdirectories"""
+    if not default_storage.exists(path):
+        return
+
+    dirs, files = default_storage.listdir(path)
+    for it in files:
+        yield os.path.join(path, it)
+
+    for it in dirs:
+        yield from iter_files(os.path.join(path, it))
+
+
+def get_all_referenced() -> Set[str]:
+    """Returns names of files and generated specs of all posts"""
+    from posts.models import Post
+
+    names = set()
+    posts = Post.objects.exclude(image='', video='').only('pk', 'image', 'video')
+    for post in posts.iterator():
+        names.update(post.get_media_names())
+
+    return names
+
+
+def iter_orphans():
+    """Streams names of files of post media directories not referenced by any post"""
+    referenced = get_all_referenced()
+    min_modified_time = datetime.now() - MEDIA_GC_ORPHAN_MIN_AGE
+
+    for path in get_media_dirs():
+        for name in iter_files(path):
+            if name not in referenced and default_storage.modified_time(name) < min_modified_time:
+                yield name
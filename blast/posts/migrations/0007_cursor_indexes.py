@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('posts', '0006_auto_20170113_2333'),
+    ]
+
+    operations = [
+        migrations.AlterIndexTogether(
+            name='post',
+            index_together=set([('created_at', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='postcomment',
+            index_together=set([('post', 'created_at', 'id')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='postvote',
+            index_together=set([('post', 'created_at', 'id')]),
+        ),
+    ]
@@ -1,27 +1,33 @@
 import logging
-import redis
 import os
 import re
 import uuid
+from collections import defaultdict
 from datetime import timedelta
+from typing import Dict, Iterable, List
 
-from django.db import models
-from django.db.models import F, Q
+from django.conf import settings
+from django.db import models, transaction, IntegrityError
+from django.db.models import Q, F, Func, Case, When, Value
 from django.utils import timezone
-from django.db.backends.dummy.base import IntegrityError
 
-from django.db.models.signals import post_save, pre_delete
+from django.db.models.signals import post_save, pre_delete, post_delete
 from django.dispatch import receiver
 from django.utils.safestring import mark_safe
+from redis.exceptions import RedisError
 
+from core import cache_events, counters
+from core.cache_events import cache_event_handler
+from core.views import invalidate_public_responses
+from posts import ending_soon, media_gc
+from core.redis_client import r, pipeline, exists_many
 from notifications.tasks import send_push_notification
 from tags.models import Tag
-from users.models import User, USER_RECENT_POSTS_KEY, UserSettings, Follower
+from users.models import User, USER_RECENT_POSTS_KEY, USER_FEED_MAX_LENGTH, UserSettings, Follower, PinnedPosts
 from imagekit.models import ImageSpecField
 from imagekit.processors import ResizeToFill
 
 logger = logging.getLogger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 def post_image_upload_dir(instance: User, filename: str):
@@ -147,6 +153,16 @@ class Post(PostAdminFields,
     def popularity(self):
         return self.voted_count - self.downvoted_count
 
+    def get_media_names(self) -> List[str]:
+        """Returns storage names of media files and generated specs of post, original file first"""
+        names = []
+        if self.image:
+            names.extend([self.image.name, self.image_135.name, self.image_248.name])
+        if self.video:
+            names.append(self.video.name)
+
+        return names
+
     def get_tag_titles(self):
         expr = re.compile(r'(?:(?<=\s)|^)#(\w*[A-Za-z_]+\w*)', re.IGNORECASE)
         return {it.lower() for it in expr.findall(self.text)}
@@ -158,7 +174,10 @@ class Post(PostAdminFields,
         return delta
 
     def comments_count(self):
-        # TODO (VM): Cache this value to redis
+        # Value is prefetched for lists by posts.serializers.PostListSerializer
+        if hasattr(self, '_comments_count'):
+            return self._comments_count
+
         return PostComment.objects.filter(post=self.pk).count()
 
     def save(self, **kwargs):
@@ -172,6 +191,11 @@ class Post(PostAdminFields,
 
     class Meta:
         ordering = ('-created_at',)
+        index_together = (('created_at', 'id'),)
+
+
+counters.register(Post, 'voted_count')
+counters.register(Post, 'downvoted_count')
 
 
 class PostVote(models.Model):
@@ -186,6 +210,7 @@ class PostVote(models.Model):
 
     class Meta:
         unique_together = (('user', 'post'),)
+        index_together = (('post', 'created_at', 'id'),)
 
 
 class PostComment(TextNotificationMixin, models.Model):
@@ -203,53 +228,489 @@ class PostComment(TextNotificationMixin, models.Model):
     def __str__(self):
         return u'{} for post {}'.format(self.pk, self.post)
 
+    class Meta:
+        index_together = (('post', 'created_at', 'id'),)
+
 
 USERS_RANGES_COUNT = 4
 
+# Live public posts scored by popularity and by expiration time
+POSTS_POPULAR_KEY = u'posts:popular'
+POSTS_EXPIRES_KEY = u'posts:expires'
+# Live anonymous posts scored by creation time
+POSTS_ANONYMOUS_KEY = u'posts:anonymous'
+# Posts of cached user and tag posts sets scored by expiration time, members are "{set}:{post_id}:{pk}"
+POSTS_INDEXED_EXPIRES_KEY = u'posts:indexed:expires'
+
+POSTS_PRUNE_BATCH_SIZE = 500
+
+# Stores of cached posts sets by name used in members of POSTS_INDEXED_EXPIRES_KEY
+POSTS_SETS = {
+    'user': User.get_posts.store,
+    'tag': Tag.get_posts.store,
+}
+
+
+def get_popularity(votes: Dict[int, tuple]) -> Dict[int, int]:
+    """
+    Returns map of post id to popularity with votes not flushed to database yet.
+    :param votes: map of post id to voted_count and downvoted_count from database
+    """
+    voted = counters.get_values(Post, 'voted_count', {pk: it[0] for pk, it in votes.items()})
+    downvoted = counters.get_values(Post, 'downvoted_count', {pk: it[1] for pk, it in votes.items()})
+    return {pk: voted[pk] - downvoted[pk] for pk in votes}
+
+
+def get_feed_owners_many(author_ids: Iterable[int]) -> Dict[int, list]:
+    """Returns map of author id to list of user ids whose home feeds include posts of author"""
+    author_ids = set(author_ids)
+    # Anonymous posts are not shown in followers feeds
+    followed = [it for it in author_ids if it != User.objects.anonymous_id]
+
+    User.heat_up_followers(followed)
+    followers = User.get_followers.store.range_many(followed)
+
+    # Sets of users without followers are never built, sets locked by heat up are read from database
+    cold = [it for it in followed if not followers[it]]
+    for followee_id, follower_id in Follower.objects.filter(followee__in=cold).values_list('followee_id',
+                                                                                           'follower_id'):
+        followers[followee_id].append(follower_id)
+
+    return {it: followers.get(it, []) + [it] for it in author_ids}
+
+
+def heat_up_popular():
+    """Builds "cold" index of live public posts"""
+    if r.exists(POSTS_POPULAR_KEY):
+        return
+
+    posts = Post.objects.public().values_list('pk', 'voted_count', 'downvoted_count', 'expired_at')
+    logger.info('Heat up {} with {} posts'.format(POSTS_POPULAR_KEY, len(posts)))
+    popularity = get_popularity({it[0]: it[1:3] for it in posts})
+
+    pipe = r.pipeline()
+    for pk, _, _, expired_at in posts:
+        pipe.zadd(POSTS_POPULAR_KEY, popularity[pk], pk)
+        pipe.zadd(POSTS_EXPIRES_KEY, expired_at.timestamp(), pk)
+    pipe.execute()
+
+
+def heat_up_anonymous():
+    """Builds "cold" index of live anonymous posts"""
+    if r.exists(POSTS_ANONYMOUS_KEY):
+        return
+
+    posts = Post.objects.actual().filter(user=User.objects.anonymous_id)
+    posts = posts.values_list('pk', 'created_at', 'expired_at')
+    logger.info('Heat up {} with {} posts'.format(POSTS_ANONYMOUS_KEY, len(posts)))
+
+    pipe = r.pipeline()
+    for pk, created_at, expired_at in posts:
+        pipe.zadd(POSTS_ANONYMOUS_KEY, created_at.timestamp(), pk)
+        pipe.zadd(POSTS_EXPIRES_KEY, expired_at.timestamp(), pk)
+    pipe.execute()
+
+
+def remove_from_popular(post_ids: list, client=None):
+    """Removes posts from indexes of live posts"""
+    if not post_ids:
+        return
+
+    if client is None:
+        with pipeline() as pipe:
+            remove_from_popular(post_ids, pipe)
+        return
+
+    client.zrem(POSTS_POPULAR_KEY, *post_ids)
+    client.zrem(POSTS_ANONYMOUS_KEY, *post_ids)
+    client.zrem(POSTS_EXPIRES_KEY, *post_ids)
+
+
+def remove_expired_from_popular():
+    """Trims posts expired by now from index of live posts"""
+    post_ids = r.zrangebyscore(POSTS_EXPIRES_KEY, '-inf', timezone.now().timestamp())
+    remove_from_popular(post_ids)
+
+    logger.info('Remove {} expired posts from {}'.format(len(post_ids), POSTS_POPULAR_KEY))
+
+
+def schedule_ending_soon(post_ids: Iterable[int]) -> List[int]:
+    """Schedules ending soon notifications of live posts not ending soon yet, returns their ids"""
+    ending_at = timezone.now() + timedelta(minutes=ending_soon.ENDING_SOON_MINUTES)
+    posts = Post.objects.actual().filter(pk__in=post_ids, expired_at__gt=ending_at)
+    posts = list(posts.values_list('pk', 'expired_at'))
+
+    ending_soon.schedule_many(posts)
+    return [it[0] for it in posts]
+
+
+def get_indexed_member(name: str, pk, post_id: int) -> str:
+    return u'{}:{}:{}'.format(name, post_id, pk)
+
+
+def index_expiration(name: str, items: Iterable, client=r):
+    """Adds (pk, post_id, expired_at) of posts cached in sets of pk to expiration index"""
+    scores = []
+    for pk, post_id, expired_at in items:
+        scores.extend([expired_at.timestamp(), get_indexed_member(name, pk, post_id)])
+
+    if scores:
+        client.zadd(POSTS_INDEXED_EXPIRES_KEY, *scores)
+
+
+def update_indexed_expiration(post: Post, client=None):
+    """Sets expiration time of post in index if post is indexed"""
+    # Tags of post are created from its text
+    members = [get_indexed_member('user', post.user_id, post.pk)]
+    members.extend(get_indexed_member('tag', it, post.pk) for it in post.get_tag_titles())
+
+    if client is None:
+        with pipeline() as pipe:
+            update_indexed_expiration(post, pipe)
+        return
+
+    for it in members:
+        client.execute_command('ZADD', POSTS_INDEXED_EXPIRES_KEY, 'XX', post.expired_at.timestamp(), it)
+
+
+def remove_expired_from_sets(batch_size: int = POSTS_PRUNE_BATCH_SIZE) -> int:
+    """Removes posts expired by now from cached user and tag posts sets, returns count of removed posts"""
+    now = timezone.now().timestamp()
+
+    count = 0
+    while True:
+        members = r.zrangebyscore(POSTS_INDEXED_EXPIRES_KEY, '-inf', now, start=0, num=batch_size)
+        if not members:
+            break
+
+        with pipeline() as pipe:
+            for it in members:
+                name, post_id, pk = it.decode('utf-8').split(':', 2)
+                POSTS_SETS[name].remove(pk, int(post_id), client=pipe)
+            pipe.zrem(POSTS_INDEXED_EXPIRES_KEY, *members)
+
+        count += len(members)
+
+    logger.info('Remove {} expired posts from user and tag posts sets'.format(count))
+    return count
+
+
+# Fields of post changed by votes
+POST_VOTED_FIELDS = {'voted_count', 'downvoted_count', 'expired_at', 'updated_at'}
+
+# Minutes upvote adds to lifetime of post
+VOTE_EXTEND_MINUTES = 5
+# Minutes downvote takes from lifetime of post, it does not shorten lifetime to less than that
+DOWNVOTE_SHORTEN_MINUTES = 10
+
+
+class ShiftedDateTime(Func):
+    """Datetime field shifted by timedelta"""
+    template = '%(expressions)s'
+
+    def __init__(self, field: str, delta: timedelta):
+        super().__init__(F(field) + delta, output_field=models.DateTimeField())
+
+    def as_sqlite(self, compiler, connection):
+        # SQLite backend formats result with UTC offset which can not be read back
+        return self.as_sql(compiler, connection, template="REPLACE(%(expressions)s, '+00:00', '')")
+
+
+def get_voted_expiration(upvotes: int, downvotes: int):
+    """Returns SQL expression of expiration time of post after upvotes and then downvotes"""
+    extend = timedelta(minutes=VOTE_EXTEND_MINUTES) * upvotes
+    if not downvotes:
+        return ShiftedDateTime('expired_at', extend)
+
+    # Each downvote shortens lifetime until it is less than DOWNVOTE_SHORTEN_MINUTES
+    shorten = timedelta(minutes=DOWNVOTE_SHORTEN_MINUTES)
+    min_expired_at = timezone.now() + shorten
+    return Case(
+        When(expired_at__gte=min_expired_at + shorten * downvotes - extend,
+             then=ShiftedDateTime('expired_at', extend - shorten * downvotes)),
+        When(expired_at__gt=min_expired_at - extend, then=Value(min_expired_at)),
+        default=ShiftedDateTime('expired_at', extend),
+        output_field=models.DateTimeField(),
+    )
+
+
+def update_cached_expiration(post_ids: List[int]):
+    """Sets expiration time of posts in indexes of live posts"""
+    posts = Post.objects.filter(pk__in=post_ids).only('pk', 'user_id', 'text', 'expired_at')
+    with pipeline() as pipe:
+        for post in posts:
+            pipe.execute_command('ZADD', POSTS_EXPIRES_KEY, 'XX', post.expired_at.timestamp(), post.pk)
+            update_indexed_expiration(post, pipe)
+            ending_soon.reschedule(post.pk, post.expired_at, pipe)
+
+
+def apply_upvotes_expiration(post_ids: List[int], upvotes: int):
+    Post.objects.filter(pk__in=post_ids).update(expired_at=get_voted_expiration(upvotes, 0))
+    update_cached_expiration(post_ids)
+
+
+def apply_downvotes_expiration(post_ids: List[int], downvotes: int):
+    Post.objects.filter(pk__in=post_ids).update(expired_at=get_voted_expiration(0, downvotes))
+    update_cached_expiration(post_ids)
+
+
+# Votes not applied to expiration time yet, upvotes are flushed first
+counters.register(Post, 'expiration_upvotes', apply_upvotes_expiration)
+counters.register(Post, 'expiration_downvotes', apply_downvotes_expiration)
+
+
+def vote_post(posts, post_id: int, user_id: int, is_positive: bool) -> Post or None:
+    """
+    Saves vote of user and changes expiration time of post by fixed count of statements,
+    redis caches and counters are updated in one pipeline.
+
+    If VOTE_COALESCING setting is on, row of post is not locked by vote: votes of post
+    are applied to its expiration time in bulk by flush of counters. Vote rows are saved
+    in both modes, so viewer reads own vote state right after vote.
+
+    :param posts: queryset of posts visible to user
+    :return: voted post or None if post is not visible
+    """
+    from notifications.models import notify_votes_reached
+
+    coalesce = getattr(settings, 'VOTE_COALESCING', False)
+    with transaction.atomic():
+        if coalesce:
+            post = posts.filter(pk=post_id).first()
+            if post is None:
+                return None
+        else:
+            expiration = get_voted_expiration(1, 0) if is_positive else get_voted_expiration(0, 1)
+            if not posts.filter(pk=post_id).update(expired_at=expiration, updated_at=timezone.now()):
+                return None
+
+        created = not PostVote.objects.filter(user=user_id, post=post_id).update(is_positive=is_positive)
+        if created:
+            # Signals of PostVote are not sent, their work is done below
+            try:
+                with transaction.atomic():
+                    PostVote.objects.bulk_create([PostVote(user_id=user_id, post_id=post_id,
+                                                           is_positive=is_positive)])
+            except IntegrityError:
+                created = False  # Concurrent vote of same user
+
+        if not coalesce:
+            post = Post.objects.get(pk=post_id)
+
+    try:
+        with pipeline() as pipe:
+            if created:
+                counters.incr(Post, 'voted_count' if is_positive else 'downvoted_count', [post_id], pipe=pipe)
+                cache_events.emit('post_voted', pipe, post=post_id)
+                User.exclude_post(user_id, post_id, client=pipe)
+
+            if coalesce:
+                field = 'expiration_upvotes' if is_positive else 'expiration_downvotes'
+                counters.incr(Post, field, [post_id], pipe=pipe)
+            else:
+                pipe.execute_command('ZADD', POSTS_EXPIRES_KEY, 'XX', post.expired_at.timestamp(), post_id)
+                update_indexed_expiration(post, pipe)
+                ending_soon.reschedule(post_id, post.expired_at, pipe)
+    except RedisError:
+        logger.exception('Failed to update caches of {} vote for {} post'.format(user_id, post_id))
+
+    if created and is_positive:
+        votes = counters.get_values(Post, 'voted_count', {post_id: post.voted_count})[post_id]
+        notify_votes_reached(post, votes)
+
+    return post
+
+
+def get_media_groups(post: Post) -> List[List[str]]:
+    """Returns groups of storage names deleted together by media collector"""
+    names = post.get_media_names()
+    if post.video:
+        return [names[:-1], names[-1:]]
+
+    return [names]
+
+
+def get_excluding_users(post_ids: List[int]) -> Dict[int, set]:
+    """Returns map of post id to ids of users voted, pinned or hidden post"""
+    result = defaultdict(set)
+    for model in (PostVote, PinnedPosts, User.hidden_posts.through):
+        for post_id, user_id in model.objects.filter(post__in=post_ids).values_list('post_id', 'user_id'):
+            result[post_id].add(user_id)
+
+    return result
+
+
+def update_search_range(user_ids: Iterable[int]):
+    """Sets search range of users by count of their live posts, one update per range"""
+    counts = User.get_posts.store.card_many(set(user_ids))
+
+    ranges = {}
+    for user_id, count in counts.items():
+        ranges.setdefault(min(count, USERS_RANGES_COUNT), []).append(user_id)
+
+    for search_range, ids in ranges.items():
+        User.objects.filter(pk__in=ids).update(search_range=search_range)
+
+
+@cache_event_handler('post_created')
+def apply_posts_created(payloads: List[Dict]):
+    """Adds created posts to user posts, recent posts, home feeds and live posts caches"""
+    store = User.get_posts.store
+    # Recent posts and capped feeds keep latest posts on top
+    posts = sorted(Post.objects.filter(pk__in=[it['post'] for it in payloads]), key=lambda it: (it.created_at, it.pk))
+    if not posts:
+        return
+
+    popularity = get_popularity({it.pk: (it.voted_count, it.downvoted_count) for it in posts})
+    author_ids = {it.user_id for it in posts}
+
+    User.heat_up_posts(author_ids)
+    owners = get_feed_owners_many(author_ids)
+    feeds = set(exists_many(User.redis_feed_key(it) for it in set().union(*owners.values())))
+    indexes = set(exists_many([POSTS_POPULAR_KEY, POSTS_ANONYMOUS_KEY]))
+    authors = User.get_cards(author_ids) if POSTS_POPULAR_KEY in indexes else {}
+
+    # Cold sets are built with these posts on first read
+    with pipeline() as pipe:
+        for post in posts:
+            store.add(post.user_id, popularity[post.pk], post.pk, client=pipe)
+            User.get_recent_posts.push(post.user_id, post.pk, client=pipe)
+
+            score = post.created_at.timestamp()
+            for key in (User.redis_feed_key(it) for it in owners[post.user_id]):
+                if key in feeds:
+                    pipe.zadd(key, score, post.pk)
+                    pipe.zremrangebyrank(key, 0, -USER_FEED_MAX_LENGTH - 1)
+
+            author = authors.get(post.user_id)
+            if author and not author['is_private']:
+                pipe.zadd(POSTS_POPULAR_KEY, popularity[post.pk], post.pk)
+                pipe.zadd(POSTS_EXPIRES_KEY, post.expired_at.timestamp(), post.pk)
+
+            if post.is_anonymous and POSTS_ANONYMOUS_KEY in indexes:
+                pipe.zadd(POSTS_ANONYMOUS_KEY, score, post.pk)
+                pipe.zadd(POSTS_EXPIRES_KEY, post.expired_at.timestamp(), post.pk)
+
+        index_expiration('user', [(it.user_id, it.pk, it.expired_at) for it in posts], client=pipe)
+
+    update_search_range(author_ids)
+    logger.info('Add {} posts of {} users to caches and {} feeds'.format(len(posts), len(author_ids), len(feeds)))
+
+
+@cache_event_handler('post_tagged')
+def apply_posts_tagged(payloads: List[Dict]):
+    """Adds tagged posts to tag posts caches"""
+    store = Tag.get_posts.store
+    posts = list(Post.objects.filter(pk__in=[it['post'] for it in payloads]).prefetch_related('tags'))
+    popularity = get_popularity({it.pk: (it.voted_count, it.downvoted_count) for it in posts})
+    for post in posts:
+        for tag in post.tags.all():
+            if not store.exists(tag.title):
+                Tag.get_posts(tag.title, 0, 1)  # Heat up cache
+
+            store.add(tag.title, popularity[post.pk], post.pk)
+            index_expiration('tag', [(tag.title, post.pk, post.expired_at)])
+
+
+@cache_event_handler('post_voted')
+def apply_posts_voted(payloads: List[Dict]):
+    """Sets popularity of voted posts in "hot" caches"""
+    post_ids = [it['post'] for it in payloads]
+    posts = list(Post.objects.filter(pk__in=post_ids).values_list('pk', 'user_id', 'voted_count', 'downvoted_count'))
+    tags = Post.tags.through.objects.filter(post_id__in=post_ids).values_list('post_id', 'tag_id')
+
+    popularity = get_popularity({it[0]: it[2:4] for it in posts})
+
+    # Updates existing members only
+    with pipeline() as pipe:
+        for pk, user_id, _, _ in posts:
+            User.get_posts.store.add(user_id, popularity[pk], pk, xx=True, client=pipe)
+            pipe.execute_command('ZADD', POSTS_POPULAR_KEY, 'XX', popularity[pk], pk)
+
+        for pk, title in tags:
+            Tag.get_posts.store.add(title, popularity[pk], pk, xx=True, client=pipe)
+
+
+@cache_event_handler('post_deleted')
+def apply_posts_deleted(payloads: List[Dict]):
+    """Removes deleted posts from all caches"""
+    if not payloads:
+        return
+
+    post_ids = [it['post'] for it in payloads]
+    author_ids = {it['user'] for it in payloads}
+    owners = get_feed_owners_many(author_ids)
+
+    # Posts are grouped by feed owner, excluding user and tag
+    feeds, excluded, tags = {}, {}, {}
+    for it in payloads:
+        for user_id in owners[it['user']]:
+            feeds.setdefault(user_id, []).append(it['post'])
+        for user_id in it['excluded_users']:
+            excluded.setdefault(user_id, []).append(it['post'])
+        for tag in it['tags']:
+            tags.setdefault(tag, []).append(it['post'])
+
+    with pipeline() as pipe:
+        members = []
+        for it in payloads:
+            User.get_posts.store.remove(it['user'], it['post'], client=pipe)
+            members.append(get_indexed_member('user', it['user'], it['post']))
+            members.extend(get_indexed_member('tag', tag, it['post']) for tag in it['tags'])
+
+        for tag, ids in tags.items():
+            for post_id in ids:
+                Tag.get_posts.store.remove(tag, post_id, client=pipe)
+
+        for user_id, ids in feeds.items():
+            pipe.zrem(User.redis_feed_key(user_id), *ids)
+
+        for user_id, ids in excluded.items():
+            pipe.zrem(User.redis_excluded_posts_key(user_id), *ids)
+
+        # Capped lists of recent posts are rebuilt on next read
+        pipe.delete(*[USER_RECENT_POSTS_KEY.format(it) for it in author_ids])
+        pipe.zrem(POSTS_INDEXED_EXPIRES_KEY, *members)
+        ending_soon.unschedule(post_ids, client=pipe)
+        remove_from_popular(post_ids, client=pipe)
+
+    update_search_range(author_ids)
+    logger.info('Remove {} posts of {} users from caches'.format(len(post_ids), len(author_ids)))
+
 
 @receiver(pre_delete, sender=Post, dispatch_uid='on_blast_delete')
 def blast_delete_handler(sender, instance: Post, **kwargs):
-    logging.info('pre_delete for {} post'.format(instance.pk))
-    if instance.video:
-        logger.info('Delete {} image of {} post'.format(instance.image, instance.pk))
-        instance.video.delete()
+    logger.info('pre_delete for {} post'.format(instance.pk))
 
-    if instance.image:
-        logger.info('Delete {} video of {} post'.format(instance.image, instance.pk))
-        instance.image.delete()
+    # Files are deleted by collector
+    media_gc.enqueue(get_media_groups(instance))
 
-    # Remove post from user post set.
-    posts_key = User.redis_posts_key(instance.user_id)
-    if r.exists(posts_key):  # If cache is "hot"
-        r.zrem(posts_key, instance.pk)
-        logging.info('Remove {} from {} cache'.format(instance.pk, posts_key))
+    # Updates user popularity
+    counters.incr(User, 'popularity', [instance.user_id], -1)
 
-    # Updates search range
-    search_range = min(r.zcard(posts_key), USERS_RANGES_COUNT)
-    User.objects.filter(pk=instance.user_id).update(search_range=search_range)
+    # Relations are deleted with post, so keep them for post_deleted event
+    instance.deleted_event = {
+        'post': instance.pk,
+        'user': instance.user_id,
+        'excluded_users': sorted(get_excluding_users([instance.pk])[instance.pk]),
+        'tags': sorted(instance.tags.values_list('title', flat=True)),
+    }
 
-    # Updates user popularity
-    User.objects.filter(pk=instance.user_id).update(popularity=F('popularity') - 1)
 
-    # Update user recent posts
-    key = USER_RECENT_POSTS_KEY.format(instance.user_id)
-    r.lrem(key, 1, instance.pk)
+@receiver(post_delete, sender=Post, dispatch_uid='on_blast_deleted')
+def blast_deleted_handler(sender, instance: Post, **kwargs):
+    event = getattr(instance, 'deleted_event', None)
+    if event:
+        cache_events.emit('post_deleted', **event)
 
 
 @receiver(pre_delete, sender=Post, dispatch_uid='post_clear_cache')
 def blast_delete_handle_tags(sender, instance: Post, **kwargs):
     tags = list(instance.tags.all())
     tags = {it.title for it in tags}
-    logging.info('pre_delete: Post. Update tag counters. {}'.format(tags))
-    for it in tags:
-        key = Tag.redis_posts_key(it)
-        logging.info('pre_delete: Post. Update tag {} with key {}'.format(it, key))
-        r.zrem(key, instance.pk)
+    logger.info('pre_delete: Post. Update tag counters. {}'.format(tags))
 
-    try:
-        Tag.objects.filter(title__in=tags).update(total_posts=F('total_posts') - 1)
-    except IntegrityError as e:
-        logger.error('{}'.format(e))
+    counters.incr(Tag, 'total_posts', tags, -1)
 
 
 @receiver(post_save, sender=Post, dispatch_uid='on_blast_save')
@@ -257,24 +718,39 @@ def blast_save_handler(sender, instance: Post, **kwargs):
     if not kwargs['created']:
         return
 
-    # Add post to user post set.
-    posts_key = User.redis_posts_key(instance.user_id)
-    if not r.exists(posts_key):
-        User.get_posts(instance.user_id, 0, 1)  # Heat up cache
+    # Updates user popularity
+    counters.incr(User, 'popularity', [instance.user_id])
 
-    r.zadd(posts_key, 1, instance.pk)
-    logging.info('Add {} to {} cache'.format(instance.pk, posts_key))
+    ending_soon.schedule(instance.pk, instance.expired_at)
 
-    # Updates search popularity
-    search_range = min(r.zcard(posts_key), USERS_RANGES_COUNT)
-    User.objects.filter(pk=instance.user_id).update(search_range=search_range)
+    cache_events.emit('post_created', post=instance.pk)
+
+
+@receiver(post_save, sender=Post, dispatch_uid='post_save_popular')
+def blast_save_popular(sender, instance: Post, created: bool, **kwargs):
+    if created:
+        return
+
+    # Expiration time could be changed
+    if r.zscore(POSTS_EXPIRES_KEY, instance.pk) is not None:
+        r.zadd(POSTS_EXPIRES_KEY, instance.expired_at.timestamp(), instance.pk)
+
+    update_indexed_expiration(instance)
+    ending_soon.reschedule(instance.pk, instance.expired_at)
+
+
+@receiver(post_save, sender=Post, dispatch_uid='post_save_public_responses')
+def blast_save_public_responses(sender, instance: Post, update_fields=None, **kwargs):
+    # Votes and expiration changes are shown by cached public responses after their TTL
+    if update_fields and set(update_fields) <= POST_VOTED_FIELDS:
+        return
+
+    invalidate_public_responses()
 
-    # Updates user popularity
-    User.objects.filter(pk=instance.user_id).update(popularity=F('popularity') + 1)
 
-    # Update user recent posts
-    key = USER_RECENT_POSTS_KEY.format(instance.user_id)
-    r.lpush(key, instance.pk)
+@receiver(post_delete, sender=Post, dispatch_uid='post_delete_public_responses')
+def blast_delete_public_responses(sender, instance: Post, **kwargs):
+    invalidate_public_responses()
 
 
 @receiver(post_save, sender=Post, dispatch_uid='post_create_tags')
@@ -307,11 +783,9 @@ def blast_save_handle_tags(sender, instance: Post, **kwargs):
     instance.tags.add(*db_tags)
 
     # Increase total posts counter
-    for it in db_tags:
-        key = Tag.redis_posts_key(it.title)
-        r.zincrby(key, instance.pk)
+    counters.incr(Tag, 'total_posts', [it.title for it in db_tags])
 
-    Tag.objects.filter(title__in=tags).update(total_posts=F('total_posts') + 1)
+    cache_events.emit('post_tagged', post=instance.pk)
 
 
 @receiver(post_save, sender=PostVote, dispatch_uid='posts_post_save_vote_handler')
@@ -319,21 +793,30 @@ def vote_save(sender, instance: PostVote, created: bool, **kwargs):
     if not created or instance.is_positive is None:
         return
 
-    user_key = User.redis_posts_key(instance.post.user_id)
     if instance.is_positive:
-        r.zincrby(user_key, instance.post_id, 1)  # incr post in redis cache
-        Post.objects.filter(pk=instance.post_id).update(voted_count=F('voted_count') + 1)
+        counters.incr(Post, 'voted_count', [instance.post_id])
         logger.debug('Incremented voted_count {} {}'.format(instance, instance.post_id))
     else:
-        r.zincrby(user_key, instance.post_id, -1)  # incr post in redis cache
-        Post.objects.filter(pk=instance.post_id).update(downvoted_count=F('downvoted_count') + 1)
+        counters.incr(Post, 'downvoted_count', [instance.post_id])
         logger.debug('Decremented voted_count {} {}'.format(instance, instance.post_id))
 
+    # Updates post popularity in caches
+    cache_events.emit('post_voted', post=instance.post_id)
+
     logger.debug('Refreshing post after changing counter')
     # FIXME: Workaround for tests.VoteTest.test_twice_vote
     instance.post.refresh_from_db()
 
 
+@receiver(post_save, sender=PostVote, dispatch_uid='posts_post_save_vote_exclude')
+def vote_exclude_post(sender, instance: PostVote, created: bool, **kwargs):
+    if not created:
+        return
+
+    # Voted posts are not shown in feeds
+    User.exclude_post(instance.user_id, instance.post_id)
+
+
 @receiver(post_save, sender=PostComment, dispatch_uid='blast_comment_notification')
 def blast_comment_notification(sender, instance: PostComment, created, **kwargs):
     from notifications.models import Notification
@@ -1,5 +1,7 @@
+from django.db.models import Count, Manager
 from rest_framework import serializers
 
+from core import counters
 from posts.models import Post, PostComment, PostVote
 
 
@@ -7,19 +9,67 @@ from posts.models import Post, PostComment, PostVote
 from users.models import User
 from users.serializers import UsernameSerializer
 
+
+def prefetch_comments_count(posts: list):
+    """Sets comments count for each post in list by single query"""
+    posts = [it for it in posts if not hasattr(it, '_comments_count')]
+    if not posts:
+        return
+
+    counts = PostComment.objects.filter(post__in={it.pk for it in posts})
+    counts = counts.values('post').annotate(count=Count('pk'))
+    counts = {it['post']: it['count'] for it in counts}
+
+    for it in posts:
+        it._comments_count = counts.get(it.pk, 0)
+
+
+def prefetch_votes(posts: list):
+    """Sets counts of votes with votes not flushed to database yet for each post in list"""
+    posts = [it for it in posts if not hasattr(it, '_votes')]
+    if not posts:
+        return
+
+    voted = counters.get_values(Post, 'voted_count', {it.pk: it.voted_count for it in posts})
+    downvoted = counters.get_values(Post, 'downvoted_count', {it.pk: it.downvoted_count for it in posts})
+
+    for it in posts:
+        it._votes, it._downvotes = voted[it.pk], downvoted[it.pk]
+
+
+class PostListSerializer(serializers.ListSerializer):
+    """Resolves comments and votes counts for whole page of posts"""
+
+    def to_representation(self, data):
+        iterable = data.all() if isinstance(data, Manager) else data
+        posts = list(iterable)
+        prefetch_comments_count(posts)
+        prefetch_votes(posts)
+
+        return super().to_representation(posts)
+
+
 class PostPublicSerializer(serializers.ModelSerializer):
     comments = serializers.ReadOnlyField(source='comments_count')
     image = serializers.SerializerMethodField()
     video = serializers.SerializerMethodField()
 
-    votes = serializers.ReadOnlyField(source='voted_count')
-    downvotes = serializers.ReadOnlyField(source='downvoted_count')
+    votes = serializers.SerializerMethodField()
+    downvotes = serializers.SerializerMethodField()
 
     is_anonymous = serializers.ReadOnlyField(read_only=True)
 
     image_135 = serializers.ImageField()
     image_248 = serializers.ImageField()
 
+    def get_votes(self, instance):
+        prefetch_votes([instance])
+        return instance._votes
+
+    def get_downvotes(self, instance):
+        prefetch_votes([instance])
+        return instance._downvotes
+
     def get_image(self, instance):
         request = self.context.get('request', None)
         if request and instance.image:
@@ -36,6 +86,7 @@ class PostPublicSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Post
+        list_serializer_class = PostListSerializer
         read_only = ('comments', 'votes', 'downvotes', 'is_anonymous')
         exclude = ('tags', 'voted_count', 'downvoted_count',)
 
@@ -3,7 +3,6 @@ from datetime import timedelta
 
 import itertools
 
-import redis
 from django.utils import timezone
 
 from push_notifications.models import APNSDevice
@@ -11,38 +10,54 @@ from push_notifications.models import APNSDevice
 from celery import shared_task
 
 from notifications.models import Notification
-from posts.models import Post, PostVote
+from posts import ending_soon, media_gc
+from posts.expiry import delete_expired_posts
+from posts.models import Post, PostVote, remove_expired_from_popular, remove_expired_from_sets, \
+    schedule_ending_soon
 from users.models import User, PinnedPosts
-
-
-EXPIRE_LIMIT_MINUTES = 10
+from core import counters
+from core.management.commands.warm_up_cache import iter_chunks, WARM_UP_CHUNK_SIZE
+from core.redis_client import pipeline
 
 
 logger = logging.getLogger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 @shared_task(bind=False)
 def clear_expired_posts():
-    posts = Post.objects.expired()
+    # Pending votes can extend lifetime of posts
+    counters.flush()
+    remove_expired_from_popular()
+    delete_expired_posts()
 
-    posts = list(posts)
-    if not len(posts):
-        return
 
-    logger.info('Remove {} expired posts'.format(len(posts)))
+@shared_task(bind=False)
+def collect_media_garbage():
+    media_gc.collect()
 
-    for it in posts:
-        logger.info('Delete {}'.format(it.pk))
-        # TODO: delete file
-        it.delete()
+
+@shared_task(bind=False)
+def prune_expired_posts():
+    remove_expired_from_sets()
+
+
+ENDING_SOON_TYPES = {
+    Notification.TEXT_END_SOON_OWNER: Notification.ENDING_SOON_OWNER,
+    Notification.TEXT_END_SOON_PINNER: Notification.ENDING_SOON_PINNER,
+    Notification.TEXT_END_SOON_UPVOTER: Notification.ENDING_SOON_UPVOTER,
+    Notification.TEXT_END_SOON_DOWNVOTER: Notification.ENDING_SOON_DOWNVOTER,
+}
 
 
 def send_ending_soon_notification(post_id: int, users: set, message: str):
-    send_marker_key = 'EndSoonPUSHSendState:{}:{}'.format(post_id, '{}')
-    logger.info('Ending soon PUSH message candidates %s: %s', post_id, users)
+    notify_type = ENDING_SOON_TYPES.get(message)
+
+    # Post of crashed worker is handed out again, users notified by it are skipped
+    notified = Notification.objects.filter(post_id=post_id, user_id__in=users, type=notify_type)
+    users = set(users) - set(notified.values_list('user_id', flat=True))
+    if not users:
+        return
 
-    users = [it for it in users if not r.exists(send_marker_key.format(it))]
     logger.info('Send ending soon PUSH message to %s: %s', post_id, users)
 
     devices = APNSDevice.objects.filter(user_id__in=users)
@@ -61,16 +76,6 @@ def send_ending_soon_notification(post_id: int, users: set, message: str):
     author_id = Post.objects.get(id=post_id).user_id
     # Create notifications
     try:
-        notify_type = None
-        if message == Notification.TEXT_END_SOON_OWNER:
-            notify_type = Notification.ENDING_SOON_OWNER
-        elif message == Notification.TEXT_END_SOON_PINNER:
-            notify_type = Notification.ENDING_SOON_PINNER
-        elif message == Notification.TEXT_END_SOON_UPVOTER:
-            notify_type = Notification.ENDING_SOON_UPVOTER
-        elif message == Notification.TEXT_END_SOON_DOWNVOTER:
-            notify_type = Notification.ENDING_SOON_DOWNVOTER
-
         logger.info('Creating notifications for %s, %s, notify_type is %s', post_id, users, notify_type)
         notifications = []
         for user_id in users:
@@ -82,17 +87,23 @@ def send_ending_soon_notification(post_id: int, users: set, message: str):
     except Exception:
         logger.exception("Failed to create notifications for %s %s", post_id, users)
 
-    logger.info('Set up ending soon markers for %s %s', post_id, users)
-    for it in users:
-        key = send_marker_key.format(it)
-        r.set(key, '1', ex=60 * (EXPIRE_LIMIT_MINUTES + 1))
 
+def _get_post_for_users_push_list(post_ids: list) -> dict:
+    """
+    Returns lists of users to notify about posts popped from ending soon schedule.
+    Posts whose expiration time was extended after pop are scheduled again.
+    """
+    ending_at = timezone.now() + timedelta(minutes=ending_soon.ENDING_SOON_MINUTES)
+    expired_posts = Post.objects.actual().filter(pk__in=post_ids, is_marked_for_removal=False)
+    expired_posts = list(expired_posts.values('id', 'user_id', 'expired_at'))
+
+    with pipeline() as pipe:
+        for it in expired_posts:
+            if it['expired_at'] > ending_at:
+                ending_soon.schedule(it['id'], it['expired_at'], pipe)
 
-def _get_post_for_users_push_list() -> dict:
-    expired_posts = Post.objects.actual().filter(expired_at__lte=timezone.now() + timedelta(minutes=EXPIRE_LIMIT_MINUTES))
-    expired_posts = expired_posts.filter(is_marked_for_removal=False)
-    expired_posts = expired_posts.values('id', 'user_id')
-    expired_posts = [{'post_id': it['id'], 'user_id': it['user_id']} for it in expired_posts]
+    expired_posts = [{'post_id': it['id'], 'user_id': it['user_id']}
+                     for it in expired_posts if it['expired_at'] <= ending_at]
     expired_ids = {it['post_id'] for it in expired_posts}
     posts = {it['post_id']: it for it in expired_posts}
 
@@ -200,15 +211,31 @@ def send_expire_notifications():
         'downvote': Notification.TEXT_END_SOON_DOWNVOTER
     }
 
-    post_dict = _get_post_for_users_push_list()
-    if not post_dict:
-        return
+    # Each due post is handed to one worker, it is handed out again if worker crashed
+    while True:
+        post_ids = ending_soon.pop_due()
+        if not post_ids:
+            return
+
+        post_dict = _get_post_for_users_push_list(post_ids) or {}
+        if post_dict:
+            logger.info('Sending expired PUSH to %s', post_dict)
 
-    logger.info('Sending expired PUSH to %s', post_dict)
+        for category in post_dict:
+            msg = messages[category]
+            for post_id in post_dict[category]:
+                users = post_dict[category][post_id]
+                logger.info('Sending expired push %s %s %s', category, post_id, users)
+                send_ending_soon_notification(post_id, users, msg)  # TODO: make async
+
+        ending_soon.ack(post_ids)
+
+
+@shared_task(bind=False)
+def schedule_ending_soon_posts():
+    """Schedules live posts missing from ending soon schedule, e.g. after redis flush or eviction"""
+    count = 0
+    for chunk in iter_chunks(Post.objects.actual(), None, WARM_UP_CHUNK_SIZE):
+        count += len(schedule_ending_soon(chunk))
 
-    for category in post_dict:
-        msg = messages[category]
-        for post_id in post_dict[category]:
-            users = post_dict[category][post_id]
-            logger.info('Sending expired push %s %s %s', category, post_id, users)
-            send_ending_soon_notification(post_id, users, msg)  # TODO: make async
+    logger.info('Scheduled ending soon notifications of {} live posts'.format(count))
@@ -1,17 +1,39 @@
 import datetime
+import os
+import time
 
 import itertools
+from io import StringIO
+from unittest import mock
+
+from django.core.files.storage import default_storage
+from django.core.management import call_command
 from django.utils import timezone
 from django.core.urlresolvers import reverse_lazy
-from django.test import TestCase
+from django.db import connection
+from django.db.models import Q
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
 from rest_framework import status
 
-from core.tests import BaseTestCase, create_file
+from core import cache_events, counters
+from core.views import PUBLIC_RESPONSE_VERSION_KEY
+from tags.models import Tag
+from core.tests import BaseTestCase, BaseTestCaseUnauth, create_file
 from countries.models import Country
+from notifications.models import Notification
 from reports.models import Report
-from users.models import User, Follower, UserSettings, PinnedPosts
-from posts.models import Post, PostComment, PostVote
-from posts.tasks import send_expire_notifications, _get_post_for_users_push_list
+from users.models import User, Follower, UserSettings, PinnedPosts, BlockedUsers
+from users.viewer import ViewerContext
+from posts.models import Post, PostComment, PostVote, POSTS_POPULAR_KEY, POSTS_EXPIRES_KEY, \
+    remove_expired_from_popular, remove_expired_from_sets, vote_post
+from posts import ending_soon, media_gc
+from posts import feeds
+from posts.feeds import AnonymousInterleaveMixin, FEED_ANONYMOUS_RATIO, get_ranked_ids
+from posts.serializers import PostPublicSerializer
+from posts.expiry import delete_expired_posts, delete_posts, EXPIRY_PROGRESS_KEY, EXPIRY_LOCK_KEY
+from posts.tasks import send_expire_notifications, _get_post_for_users_push_list, clear_expired_posts, \
+    schedule_ending_soon_posts
 
 
 class AnyPermissionTest(TestCase):
@@ -273,6 +295,51 @@ class CommentTest(BaseTestCase):
             self.assertEqual(results[i]['text'], str(i))
 
 
+class CommentsCursorTest(BaseTestCase):
+    url = reverse_lazy('comment-list')
+    count = 7
+
+    def setUp(self):
+        super().setUp()
+        self.post = Post.objects.create(user=self.user, text='text')
+
+        for i in range(self.count):
+            PostComment.objects.create(post=self.post, user=self.user, text=str(i))
+
+        # Comments with same creation time should not be skipped or duplicated
+        PostComment.objects.all().update(created_at=timezone.now())
+
+    def test_pages(self):
+        ids = []
+        url = self.url + '?page_size=3'
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            pages.append(response.data)
+            ids.extend(it['id'] for it in response.data['results'])
+            url = response.data['next']
+
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(pages[0]['count'], self.count)
+        self.assertNotIn('count', pages[1])
+        self.assertEqual(ids, sorted(ids, reverse=True))
+        self.assertEqual(set(ids), set(PostComment.objects.values_list('id', flat=True)))
+
+        # Goes back from the last page
+        response = self.client.get(pages[-1]['previous'])
+        self.assertEqual(response.data['results'], pages[-2]['results'])
+
+        response = self.client.get(response.data['previous'])
+        self.assertEqual(response.data['results'], pages[0]['results'])
+        self.assertIsNone(response.data['previous'])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(self.url + '?cursor=invalid')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
 class AuthorizedPermissionsTest(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -420,6 +487,79 @@ class VoteTest(BaseTestCase):
         self.post.refresh_from_db()
         self.assertEqual(self.post.voted_count, 1)
 
+    def test_change_vote(self):
+        self.put_json(self.url + 'vote/')
+        response = self.put_json(self.url + 'downvote/')
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        self.assertFalse(PostVote.objects.get(user=self.user, post=self.post).is_positive)
+
+        # Counters are changed by new votes only
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.voted_count, 1)
+        self.assertEqual(self.post.downvoted_count, 0)
+
+    def test_vote_not_visible(self):
+        user = self.generate_user()
+        self.login(user.username)
+
+        response = self.put_json(self.url + 'vote/')
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertFalse(PostVote.objects.filter(post=self.post).exists())
+
+    @mock.patch('core.tasks.apply_cache_events.delay')
+    @mock.patch('core.tasks.flush_counters.apply_async')
+    def test_vote_queries(self, apply_async, delay):
+        voter = self.generate_user()
+        Follower.objects.create(follower=voter, followee=self.user)
+        posts = Post.objects.filter(Q(user__is_private=False) | Q(user__in=[self.user.pk]))
+
+        # Update of post, update and insert of vote, select of post and 2 savepoints
+        with self.assertNumQueries(8):
+            post = vote_post(posts, self.post.pk, voter.pk, True)
+
+        self.assertEqual(post.expired_at, self.expired_at + datetime.timedelta(minutes=5))
+        self.assertEqual(counters.get_pending(Post, 'voted_count', [self.post.pk]), {self.post.pk: 1})
+        self.assertEqual(User.filter_excluded_posts(voter.pk, [self.post.pk]), {self.post.pk})
+
+    @mock.patch('core.tasks.flush_counters.apply_async')
+    def test_pending_votes_read(self, apply_async):
+        counters.incr(Post, 'voted_count', [self.post.pk], 2)
+        counters.incr(Post, 'downvoted_count', [self.post.pk])
+
+        self.assertEqual(PostPublicSerializer(self.post).data['votes'], 2)
+        self.assertEqual(PostPublicSerializer([self.post], many=True).data[0]['downvotes'], 1)
+
+        # Cold caches are built with pending votes
+        User.get_posts.store.delete(self.user.pk)
+        User.get_posts(self.user.pk, 0, -1)
+        self.assertEqual(User.get_posts.store.score(self.user.pk, self.post.pk), 1)
+
+    @override_settings(VOTE_COALESCING=True)
+    @mock.patch('core.tasks.flush_counters.apply_async')
+    def test_coalesced_votes(self, apply_async):
+        posts = Post.objects.all()
+        voters = [self.generate_user() for _ in range(4)]
+
+        with CaptureQueriesContext(connection) as context:
+            for it in voters[:3]:
+                vote_post(posts, self.post.pk, it.pk, True)
+            vote_post(posts, self.post.pk, voters[3].pk, False)
+
+        # Row of post is not locked by votes
+        self.assertFalse([it for it in context.captured_queries if 'UPDATE "posts_post"' in it['sql']])
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.expired_at, self.expired_at)
+
+        # Viewer reads own vote before flush
+        self.assertEqual(ViewerContext(voters[3]).votes([self.post.pk]), {self.post.pk: False})
+
+        counters.flush()
+        self.post.refresh_from_db()
+        self.assertEqual(self.post.voted_count, 3)
+        self.assertEqual(self.post.downvoted_count, 1)
+        self.assertEqual(self.post.expired_at, self.expired_at + datetime.timedelta(minutes=5))
+
 
 class ReportTest(BaseTestCase):
     text = 'report text'
@@ -561,6 +701,464 @@ class FeedsTest(BaseTestCase):
         self.assertNotIn(should_be_hidden[1], response.data['results'])
 
 
+class PostListQueriesTest(BaseTestCase):
+    url = reverse_lazy('post-list')
+
+    def get_queries_count(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        for it in response.data['results']:
+            self.assertEqual(it['comments'], PostComment.objects.filter(post=it['id']).count())
+
+        return len(context.captured_queries)
+
+    def create_posts(self, count):
+        for it in range(count):
+            post = Post.objects.create(user=self.user, text='text')
+            PostComment.objects.create(post=post, user=self.user, text='comment')
+
+    def test_comments_count_queries(self):
+        self.create_posts(2)
+        self.get_queries_count()  # Heat up author cards
+
+        count = self.get_queries_count()
+
+        self.create_posts(5)
+        self.assertEqual(self.get_queries_count(), count)
+
+    def test_authors_serialized_once(self):
+        other = self.generate_user('other')
+        for it in range(3):
+            Post.objects.create(user=self.user, text='text')
+            Post.objects.create(user=other, text='text')
+
+        with mock.patch.object(User, 'card', autospec=True, side_effect=User.card) as card:
+            response = self.client.get(self.url)
+
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(response.data['results']), 6)
+        self.assertEqual(card.call_count, 2)
+
+        # Cards are cached for next requests
+        with mock.patch.object(User, 'card', autospec=True, side_effect=User.card) as card:
+            self.client.get(self.url)
+
+        self.assertEqual(card.call_count, 0)
+        for it in response.data['results']:
+            self.assertEqual(it['author']['id'], it['user'])
+
+
+class PublicResponseCacheTest(BaseTestCaseUnauth):
+    url = reverse_lazy('post-list')
+
+    def test_conditional_get(self):
+        post = Post.objects.create(user=self.user, text='text')
+
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        etag = response['ETag']
+
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(self.url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+            self.assertEqual(response['ETag'], etag)
+            self.assertEqual([it['id'] for it in response.data['results']], [post.pk])
+
+            response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+            self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        self.assertEqual(len(context), 0)
+
+    def test_invalidate_on_create(self):
+        response = self.client.get(self.url)
+        etag = response['ETag']
+
+        post = Post.objects.create(user=self.user, text='text')
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual([it['id'] for it in response.data['results']], [post.pk])
+
+    def test_etag_list(self):
+        Post.objects.create(user=self.user, text='text')
+        etag = self.client.get(self.url)['ETag']
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"other", W/{}'.format(etag))
+        self.assertEqual(response.status_code, status.HTTP_304_NOT_MODIFIED)
+
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH='"x{}"'.format(etag.strip('"')))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+    def test_vote_keeps_cache(self):
+        post = Post.objects.create(user=self.user, text='text')
+        voter = self.generate_user()
+        version = self.r.get(PUBLIC_RESPONSE_VERSION_KEY)
+
+        vote_post(Post.objects.all(), post.pk, voter.pk, True)
+        self.assertEqual(self.r.get(PUBLIC_RESPONSE_VERSION_KEY), version)
+
+
+class HomeFeedTest(BaseTestCase):
+    url = reverse_lazy('feed-first-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.followee = self.generate_user('followee')
+        self.other = self.generate_user('other')
+
+        Follower.objects.create(follower=self.user, followee=self.followee)
+
+    def test_feed_fan_out(self):
+        own = Post.objects.create(user=self.user, text='own')
+
+        # Heat up home feed
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual([it['id'] for it in response.data['results']], [own.pk])
+
+        key = User.redis_feed_key(self.user.pk)
+        self.assertTrue(self.r.exists(key))
+
+        followee_post = Post.objects.create(user=self.followee, text='followee')
+        Post.objects.create(user=self.other, text='other')
+        Post.objects.create(text='anonymous')
+
+        self.assertEqual(self.r.zcard(key), 2)
+
+        response = self.client.get(self.url)
+        ids = [it['id'] for it in response.data['results']]
+        self.assertEqual(ids, [followee_post.pk, own.pk])
+
+    def test_feed_prune_deleted(self):
+        post = Post.objects.create(user=self.followee, text='followee')
+
+        key = User.redis_feed_key(self.user.pk)
+        User.get_feed(self.user.pk, 0, 1)  # Heat up cache
+        self.assertEqual(self.r.zcard(key), 1)
+
+        post.delete()
+
+        self.assertEqual(self.r.zcard(key), 0)
+
+    def test_feed_unfollow(self):
+        Post.objects.create(user=self.followee, text='followee')
+        User.get_feed(self.user.pk, 0, 1)  # Heat up cache
+
+        Follower.objects.filter(follower=self.user, followee=self.followee).delete()
+
+        response = self.client.get(self.url)
+        self.assertEqual(len(response.data['results']), 0)
+
+
+class FeedExclusionsTest(BaseTestCase):
+    url = reverse_lazy('feed-second-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.other = self.generate_user('other')
+        self.posts = [Post.objects.create(user=self.other) for it in range(5)]
+
+        self.key = User.redis_excluded_posts_key(self.user.pk)
+
+    def get_ids(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return {it['id'] for it in response.data['results']}
+
+    def test_incremental_exclusions(self):
+        PostVote.objects.create(user=self.user, post=self.posts[0], is_positive=True)
+        self.assertNotIn(self.posts[0].pk, self.get_ids())
+        self.assertTrue(self.r.exists(self.key))
+
+        # Cache is hot and updated by handlers
+        PostVote.objects.create(user=self.user, post=self.posts[1], is_positive=False)
+        PinnedPosts.objects.create(user=self.user, post=self.posts[2])
+        self.user.hidden_posts.add(self.posts[3])
+
+        self.assertEqual(self.r.zcard(self.key), 5)  # With sentinel member
+        self.assertEqual(self.get_ids(), {self.posts[4].pk})
+
+    def test_empty_exclusions(self):
+        self.assertEqual(len(self.get_ids()), len(self.posts))
+        self.assertTrue(self.r.exists(self.key))
+
+        with self.assertNumQueries(0):
+            self.assertEqual(User.filter_excluded_posts(self.user.pk, [it.pk for it in self.posts]), set())
+
+    def test_unpin_and_show(self):
+        PinnedPosts.objects.create(user=self.user, post=self.posts[0])
+        self.user.hidden_posts.add(self.posts[1])
+        self.assertEqual(self.get_ids(), {it.pk for it in self.posts[2:]})
+
+        PinnedPosts.objects.filter(user=self.user, post=self.posts[0]).delete()
+        self.user.hidden_posts.remove(self.posts[1])
+
+        self.assertEqual(self.get_ids(), {it.pk for it in self.posts})
+
+    def test_blocked_user(self):
+        self.assertEqual(len(self.get_ids()), len(self.posts))
+
+        BlockedUsers.objects.create(user=self.user, blocked=self.other)
+        self.assertEqual(self.get_ids(), set())
+
+        BlockedUsers.objects.filter(user=self.user, blocked=self.other).delete()
+        self.assertEqual(len(self.get_ids()), len(self.posts))
+
+
+class PopularFeedTest(BaseTestCase):
+    url = reverse_lazy('feed-second-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.other = self.generate_user('other')
+        self.voter = self.generate_user('voter')
+        self.posts = [Post.objects.create(user=self.other) for it in range(3)]
+
+    def get_ids(self):
+        response = self.client.get(self.url)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return [it['id'] for it in response.data['results']]
+
+    def vote(self, post, is_positive=True):
+        user = self.generate_user()
+        PostVote.objects.create(user=user, post=post, is_positive=is_positive)
+
+    def test_popularity_order(self):
+        self.vote(self.posts[1])
+        self.vote(self.posts[0], False)
+        self.assertEqual(self.get_ids(), [self.posts[1].pk, self.posts[2].pk, self.posts[0].pk])
+
+        # Index is hot and updated by vote handler
+        for it in range(3):
+            self.vote(self.posts[0])
+        self.assertEqual(self.r.zscore(POSTS_POPULAR_KEY, self.posts[0].pk), 2)
+        self.assertEqual(self.get_ids()[0], self.posts[0].pk)
+
+    def test_exclude_own_and_followees(self):
+        own = Post.objects.create(user=self.user)
+        anonymous = Post.objects.create(text='anonymous')
+
+        Follower.objects.create(follower=self.user, followee=self.other)
+        self.assertEqual(set(self.get_ids()), set())
+
+    def test_cursor(self):
+        for it in range(3):
+            self.vote(self.posts[it])
+        self.vote(self.posts[2])
+
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual([it['id'] for it in response.data['results']], [self.posts[2].pk, self.posts[1].pk])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([it['id'] for it in response.data['results']], [self.posts[0].pk])
+
+    def test_cursor_post_gone(self):
+        self.get_ids()  # Heat up index
+        ids = [int(it) for it in self.r.zrevrange(POSTS_POPULAR_KEY, 0, -1)]
+
+        # Cursor post has gone from index, posts tied at its score are not skipped
+        response = self.client.get(self.url, {'page_size': 2})
+        self.assertEqual([it['id'] for it in response.data['results']], ids[:2])
+        self.r.zrem(POSTS_POPULAR_KEY, ids[1])
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual([it['id'] for it in response.data['results']], ids[2:])
+        self.assertEqual(get_ranked_ids(POSTS_POPULAR_KEY, (0, ids[1]), 5, True), ids[:1])
+
+    def test_chunk_post_pruned(self):
+        self.posts += [Post.objects.create(user=self.other) for it in range(3)]
+        self.get_ids()  # Heat up index
+        ids = [int(it) for it in self.r.zrevrange(POSTS_POPULAR_KEY, 0, -1)]
+
+        # First chunk is expired and its last post is pruned before the next chunk is read
+        Post.objects.filter(pk__in=ids[:3]).update(expired_at=timezone.now() - datetime.timedelta(minutes=1))
+        get_popular_ids = feeds.get_popular_ids
+
+        def get_pruned_ids(*args, **kwargs):
+            items = get_popular_ids(*args, **kwargs)
+            self.r.zrem(POSTS_POPULAR_KEY, ids[2])
+            return items
+
+        with mock.patch('posts.feeds.get_popular_ids', get_pruned_ids):
+            response = self.client.get(self.url, {'page_size': 2})
+
+        self.assertEqual([it['id'] for it in response.data['results']], ids[3:5])
+        self.assertIsNotNone(response.data['next'])
+
+    def test_remove_expired(self):
+        self.get_ids()  # Heat up index
+
+        Post.objects.filter(pk=self.posts[0].pk).update(expired_at=timezone.now())
+        self.r.zadd(POSTS_EXPIRES_KEY, timezone.now().timestamp(), self.posts[0].pk)
+        remove_expired_from_popular()
+
+        self.assertIsNone(self.r.zscore(POSTS_POPULAR_KEY, self.posts[0].pk))
+        self.assertEqual(set(self.get_ids()), {it.pk for it in self.posts[1:]})
+
+
+class CacheEventsTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.post = Post.objects.create(user=self.user)
+        PostVote.objects.create(user=self.generate_user(), post=self.post, is_positive=True)
+
+    def test_replay_created(self):
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        cache_events.apply_events([['post_created', {'post': self.post.pk}]] * 2)
+
+        self.assertEqual(User.get_recent_posts(self.user.pk, 0, -1), [self.post.pk])
+        self.assertEqual(User.get_posts.store.score(self.user.pk, self.post.pk), 1)
+        self.assertEqual(User.objects.get(pk=self.user.pk).search_range, 1)
+
+    def test_batch_created(self):
+        follower = self.generate_user('follower')
+        Follower.objects.create(follower=follower, followee=self.user)
+        User.get_feed(follower.pk, 0, -1)  # Heat up caches
+        User.get_recent_posts(self.user.pk, 0, -1)
+
+        # Signals are not sent by bulk create
+        Post.objects.bulk_create([Post(user=self.user, text='first'), Post(user=self.user, text='second')])
+        posts = list(Post.objects.filter(text__in=['first', 'second']).order_by('-pk').values_list('pk', flat=True))
+        cache_events.apply_events([['post_created', {'post': it}] for it in posts])
+
+        expected = posts + [self.post.pk]
+        self.assertEqual(User.get_recent_posts(self.user.pk, 0, -1), expected)
+        self.assertEqual([int(it) for it in self.r.zrevrange(User.redis_feed_key(follower.pk), 0, -1)], expected)
+        self.assertEqual(User.get_posts.store.card(self.user.pk), 3)
+        self.assertEqual(User.objects.get(pk=self.user.pk).search_range, 3)
+
+    def test_replay_voted(self):
+        self.r.zadd(POSTS_POPULAR_KEY, 0, self.post.pk)
+        cache_events.apply_events([['post_voted', {'post': self.post.pk}]])
+        cache_events.apply_events([['post_voted', {'post': self.post.pk}]])
+
+        # Score is set from database instead of incremented
+        self.assertEqual(self.r.zscore(POSTS_POPULAR_KEY, self.post.pk), 1)
+
+    def test_deleted(self):
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        self.post.delete()
+
+        self.assertIsNone(User.get_posts.store.score(self.user.pk, self.post.pk))
+        self.assertIsNone(self.r.zscore(POSTS_POPULAR_KEY, self.post.pk))
+
+
+class PruneExpiredPostsTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.post = Post.objects.create(user=self.user, text='#summer')
+        self.other = Post.objects.create(user=self.user, text='#summer')
+
+    def test_prune(self):
+        self.assertEqual(set(User.get_posts(self.user.pk, 0, -1)), {self.post.pk, self.other.pk})
+        self.assertEqual(set(Tag.get_posts('summer', 0, -1)), {self.post.pk, self.other.pk})
+
+        self.post.expired_at = timezone.now() - datetime.timedelta(minutes=1)
+        self.post.save()
+
+        self.assertEqual(remove_expired_from_sets(batch_size=1), 2)
+        self.assertEqual(User.get_posts(self.user.pk, 0, -1), [self.other.pk])
+        self.assertEqual(Tag.get_posts('summer', 0, -1), [self.other.pk])
+        self.assertEqual(remove_expired_from_sets(), 0)
+
+    def test_check_post_sets(self):
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        Tag.get_posts('summer', 0, -1)
+
+        # Row removed without signals
+        Post.objects.filter(pk=self.post.pk).update(expired_at=timezone.now() - datetime.timedelta(minutes=1))
+
+        out = StringIO()
+        call_command('check_post_sets', stdout=out)
+        self.assertIn('users: 1 checked, 1 drifted, 1 stale posts, 0 missing posts', out.getvalue())
+        self.assertIn('tags: 1 checked, 1 drifted, 1 stale posts, 0 missing posts', out.getvalue())
+
+        call_command('check_post_sets', repair=True, stdout=StringIO())
+        self.assertEqual(User.get_posts(self.user.pk, 0, -1), [self.other.pk])
+        self.assertEqual(Tag.get_posts('summer', 0, -1), [self.other.pk])
+
+    def test_check_post_sets_expired(self):
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        Tag.get_posts('summer', 0, -1)
+
+        # Expired post is not pruned from sets yet
+        self.post.expired_at = timezone.now() - datetime.timedelta(minutes=1)
+        self.post.save()
+
+        out = StringIO()
+        call_command('check_post_sets', stdout=out)
+        self.assertIn('users: 1 checked, 0 drifted, 0 stale posts, 0 missing posts', out.getvalue())
+        self.assertIn('tags: 1 checked, 0 drifted, 0 stale posts, 0 missing posts', out.getvalue())
+
+
+class AnonymousInterleaveTest(BaseTestCase):
+    url = reverse_lazy('feed-first-list')
+
+    def setUp(self):
+        super().setUp()
+
+        self.followee = self.generate_user('followee')
+        Follower.objects.create(follower=self.user, followee=self.followee)
+
+        self.anonymous_posts = [Post.objects.create(text='anonymous') for it in range(3)]
+        self.anonymous_posts.reverse()
+        self.posts = [Post.objects.create(user=self.followee) for it in range(18)]
+        self.posts.reverse()
+
+    def get_page(self, url, data=None):
+        response = self.client.get(url, data)
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        return [it['id'] for it in response.data['results']], response.data
+
+    @mock.patch.object(AnonymousInterleaveMixin, 'get_anonymous_offset', return_value=8)
+    def test_interleave(self, get_anonymous_offset):
+        first, data = self.get_page(self.url, {'page_size': 10})
+        self.assertEqual(first, [it.pk for it in self.posts[:9]] + [self.anonymous_posts[0].pk])
+
+        second, data = self.get_page(data['next'])
+        self.assertEqual(second, [it.pk for it in self.posts[9:]] + [self.anonymous_posts[1].pk])
+
+        # Previous page is the same
+        previous, _ = self.get_page(data['previous'])
+        self.assertEqual(previous, first)
+
+    def test_skip_excluded(self):
+        self.user.hidden_posts.add(self.anonymous_posts[0])
+
+        first, data = self.get_page(self.url, {'page_size': 10})
+        self.assertEqual(first, [it.pk for it in self.posts[:9]])
+
+        second, data = self.get_page(data['next'])
+        self.assertIn(self.anonymous_posts[1].pk, second)
+
+    def test_random_positions(self):
+        first, data = self.get_page(self.url, {'page_size': 10})
+        second, data = self.get_page(data['next'])
+        self.assertEqual(len(first), 10)
+        self.assertEqual([it for it in first + second if it not in {it.pk for it in self.anonymous_posts}],
+                         [it.pk for it in self.posts])
+
+        # First page is the same on each request
+        self.assertEqual(self.get_page(self.url, {'page_size': 10})[0], first)
+
+        # Positions are kept by cursors
+        previous, _ = self.get_page(data['previous'])
+        self.assertEqual(previous, first)
+        offsets = {AnonymousInterleaveMixin().get_anonymous_offset(seed, 1) for seed in range(100)}
+        self.assertEqual(offsets, set(range(FEED_ANONYMOUS_RATIO - 1)))
+
+
 class VotersList(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -584,12 +1182,144 @@ class VotersList(BaseTestCase):
         response = self.client.get(url)
 
         self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertEqual(response.data['count'], 3)
         self.assertEqual(len(response.data['results']), 3)
         # TODO: Improve and check user[0]
         self.assertEqual(response.data['results'][1]['username'], '1')
         self.assertEqual(response.data['results'][1]['is_followee'], True)
 
 
+class ClearExpiredPostsTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        self.other = self.generate_user('other')
+        self.posts = [Post.objects.create(user=self.user, text='#summer') for _ in range(3)]
+        self.live = Post.objects.create(user=self.user, text='#summer')
+
+        for post in self.posts:
+            PostVote.objects.create(user=self.other, post=post, is_positive=True)
+            PinnedPosts.objects.create(user=self.other, post=post)
+            comment = PostComment.objects.create(user=self.other, post=post, text='comment')
+            PostComment.objects.create(user=self.user, post=post, parent=comment, text='reply')
+
+        expired_at = timezone.now() - datetime.timedelta(minutes=1)
+        Post.objects.filter(pk__in=[it.pk for it in self.posts]).update(expired_at=expired_at)
+        counters.flush()
+
+    def test_clear(self):
+        User.get_posts(self.user.pk, 0, -1)  # Heat up cache
+        popularity = User.objects.get(pk=self.user.pk).popularity
+
+        clear_expired_posts()
+
+        self.assertEqual(list(Post.objects.values_list('pk', flat=True)), [self.live.pk])
+        self.assertFalse(PostComment.objects.exists())
+        self.assertFalse(PinnedPosts.objects.exists())
+        self.assertEqual(PostVote.objects.count(), 0)
+
+        self.assertEqual(User.objects.get(pk=self.user.pk).popularity, popularity - 3)
+        self.assertEqual(Tag.objects.get(title='summer').total_posts, 1)
+        self.assertEqual(User.get_posts(self.user.pk, 0, -1), [self.live.pk])
+        self.assertFalse(self.r.exists(EXPIRY_PROGRESS_KEY))
+
+    def test_resume(self):
+        self.r.hset(EXPIRY_PROGRESS_KEY, 'last_pk', self.posts[0].pk)
+
+        self.assertEqual(delete_expired_posts(chunk_size=1), 2)
+        self.assertTrue(Post.objects.filter(pk=self.posts[0].pk).exists())
+
+        # Next run starts from beginning
+        self.assertEqual(delete_expired_posts(), 1)
+        self.assertEqual(list(Post.objects.values_list('pk', flat=True)), [self.live.pk])
+
+    def test_locked(self):
+        self.r.set(EXPIRY_LOCK_KEY, 1)
+        self.assertEqual(delete_expired_posts(), 0)
+        self.assertEqual(Post.objects.count(), 4)
+
+    def test_expired_lock_kept(self):
+        def delete_posts(post_ids):
+            # Lock expired and taken by other worker
+            self.r.set(EXPIRY_LOCK_KEY, 'other')
+            return 0
+
+        with mock.patch('posts.expiry.delete_posts', delete_posts):
+            delete_expired_posts()
+
+        self.assertEqual(self.r.get(EXPIRY_LOCK_KEY), b'other')
+
+    def test_redis_after_commit(self):
+        def get_popularity():
+            popularity = User.objects.get(pk=self.user.pk).popularity
+            return counters.get_values(User, 'popularity', {self.user.pk: popularity})[self.user.pk]
+
+        popularity = get_popularity()
+        callbacks = []
+        with mock.patch('django.db.transaction.on_commit', callbacks.append):
+            self.assertEqual(delete_posts([self.posts[0].pk]), 1)
+
+        self.assertFalse(Post.objects.filter(pk=self.posts[0].pk).exists())
+        self.assertEqual(get_popularity(), popularity)
+
+        for callback in callbacks:
+            callback()
+        self.assertEqual(get_popularity(), popularity - 1)
+
+
+class MediaGCTest(BaseTestCase):
+    def setUp(self):
+        super().setUp()
+
+        # Specs are saved to their names instead of generating
+        image = default_storage.save('user/images/test.png', create_file('test.png'))
+        self.post = Post.objects.create(user=self.user, text='text')
+        Post.objects.filter(pk=self.post.pk).update(image=image)
+        self.post = Post.objects.get(pk=self.post.pk)
+
+        self.names = self.post.get_media_names()
+        for name in self.names[1:]:
+            default_storage.save(name, create_file('test.png'))
+
+    def test_collect(self):
+        self.post.delete()
+
+        # Collector scheduled by delete skips files of not committed post
+        self.assertTrue(all(default_storage.exists(it) for it in self.names))
+
+        self.assertEqual(media_gc.collect(), 3)
+        self.assertFalse(any(default_storage.exists(it) for it in self.names))
+        self.assertFalse(os.path.exists(os.path.dirname(default_storage.path(self.names[1]))))
+        self.assertFalse(self.r.exists(media_gc.MEDIA_GC_KEY))
+        self.assertFalse(self.r.exists(media_gc.MEDIA_GC_RETRIES_KEY))
+
+    def test_give_up(self):
+        with mock.patch.object(default_storage, 'delete', side_effect=OSError):
+            self.post.delete()
+            for _ in range(media_gc.MEDIA_GC_MAX_RETRIES - 2):
+                media_gc.collect()
+            self.assertEqual(self.r.scard(media_gc.MEDIA_GC_KEY), 1)
+
+            media_gc.collect()
+
+        self.assertFalse(self.r.exists(media_gc.MEDIA_GC_KEY))
+        self.assertFalse(self.r.exists(media_gc.MEDIA_GC_RETRIES_KEY))
+        self.assertTrue(all(default_storage.exists(it) for it in self.names))
+
+    def test_orphans(self):
+        orphan = default_storage.save('user/videos/orphan.mp4', create_file('orphan.mp4'))
+        call_command('scan_media_orphans', '--enqueue', stdout=StringIO())
+        self.assertFalse(self.r.exists(media_gc.MEDIA_GC_KEY))  # Too recent
+
+        modified = time.time() - 2 * media_gc.MEDIA_GC_ORPHAN_MIN_AGE.total_seconds()
+        os.utime(default_storage.path(orphan), (modified, modified))
+        self.assertEqual(list(media_gc.iter_orphans()), [orphan])
+
+        call_command('scan_media_orphans', '--enqueue', stdout=StringIO())
+        self.assertFalse(default_storage.exists(orphan))
+        self.assertTrue(all(default_storage.exists(it) for it in self.names))
+
+
 class ExpiredNotificationsTest(BaseTestCase):
     def setUp(self):
         super().setUp()
@@ -639,7 +1369,7 @@ class ExpiredNotificationsTest(BaseTestCase):
             }
         }
 
-        result = _get_post_for_users_push_list()
+        result = _get_post_for_users_push_list(ending_soon.pop_due())
 
         self.assertEqual(result, should_be)
 
@@ -650,7 +1380,7 @@ class ExpiredNotificationsTest(BaseTestCase):
 
         PinnedPosts.objects.create(user=self.user1, post=post)
 
-        result = _get_post_for_users_push_list()
+        result = _get_post_for_users_push_list(ending_soon.pop_due())
 
         should_be = {
             'owner': {post.pk: {self.user.pk}},
@@ -660,3 +1390,63 @@ class ExpiredNotificationsTest(BaseTestCase):
         }
 
         self.assertEqual(result, should_be)
+
+    def test_notified_once(self):
+        post = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=5))
+        PinnedPosts.objects.create(user=self.user1, post=post)
+
+        send_expire_notifications()
+        send_expire_notifications()
+
+        notifications = Notification.objects.filter(post=post).values_list('user_id', 'type')
+        self.assertEqual(sorted(notifications), [(self.user.pk, Notification.ENDING_SOON_OWNER),
+                                                 (self.user1.pk, Notification.ENDING_SOON_PINNER)])
+
+    def test_vote_moves_schedule(self):
+        post = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=15))
+        self.assertEqual(ending_soon.pop_due(), [])
+
+        vote_post(Post.objects.all(), post.pk, self.user1.pk, False)
+        self.assertEqual(ending_soon.pop_due(), [post.pk])
+
+        # Processed post is not scheduled by votes
+        vote_post(Post.objects.all(), post.pk, self.user2.pk, True)
+        self.assertIsNone(self.r.zscore(ending_soon.ENDING_SOON_KEY, post.pk))
+
+    def test_extended_after_pop(self):
+        post = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=5))
+        post_ids = ending_soon.pop_due()
+
+        Post.objects.filter(pk=post.pk).update(expired_at=timezone.now() + datetime.timedelta(minutes=30))
+
+        self.assertIsNone(_get_post_for_users_push_list(post_ids))
+        self.assertIsNotNone(self.r.zscore(ending_soon.ENDING_SOON_KEY, post.pk))
+
+    def test_crashed_worker(self):
+        post = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=5))
+        PinnedPosts.objects.create(user=self.user1, post=post)
+
+        # Worker crashed after sending of part of notifications
+        self.assertEqual(ending_soon.pop_due(), [post.pk])
+        Notification.objects.create(user=self.user, post=post, type=Notification.ENDING_SOON_OWNER)
+        self.assertEqual(ending_soon.pop_due(), [])
+
+        # Post is handed out again after visibility timeout
+        self.r.zadd(ending_soon.ENDING_SOON_PROCESSING_KEY, timezone.now().timestamp() - 1, post.pk)
+        send_expire_notifications()
+
+        notifications = Notification.objects.filter(post=post).values_list('user_id', 'type')
+        self.assertEqual(sorted(notifications), [(self.user.pk, Notification.ENDING_SOON_OWNER),
+                                                 (self.user1.pk, Notification.ENDING_SOON_PINNER)])
+        self.assertEqual(self.r.zcard(ending_soon.ENDING_SOON_PROCESSING_KEY), 0)
+
+    def test_rebuild_schedule(self):
+        post1 = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=30))
+        post2 = Post.objects.create(user=self.user, expired_at=timezone.now() + datetime.timedelta(minutes=5))
+        self.r.delete(ending_soon.ENDING_SOON_KEY)
+
+        schedule_ending_soon_posts()
+
+        # Posts ending soon already were processed or are being processed
+        self.assertIsNotNone(self.r.zscore(ending_soon.ENDING_SOON_KEY, post1.pk))
+        self.assertIsNone(self.r.zscore(ending_soon.ENDING_SOON_KEY, post2.pk))
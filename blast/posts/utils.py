@@ -1,11 +1,19 @@
-from typing import List, Dict
+from typing import List, Dict, Iterable
 
-from posts.models import PostVote
 from users.models import User
+from users.viewer import ViewerContext, as_viewer
 
 
 # TODO: It uses in PostComment.list method and should be refactored.
-from users.serializers import OwnerSerializer
+from users.serializers import get_author_cards
+
+
+def serialize_authors(user_ids: Iterable[int], request) -> Dict[int, Dict]:
+    """
+    Builds each of authors once from cached user cards
+    :return: dictionary of user id to serialized author
+    """
+    return get_author_cards(user_ids, request)
 
 
 def attach_users(items: List[Dict], user: User, request):
@@ -17,27 +25,20 @@ def attach_users(items: List[Dict], user: User, request):
     if not items:
         return items
 
-    users = {it['user'] for it in items if it['user']}
-    users = User.objects.filter(pk__in=users)
-    users = {it.pk: it for it in users}
-
-    context = {'request': request}
+    authors = serialize_authors((it['user'] for it in items), request)
     for post in items:
-        user = users[post['user']]
-        author = OwnerSerializer(instance=user, context=context).data
-
-        post['author'] = author
+        author = authors.get(post['user'])
+        post['author'] = dict(author) if author else None
 
     return items
 
 
-def mark_voted(posts: List, user: User):
-    if user.is_anonymous() or len(posts) == 0:
+def mark_voted(posts: List, viewer: ViewerContext or User):
+    viewer = as_viewer(viewer)
+    if not viewer.is_authenticated() or len(posts) == 0:
         return posts
 
-    ids = {it['id'] for it in posts}
-    votes = list(PostVote.objects.filter(post_id__in=ids, user=user))
-    votes = {it.post_id: it.is_positive for it in votes}
+    votes = viewer.votes({it['id'] for it in posts})
 
     for post in posts:
         pk = post['id']
@@ -47,18 +48,17 @@ def mark_voted(posts: List, user: User):
     return posts
 
 
-def mark_pinned(posts: list, user: User):
+def mark_pinned(posts: list, viewer: ViewerContext or User):
     # TODO (VM): Make test
     """
     Adds is_pinned flag to each post dictionary in posts list
     :return: modified list of posts
     """
-    if user.is_anonymous() or len(posts) == 0:
+    viewer = as_viewer(viewer)
+    if not viewer.is_authenticated() or len(posts) == 0:
         return posts
 
-    ids = [it['id'] for it in posts]
-    pinned = user.pinned_posts.filter(id__in=ids).values('id')
-    pinned = [it['id'] for it in pinned]
+    pinned = viewer.pinned({it['id'] for it in posts})
 
     for post in posts:
         if post['id'] in pinned:
@@ -69,14 +69,33 @@ def mark_pinned(posts: list, user: User):
     return posts
 
 
-def extend_posts(posts: list, user: User, request):
+def extend_posts(posts: list, viewer: ViewerContext or User, request):
     """
-    Adds additional information to raw posts
+    Adds author, is_pinned, is_upvoted and is_downvoted fields to raw posts
     :param posts: list of dictionaries
     :return: modified posts list
     """
-    data = mark_pinned(posts, user)
-    data = attach_users(data, user, request)
-    data = mark_voted(posts, user)
+    if not posts:
+        return posts
+
+    viewer = as_viewer(viewer)
 
-    return data
\ No newline at end of file
+    post_ids = {it['id'] for it in posts}
+    authors = serialize_authors((it['user'] for it in posts), request)
+
+    pinned, votes = set(), {}
+    if viewer.is_authenticated():
+        pinned = viewer.pinned(post_ids)
+        votes = viewer.votes(post_ids)
+
+    for post in posts:
+        pk = post['id']
+        author = authors.get(post['user'])
+        post['author'] = dict(author) if author else None
+
+        if viewer.is_authenticated():
+            post['is_pinned'] = pk in pinned
+            post['is_upvoted'] = votes.get(pk) is True
+            post['is_downvoted'] = votes.get(pk) is False
+
+    return posts
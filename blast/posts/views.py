@@ -1,4 +1,3 @@
-import redis
 from django.contrib.contenttypes.models import ContentType
 from django.db.models import Q
 from django.http import Http404
@@ -10,28 +9,27 @@ from rest_framework import viewsets, mixins, permissions, status, generics
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 
-from core.views import ExtendableModelMixin
+from core.pagination import CountedCursorPaginator
+from core.views import ExtendableModelMixin, PublicResponseCacheMixin
 
-from posts.models import Post, PostComment, PostVote
+from posts.models import Post, PostComment, PostVote, vote_post
 from posts.serializers import (PostSerializer, PostPublicSerializer,
                                CommentSerializer, CommentPublicSerializer,
                                VoteSerializer, VotePublicSerializer)
 
-from datetime import timedelta
-
 from notifications.tasks import send_share_notifications
 
 from reports.serializers import ReportSerializer
 from tags.models import Tag
 from users.models import User, Follower, BlockedUsers, PinnedPosts
 
-from users.serializers import UsernameSerializer
+from users.serializers import UsernameSerializer, get_author_cards
 
 from posts.utils import attach_users, extend_posts
 from users.utils import mark_followee
 from users.utils import mark_requested
+from users.viewer import get_viewer
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 
 # FIXME: Replace by custom permission class
@@ -64,6 +62,7 @@ class PerObjectPermissionMixin(object):
 
 
 class PostsViewSet(PerObjectPermissionMixin,
+                   PublicResponseCacheMixin,
                    ExtendableModelMixin,
                    viewsets.ModelViewSet):
     """
@@ -110,14 +109,13 @@ class PostsViewSet(PerObjectPermissionMixin,
     filter_fields = ('user', 'tags',)
 
     def extend_response_data(self, data):
-        extend_posts(data, self.request.user, self.request)
+        extend_posts(data, get_viewer(self.request), self.request)
 
     def get_queryset(self):
         if not self.request.user.is_authenticated():
             return self.queryset.filter(user__is_private=False)
 
-        followees = Follower.objects.filter(follower=self.request.user.pk)
-        followees = {it.followee_id for it in followees}
+        followees = Follower.objects.filter(follower=self.request.user.pk).values('followee')
 
         qs = Post.objects.actual()
         qs = qs.filter(Q(user__is_private=False) | Q(user=None) |
@@ -135,7 +133,7 @@ class PostsViewSet(PerObjectPermissionMixin,
 
         # Changes response use PostPublicSerializer
         data = PostPublicSerializer(serializer.instance, context=self.get_serializer_context()).data
-        data = extend_posts([data], request.user, request)
+        data = extend_posts([data], get_viewer(request), request)
 
         return Response(data[0], status=status.HTTP_201_CREATED, headers=headers)
 
@@ -161,59 +159,29 @@ class PostsViewSet(PerObjectPermissionMixin,
         if not self.request.user.is_authenticated():
             return self.permission_denied(self.request, 'You are not authenticated')
 
-        try:
-            post = self.get_queryset().get(pk=pk)
-        except Post.DoesNotExist:
+        post = vote_post(self.get_queryset(), pk, request.user.pk, is_positive)
+        if post is None:
             raise Http404()
 
-        try:
-            vote = PostVote.objects.get(user=request.user, post=post)
-        except PostVote.DoesNotExist:
-            vote = PostVote(user=request.user, post=post, is_positive=is_positive)
-        # vote, created = PostVote.objects.get_or_create(user=request.user, post=post)
-        vote.is_positive = is_positive
-        vote.save()
-
-        # Increase popularity in tags cache
-        # TODO: Move to post_save for vote?
-        tags = post.get_tag_titles()
-        for tag in tags:
-            key = Tag.redis_posts_key(tag)
-            r.zincrby(key, post.pk, 1 if is_positive else -1)
-
-        if is_positive:
-            post.expired_at += timedelta(minutes=5)
-        else:
-            min_time_in_seconds = 60 * 10
-
-            remains = post.time_remains.total_seconds()
-            if remains > min_time_in_seconds: # Is enough time to downvote?
-                post.expired_at -= timedelta(seconds=min_time_in_seconds)
-                remains = post.time_remains.total_seconds()
-
-                if remains < min_time_in_seconds:  # Is too much taken away?
-                    post.expired_at = timezone.now() + timedelta(seconds=min_time_in_seconds)
-
-        post.save()
-
         serializer = PostPublicSerializer(instance=post)
         return Response(serializer.data, status=status.HTTP_200_OK)
 
     @detail_route(methods=['get'])
     def voters(self, request, pk=None):
         qs = PostVote.objects.filter(post=pk)
-        qs = qs.prefetch_related('user')
 
-        page = self.paginate_queryset(qs)
-        users = [it.user for it in page]
+        paginator = CountedCursorPaginator()
+        page = paginator.paginate_queryset(qs, request)
 
-        serializer = UsernameSerializer(users, many=True,
-                                        context=self.get_serializer_context())
+        users = get_author_cards((it.user_id for it in page), request,
+                                 fields=UsernameSerializer.Meta.fields)
+        data = [dict(users[it.user_id]) for it in page if it.user_id in users]
 
-        mark_followee(serializer.data, self.request.user)
-        mark_requested(serializer.data, self.request.user)
+        viewer = get_viewer(request)
+        mark_followee(data, viewer)
+        mark_requested(data, viewer)
 
-        return self.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(data)
 
     @detail_route(methods=['get'])
     def votes(self, request, pk=None):
@@ -223,16 +191,17 @@ class PostsViewSet(PerObjectPermissionMixin,
             raise Http404()
 
         try:
-            votes = PostVote.objects.filter(post=post).order_by('-created_at')
+            votes = PostVote.objects.filter(post=post)
             votes = votes.prefetch_related('user')
         except PostVote.DoesNotExist:
             raise Http404()
-        
-        page = self.paginate_queryset(votes)
-        
+
+        paginator = CountedCursorPaginator()
+        page = paginator.paginate_queryset(votes, request)
+
         serializer = VotePublicSerializer(page, many=True,
                                         context=self.get_serializer_context())
-        return self.get_paginated_response(serializer.data)
+        return paginator.get_paginated_response(serializer.data)
 
     @detail_route(methods=['put'])
     def vote(self, request, pk=None):
@@ -314,7 +283,7 @@ class PostsViewSet(PerObjectPermissionMixin,
         serializer = ReportSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(user=request.user, object_pk=instance.pk,
-                        content_type=ContentType.objects.get(app_label='posts', model='post'))
+                        content_type=ContentType.objects.get_for_model(Post))
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -379,7 +348,7 @@ class PinnedPostsViewSet(ExtendableModelMixin,
     permission_classes = (permissions.IsAuthenticated,)
 
     def extend_response_data(self, data):
-        extend_posts(data, self.request.user, self.request)
+        extend_posts(data, get_viewer(self.request), self.request)
 
     def get_queryset(self):
         posts = self.request.user.pinned.filter().values('post_id')
@@ -404,7 +373,7 @@ class VotedPostBaseView(mixins.ListModelMixin,
 
     def list(self, request, *args, **kwargs):
         response = super().list(self, request, *args, **kwargs)
-        extend_posts(response.data['results'], request.user, request)
+        extend_posts(response.data['results'], get_viewer(request), request)
 
         return response
 
@@ -422,9 +391,10 @@ class DonwvotedPostsViewSet(VotedPostBaseView):
 class CommentsViewSet(PerObjectPermissionMixin,
                       ExtendableModelMixin,
                       viewsets.ModelViewSet):
-    queryset = PostComment.objects.all().order_by('-created_at')
+    queryset = PostComment.objects.all()
     public_serializer_class = CommentPublicSerializer
     private_serializer_class = CommentSerializer
+    pagination_class = CountedCursorPaginator
 
     filter_backends = (filters.DjangoFilterBackend,)
     filter_fields = ('user', 'post', 'parent',)
@@ -485,7 +455,7 @@ class CommentsViewSet(PerObjectPermissionMixin,
         serializer = ReportSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(user=request.user, object_pk=instance.pk,
-                        content_type=ContentType.objects.get(app_label='posts', model='postcomment'))
+                        content_type=ContentType.objects.get_for_model(PostComment))
 
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
@@ -742,7 +712,7 @@ class PostSortViewSet(  mixins.ListModelMixin,
     queryset = Post.objects.all().order_by('-created_at')
 
     def extend_response_data(self, data):
-        extend_posts(data, self.request.user, self.request)
+        extend_posts(data, get_viewer(self.request), self.request)
 
     def get_queryset(self):
         posts = super().get_queryset()
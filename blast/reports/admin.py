@@ -4,13 +4,14 @@ from django.contrib import admin
 from django.contrib.contenttypes.models import ContentType
 from django.utils import timezone
 
+from core.views import invalidate_public_responses
 from notifications.models import Notification
 from posts.models import Post
 from reports.models import Report, PostReport
 
 
 def mark_for_removal(modeladmin, request, qs):
-    content_type = ContentType.objects.get(app_label='posts', model='post')
+    content_type = ContentType.objects.get_for_model(Post)
 
     # Pull posts from reports
     reports = list(qs.filter(content_type=content_type).values('user_id', 'object_pk'))
@@ -20,6 +21,7 @@ def mark_for_removal(modeladmin, request, qs):
     # Mark post for removal
     post_ids = {it['object_pk'] for it in reports}
     Post.objects.filter(pk__in=post_ids).update(expired_at=expired_at, is_marked_for_removal=True)
+    invalidate_public_responses()
     posts = list(Post.objects.filter(pk__in=post_ids))
 
     # Send notification PUSH'es
@@ -43,5 +45,5 @@ class PostReportAdmin(admin.ModelAdmin):
     readonly_fields = ('image_tag', 'video_tag')
 
     def get_queryset(self, request):
-        content_type = ContentType.objects.get(app_label='posts', model='post')
+        content_type = ContentType.objects.get_for_model(Post)
         return PostReport.objects.filter(content_type=content_type)
@@ -1,6 +1,6 @@
 import logging
 import re
-import redis
+from typing import Iterable, List
 
 from django.db import models
 
@@ -8,11 +8,14 @@ from django.db import models
 from django.db.models.signals import post_save, pre_delete
 from django.dispatch import receiver
 
-from core.decorators import save_to_zset
+from core import counters
+from core.decorators import save_to_zset, heat_up_zsets
+from core.redis_client import r
 
 
 logger = logging.Logger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+TAG_POSTS_KEY = u'tag:{}:posts'
 
 
 class Tag(models.Model):
@@ -41,20 +44,41 @@ class Tag(models.Model):
 
     @staticmethod
     def redis_posts_key(pk):
-        return u'tag:{}:posts'.format(pk)
+        return TAG_POSTS_KEY.format(pk)
 
     @staticmethod
-    @save_to_zset(u'tag:{}:posts')
+    @save_to_zset(TAG_POSTS_KEY, compact=True)
     def get_posts(tag_pk, start, end):
-        from posts.models import Post
+        from posts.models import Post, index_expiration, get_popularity
         result = []
         posts = list(Post.objects.actual().filter(tags=tag_pk))
+        index_expiration('tag', [(tag_pk, it.pk, it.expired_at) for it in posts])
+        popularity = get_popularity({it.pk: (it.voted_count, it.downvoted_count) for it in posts})
         for it in posts:
-            result.append(it.popularity)
+            result.append(popularity[it.pk])
             result.append(it.pk)
 
         return result
 
+    @staticmethod
+    def heat_up_posts(titles: Iterable[str]) -> List[str]:
+        """Heats up posts of many tags by one query"""
+        from posts.models import Post, index_expiration, get_popularity
+
+        def build_many(titles):
+            posts = Post.objects.actual().filter(tags__in=titles)
+            posts = list(posts.values_list('tags', 'pk', 'voted_count', 'downvoted_count', 'expired_at'))
+            index_expiration('tag', [(it[0], it[1], it[4]) for it in posts])
+            popularity = get_popularity({it[1]: it[2:4] for it in posts})
+
+            result = {}
+            for title, pk, _, _, _ in posts:
+                result.setdefault(title, []).extend([popularity[pk], pk])
+
+            return result
+
+        return heat_up_zsets(Tag.get_posts.store, titles, build_many)
+
     def save(self, **kwargs):
         self.title = self.title.lower()
         return super().save(**kwargs)
@@ -63,6 +87,9 @@ class Tag(models.Model):
         return u'{} - {}'.format(self.title, self.total_posts)
 
 
+counters.register(Tag, 'total_posts')
+
+
 @receiver(pre_delete, sender=Tag, dispatch_uid='pre_deleted_tag')
 def pre_delete_tag(sender, instance: Tag, **kwargs):
-    r.delete(Tag.redis_posts_key(pk=instance.title))
+    Tag.get_posts.store.delete(instance.title)
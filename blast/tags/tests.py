@@ -155,6 +155,51 @@ class TestCacheHeatUp(BaseTestCase):
             self.assertTrue(r.exists(key))
 
 
+class TagPostsCursorTest(BaseTestCase):
+    url = reverse_lazy('tag-posts', kwargs={'pk': 'paged'})
+
+    def setUp(self):
+        super().setUp()
+
+        self.posts = [Post.objects.create(user=self.user, text='#paged') for it in range(5)]
+
+    def get_pages(self, url, on_page=None) -> list:
+        pages = []
+        while url:
+            response = self.client.get(url)
+            self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+            pages.append([it['id'] for it in response.data['results']])
+            url = response.data['next']
+            if on_page:
+                on_page(pages)
+
+        return pages
+
+    def test_feature_pages(self):
+        voted = self.posts[2]
+        response = self.put_json(reverse_lazy('post-vote', kwargs={'pk': voted.pk}))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+
+        def flush_votes(pages):
+            # Votes flushed to database between pages do not move posts across cursor
+            if len(pages) == 1:
+                last = [it.pk for it in self.posts if it.pk not in pages[0]][-1]
+                Post.objects.filter(pk=last).update(voted_count=10)
+
+        pages = self.get_pages(self.url + '?page_size=2', flush_votes)
+
+        ids = [pk for page in pages for pk in page]
+        self.assertEqual(len(pages), 3)
+        self.assertEqual(ids[0], voted.pk)
+        self.assertEqual(sorted(ids), sorted(it.pk for it in self.posts))
+
+    def test_newest_pages(self):
+        pages = self.get_pages(self.url + '?order=newest&page_size=2')
+
+        self.assertEqual([pk for page in pages for pk in page], [it.pk for it in reversed(self.posts)])
+
+
 class TestPostCounterInTagModel(BaseTestCase):
     def setUp(self):
         super().setUp()
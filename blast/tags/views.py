@@ -1,27 +1,80 @@
 import logging
 
 import itertools
+from django.db import models
 from django.shortcuts import get_object_or_404
-import redis
 
 from rest_framework import viewsets, filters, permissions
 from rest_framework.decorators import detail_route, list_route
 from rest_framework.response import Response
 
-from posts.serializers import PostPublicSerializer
+from posts.serializers import PostPublicSerializer, prefetch_comments_count
 from notifications.tasks import send_share_notifications
 
+from core.pagination import CountedCursorPaginator
+from core.redis_client import r
 from core.views import ExtendableModelMixin
 
 from posts.models import Post
 from posts.utils import extend_posts
 
+from users.viewer import get_viewer
+
 from tags.models import Tag
 from tags.serializers import TagPublicSerializer
 
 
 logger = logging.Logger(__name__)
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+
+# Count of posts attached to each tag
+TAG_POSTS_PREVIEW_COUNT = 3
+
+
+class TagPopularPosts(object):
+    """
+    Cursor chunks of live posts of tag ordered by popularity in tag posts set.
+    Cursor keeps popularity of post from set, so pages are not shifted by flushed votes.
+    """
+    cursor_ordering = 'indexed_popularity'
+    cursor_field = models.IntegerField()
+
+    def __init__(self, title: str, queryset):
+        self.title = title
+        self.queryset = queryset
+
+    def get_pairs(self, position: tuple or None, reverse: bool) -> list:
+        """Returns (score, id) pairs after position in paging direction"""
+        Tag.get_posts(self.title, 0, 0)  # Heat up cache
+        pairs = Tag.get_posts.store.load_many([self.title])[self.title] or []
+
+        # Members of equal score are ordered by member bytes like in ZREVRANGE
+        def order(pair):
+            return pair[0], str(pair[1])
+
+        pairs = sorted(pairs, key=order, reverse=not reverse)
+        if position is None:
+            return pairs
+        elif reverse:
+            return [it for it in pairs if order(it) > order(position)]
+        else:
+            return [it for it in pairs if order(it) < order(position)]
+
+    def get_cursor_chunk(self, position: tuple or None, size: int, reverse: bool) -> list:
+        posts = []
+        pairs = self.get_pairs(position, reverse)
+        for i in range(0, len(pairs), size):
+            # Expired posts stay in set until remove_expired_from_sets
+            chunk = pairs[i:i + size]
+            found = self.queryset.in_bulk([pk for score, pk in chunk])
+            for score, pk in chunk:
+                if pk in found:
+                    found[pk].indexed_popularity = int(score)
+                    posts.append(found[pk])
+
+            if len(posts) >= size:
+                break
+
+        return posts
 
 
 def extend_tags(data, serializer_context):
@@ -31,7 +84,8 @@ def extend_tags(data, serializer_context):
     posts = []
     tags_to_posts = {}
     for tag in tags:
-        tag_post_ids = Tag.get_posts(tag, 0, 5)
+        # Expired posts are pruned from tag posts sets, see posts.models.remove_expired_from_sets
+        tag_post_ids = Tag.get_posts(tag, 0, TAG_POSTS_PREVIEW_COUNT - 1)
 
         tags_to_posts[tag] = tag_post_ids
         posts.extend(tag_post_ids)
@@ -39,18 +93,17 @@ def extend_tags(data, serializer_context):
     # Pulls posts from db and builds in-memory index
     posts = Post.objects.actual().filter(pk__in=posts)
     posts = {it.pk: it for it in posts}
+    prefetch_comments_count(list(posts.values()))
 
     for it in data:
         tag_post_ids = tags_to_posts[it['title']]
         tag_posts = []
 
         for post_id in tag_post_ids:
+            # Posts expired since last pruning are skipped
             if post_id in posts:
                 tag_posts.append(posts[post_id])
 
-            if len(tag_posts) >= 3:  # FIXME (VM): Magic number?
-                break
-
         # Order of posts is defined by zrevrange
         serializer = PostPublicSerializer(tag_posts, many=True, context=serializer_context)
         it['posts'] = serializer.data
@@ -234,23 +287,21 @@ class TagsViewSet(ExtendableModelMixin,
         """
         order = request.query_params.get('order', 'feature')
 
-        if order == 'feature':
-            order = u'-voted_count'
-        else:
-            order = u'-created_at'
+        paginator = CountedCursorPaginator()
 
         tag = get_object_or_404(Tag, pk__iexact=pk)
         posts = Post.objects.actual()
         posts = posts.filter(tags__title__iexact=tag.title)
-        posts = posts.order_by(order)
 
-        page = self.paginate_queryset(posts)
+        # Newest posts are paged by creation time
+        source = TagPopularPosts(tag.title, posts) if order == 'feature' else None
+        page = paginator.paginate_queryset(posts, request, source)
         serializer_context = self.get_serializer_context()
 
         serializer = PostPublicSerializer(instance=page, many=True, context=serializer_context)
-        response = self.get_paginated_response(serializer.data)
+        response = paginator.get_paginated_response(serializer.data)
 
-        extend_posts(serializer.data, request.user, request)
+        extend_posts(serializer.data, get_viewer(request), request)
 
         return response
 
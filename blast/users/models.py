@@ -1,25 +1,28 @@
 from __future__ import unicode_literals
 
-from typing import Set, List
+from typing import Set, List, Dict, Iterable
 
+import json
 import logging
 import os
 import uuid
-import redis
 
 from django.contrib.auth.models import (
     BaseUserManager, AbstractBaseUser, PermissionsMixin
 )
 from django.db import models
-from django.db.models import F
-from django.db.models.signals import post_save, pre_delete
+from django.db.models import Q
+from django.db.models.signals import post_save, pre_delete, post_delete, m2m_changed
 from django.dispatch import receiver
 from django.utils import timezone
 
-from core.decorators import save_to_zset, memoize_list
-from countries.models import Country
+from core import cache_events, counters
+from core.cache_events import cache_event_handler
+from core.decorators import save_to_zset, memoize_list, heat_up_zsets
+from core.redis_client import r, pipeline, zscore_many
+from core.local_cache import local_cache
+from countries.models import Country, get_country_by_name
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
 
 logger = logging.getLogger(__name__)
 
@@ -34,7 +37,7 @@ class UserManager(BaseUserManager):
     def create_user(self, phone, username, password, is_private=False, country=None, commit=True):
         # TODO: Validate password and username
         user = self.model(phone=phone, username=username, is_private=is_private)
-        user.country = country or Country.objects.get(name='Russia')
+        user.country = country or get_country_by_name('Russia')
         user.set_password(password)
         user.is_active = True
 
@@ -63,13 +66,30 @@ class UserManager(BaseUserManager):
 
     @property
     def anonymous(self):
-        return self.get_queryset().get(pk=self.anonymous_id)
+        return get_anonymous_user()
 
 
 USER_POSTS_KEY = u'user:{}:posts'
 USER_FOLLOWERS_KEY = u'user:{}:followers'
 USER_FOLLOWEES_KEY = u'user:{}:followees'
 USER_RECENT_POSTS_KEY = u'user:{}:recent:posts'
+USER_FEED_KEY = u'user:{}:feed'
+USER_EXCLUDED_POSTS_KEY = u'user:{}:excluded:posts'
+# Member of every excluded posts set, so user without excluded posts has cached set too
+EXCLUDED_POSTS_SENTINEL = 0
+USER_BLOCKED_KEY = u'user:{}:blocked'
+# Bump version when fields of user card are changed
+USER_CARD_KEY = u'user:{}:card:v1'
+
+# Time to live of cached user card in seconds.
+USER_CARD_TTL = 24 * 60 * 60
+
+# Max length of user home feed in redis.
+USER_FEED_MAX_LENGTH = 1000
+
+# Max length and time to live of cached user recent posts.
+USER_RECENT_POSTS_MAX_LENGTH = 10
+USER_RECENT_POSTS_TTL = 7 * 24 * 60 * 60
 
 
 class User(AbstractBaseUser, PermissionsMixin):
@@ -155,21 +175,39 @@ class User(AbstractBaseUser, PermissionsMixin):
         return USER_FOLLOWEES_KEY.format(pk)
 
     @staticmethod
-    @save_to_zset(USER_POSTS_KEY)
+    def redis_feed_key(pk: int):
+        return USER_FEED_KEY.format(pk)
+
+    @staticmethod
+    def redis_excluded_posts_key(pk: int):
+        return USER_EXCLUDED_POSTS_KEY.format(pk)
+
+    @staticmethod
+    def redis_blocked_key(pk: int):
+        return USER_BLOCKED_KEY.format(pk)
+
+    @staticmethod
+    def redis_card_key(pk: int):
+        return USER_CARD_KEY.format(pk)
+
+    @staticmethod
+    @save_to_zset(USER_POSTS_KEY, compact=True)
     def get_posts(user_id: int, start: int, end: int):
-        from posts.models import Post
+        from posts.models import Post, index_expiration, get_popularity
         user_posts = list(Post.objects.actual().filter(user=user_id))
         logging.info('Got {} posts for {} user key'.format(len(user_posts), user_id))
+        index_expiration('user', [(user_id, it.pk, it.expired_at) for it in user_posts])
+        popularity = get_popularity({it.pk: (it.voted_count, it.downvoted_count) for it in user_posts})
 
         result = []
         for it in user_posts:
-            result.append(it.popularity)
+            result.append(popularity[it.pk])
             result.append(it.pk)
 
         return result
 
     @staticmethod
-    @save_to_zset(USER_FOLLOWERS_KEY)
+    @save_to_zset(USER_FOLLOWERS_KEY, compact=True, scored=False)
     def get_followers(user_id, start, end):
         followers = Follower.objects.filter(followee=user_id).prefetch_related('follower')
         followers = list(followers)
@@ -183,7 +221,7 @@ class User(AbstractBaseUser, PermissionsMixin):
         return result
 
     @staticmethod
-    @save_to_zset(USER_FOLLOWEES_KEY)
+    @save_to_zset(USER_FOLLOWEES_KEY, compact=True, scored=False)
     def get_followees(user_id, start, end):
         followees = Follower.objects.filter(follower=user_id).values_list('followee_id', flat=True)
         logging.info('Got {} followees for {} user key'.format(len(followees), user_id))
@@ -196,25 +234,178 @@ class User(AbstractBaseUser, PermissionsMixin):
         return result
 
     @staticmethod
-    @memoize_list(USER_RECENT_POSTS_KEY)
+    def heat_up_followees(user_ids: Iterable[int]) -> List[int]:
+        """Heats up followees of many users by one query"""
+        def build_many(user_ids):
+            followees = Follower.objects.filter(follower__in=user_ids).values_list('follower_id', 'followee_id')
+
+            result = {}
+            for follower_id, followee_id in followees:
+                result.setdefault(follower_id, []).extend([followee_id, followee_id])
+
+            return result
+
+        return heat_up_zsets(User.get_followees.store, user_ids, build_many)
+
+    @staticmethod
+    def heat_up_posts(user_ids: Iterable[int]) -> List[int]:
+        """Heats up posts of many users by one query"""
+        from posts.models import Post, index_expiration, get_popularity
+
+        def build_many(user_ids):
+            posts = Post.objects.actual().filter(user__in=user_ids)
+            posts = list(posts.values_list('user_id', 'pk', 'voted_count', 'downvoted_count', 'expired_at'))
+            index_expiration('user', [(it[0], it[1], it[4]) for it in posts])
+            popularity = get_popularity({it[1]: it[2:4] for it in posts})
+
+            result = {}
+            for user_id, pk, _, _, _ in posts:
+                result.setdefault(user_id, []).extend([popularity[pk], pk])
+
+            return result
+
+        return heat_up_zsets(User.get_posts.store, user_ids, build_many)
+
+    @staticmethod
+    def heat_up_followers(user_ids: Iterable[int]) -> List[int]:
+        """Heats up followers of many users by one query"""
+        def build_many(user_ids):
+            followers = Follower.objects.filter(followee__in=user_ids).values_list('followee_id', 'follower_id')
+
+            result = {}
+            for followee_id, follower_id in followers:
+                result.setdefault(followee_id, []).extend([follower_id, follower_id])
+
+            return result
+
+        return heat_up_zsets(User.get_followers.store, user_ids, build_many)
+
+    @staticmethod
+    @save_to_zset(USER_FEED_KEY)
+    def get_feed(user_id: int, start: int, end: int):
+        """
+        Returns home feed of user: actual posts of followees and own posts.
+        Posts are scored by creation timestamp.
+        """
+        from posts.models import Post
+        followees = Follower.objects.filter(follower=user_id).values_list('followee_id', flat=True)
+
+        posts = Post.objects.actual().filter(Q(user__in=followees) | Q(user_id=user_id))
+        if user_id != User.objects.anonymous_id:
+            posts = posts.exclude(user_id=User.objects.anonymous_id)
+
+        posts = posts.order_by('-created_at').values_list('pk', 'created_at')
+        posts = list(posts[:USER_FEED_MAX_LENGTH])
+        logging.info('Got {} feed posts for {} user key'.format(len(posts), user_id))
+
+        result = []
+        for pk, created_at in posts:
+            result.append(created_at.timestamp())
+            result.append(pk)
+
+        return result
+
+    @staticmethod
+    @save_to_zset(USER_EXCLUDED_POSTS_KEY)
+    def get_excluded_posts(user_id: int, start: int, end: int):
+        """Returns voted, hidden and pinned posts which are excluded from user feeds and sentinel member"""
+        from posts.models import Post, PostVote
+        voted = PostVote.objects.filter(user=user_id).values('post')
+        pinned = PinnedPosts.objects.filter(user=user_id).values('post')
+
+        posts = Post.objects.actual().filter(Q(pk__in=voted) | Q(pk__in=pinned) | Q(hidden_users=user_id))
+        posts = set(posts.values_list('pk', flat=True))
+        logging.info('Got {} excluded posts for {} user key'.format(len(posts), user_id))
+
+        result = [EXCLUDED_POSTS_SENTINEL, EXCLUDED_POSTS_SENTINEL]
+        for it in posts:
+            result.append(it)
+            result.append(it)
+
+        return result
+
+    @staticmethod
+    def filter_excluded_posts(user_id: int, post_ids: list) -> Set[int]:
+        """Returns subset of post_ids excluded from user feeds"""
+        key = User.redis_excluded_posts_key(user_id)
+        if not r.exists(key):
+            User.get_excluded_posts(user_id, 0, 1)  # Heat up cache
+
+        scores = zscore_many(key, post_ids)
+        return {pk for pk, score in scores.items() if score is not None}
+
+    @staticmethod
+    def exclude_post(user_id: int, post_id: int, client=r):
+        """Adds post to "hot" excluded posts cache of user"""
+        User.get_excluded_posts.store.add(user_id, post_id, post_id, client=client)
+
+    @staticmethod
+    @save_to_zset(USER_BLOCKED_KEY)
+    def get_blocked(user_id: int, start: int, end: int):
+        blocked = BlockedUsers.objects.filter(user=user_id).values_list('blocked_id', flat=True)
+        logging.info('Got {} blocked users for {} user key'.format(len(blocked), user_id))
+
+        result = []
+        for it in blocked:
+            result.append(it)
+            result.append(it)
+
+        return result
+
+    def card(self) -> Dict:
+        """Returns public user fields shown next to posts, comments and notifications"""
+        return {
+            'id': self.pk,
+            'username': self.username,
+            'fullname': self.fullname,
+            'avatar': self.avatar.url if self.avatar else None,
+            'is_private': self.is_private,
+        }
+
+    @staticmethod
+    def get_cards(user_ids: Iterable[int]) -> Dict[int, Dict]:
+        """Returns map of user id to user card, missed cards are built by one query"""
+        user_ids = list({it for it in user_ids if it})
+        if not user_ids:
+            return {}
+
+        cached = r.mget([User.redis_card_key(it) for it in user_ids])
+        result = {pk: json.loads(it.decode('utf-8')) for pk, it in zip(user_ids, cached) if it}
+
+        missed = [it for it in user_ids if it not in result]
+        if missed:
+            logger.info('Build {} user cards'.format(len(missed)))
+
+            with pipeline() as pipe:
+                for user in User.objects.filter(pk__in=missed):
+                    card = user.card()
+                    result[user.pk] = card
+                    pipe.setex(User.redis_card_key(user.pk), USER_CARD_TTL, json.dumps(card))
+
+        return result
+
+    @staticmethod
+    @memoize_list(USER_RECENT_POSTS_KEY, max_length=USER_RECENT_POSTS_MAX_LENGTH, ttl=USER_RECENT_POSTS_TTL)
     def get_recent_posts(user_id: int, start: int, end: int):
+        """Returns ids of user posts from newest to oldest"""
         from posts.models import Post
-        return list(Post.objects.filter(user=user_id).all().order_by('created_at').values_list('pk', flat=True))
+        posts = Post.objects.filter(user=user_id).order_by('-created_at').values_list('pk', flat=True)
+        return list(posts[:USER_RECENT_POSTS_MAX_LENGTH])
 
     def followers_count(self):
         # return Follower.objects.filter(followee_id=self.pk).count()
-        key = User.redis_followers_key(self.pk)
-        if not r.exists(key):
+        store = User.get_followers.store
+        if not store.exists(self.pk):
             User.get_followers(self.pk, 0, 1)  # Heat up cache
 
-        return r.zcard(key)
+        return store.card(self.pk)
 
     def following_count(self):
-        key = User.redis_followees_key(self.pk)
-        if not r.exists(key):
+        store = User.get_followees.store
+        if not store.exists(self.pk):
             User.get_followees(self.pk, 0, 1)  # Heat up cache
 
-        return r.zcard(key)
+        return store.card(self.pk)
 
     def blasts_count(self):
         # key = User.redis_posts_key(self.pk)
@@ -250,12 +441,12 @@ class User(AbstractBaseUser, PermissionsMixin):
     def get_most_popular_ids(start, end):
         """Returns list of user ids ranged by popularity"""
         if not r.exists(User.USERS_ZSET_KEY):  # Heat up cache
-            users = User.objects.all()
+            users = counters.get_values(User, 'popularity', dict(User.objects.values_list('pk', 'popularity')))
 
             to_add = []
-            for it in users:
-                to_add.append(it.popularity)
-                to_add.append(it.pk)
+            for pk, popularity in users.items():
+                to_add.append(popularity)
+                to_add.append(pk)
 
             if to_add:
                 r.zadd(User.USERS_ZSET_KEY, *to_add)
@@ -278,6 +469,9 @@ class User(AbstractBaseUser, PermissionsMixin):
         return self.email
 
 
+counters.register(User, 'popularity')
+
+
 class Follower(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
 
@@ -349,9 +543,27 @@ class UserSettings(models.Model):
     notify_reblasts = models.IntegerField(choices=CHOICES, default=EVERYONE)
 
 
+@local_cache('users:anonymous')
+def get_anonymous_values() -> tuple:
+    """Returns values of concrete fields of anonymous user"""
+    fields = [it.attname for it in User._meta.concrete_fields]
+    return User.objects.filter(pk=User.objects.anonymous_id).values_list(*fields).get()
+
+
+def get_anonymous_user() -> User:
+    """Returns new instance of anonymous user, callers could modify it"""
+    fields = [it.attname for it in User._meta.concrete_fields]
+    return User.from_db('default', fields, get_anonymous_values())
+
+
 @receiver(post_save, sender=User, dispatch_uid='users_post_user_save_handler')
 def post_user_created(sender, instance: User, **kwargs):
+    if instance.pk == User.objects.anonymous_id:
+        get_anonymous_values.invalidate()
+
     if not kwargs['created']:
+        # Profile or avatar could be changed
+        r.delete(User.redis_card_key(instance.pk))
         return
 
     # add user to set of all users.
@@ -367,34 +579,102 @@ def post_user_created(sender, instance: User, **kwargs):
                                 followee_id=User.objects.anonymous_id)
 
 
+@cache_event_handler('follow_changed')
+def apply_follows_changed(payloads: List[Dict]):
+    """Reconciles "hot" followers, followees and users popularity caches with database"""
+    pairs = {(it['follower'], it['followee']) for it in payloads}
+    existing = Follower.objects.filter(follower_id__in={it[0] for it in pairs},
+                                       followee_id__in={it[1] for it in pairs})
+    existing = set(existing.values_list('follower_id', 'followee_id'))
+
+    followers, followees = User.get_followers.store, User.get_followees.store
+    hot_followers = followers.exists_many({it[1] for it in pairs})
+    hot_followees = followees.exists_many({it[0] for it in pairs})
+
+    with pipeline() as pipe:
+        for follower_id, followee_id in pairs:
+            if (follower_id, followee_id) in existing:
+                if followee_id in hot_followers:
+                    followers.add(followee_id, follower_id, follower_id, client=pipe)
+                if follower_id in hot_followees:
+                    followees.add(follower_id, followee_id, followee_id, client=pipe)
+            else:
+                followers.remove(followee_id, follower_id, client=pipe)
+                followees.remove(follower_id, followee_id, client=pipe)
+
+            # Home feed will be rebuilt with or without followee posts
+            pipe.delete(User.redis_feed_key(follower_id))
+
+        users = User.objects.filter(pk__in={it[1] for it in pairs})
+        users = counters.get_values(User, 'popularity', dict(users.values_list('pk', 'popularity')))
+        for pk, popularity in users.items():
+            # Updates existing members only
+            pipe.execute_command('ZADD', User.USERS_ZSET_KEY, 'XX', popularity, pk)
+
+
 @receiver(post_save, sender=Follower, dispatch_uid='update_user_popularity_positive')
 def update_user_popularity_positive(sender, instance: Follower, **kwargs):
     if not kwargs['created']:
         return
 
-    # TODO: Check cache exists
-    r.zincrby(User.USERS_ZSET_KEY, instance.followee_id, 1)
-    User.objects.filter(pk=instance.followee_id).update(popularity=F('popularity') + 1)
-
-    # Updates followers cache
-    key = User.redis_followers_key(instance.followee_id)
-    r.zadd(key, instance.follower_id, instance.follower_id)
+    counters.incr(User, 'popularity', [instance.followee_id])
 
-    key = User.redis_followees_key(instance.follower_id)
-    r.zadd(key, instance.followee_id, instance.followee_id)
+    cache_events.emit('follow_changed', follower=instance.follower_id, followee=instance.followee_id)
 
 
-@receiver(pre_delete, sender=Follower, dispatch_uid='update_user_popularity_negative')
+@receiver(post_delete, sender=Follower, dispatch_uid='update_user_popularity_negative')
 def update_user_popularity_negative(sender, instance: Follower, **kwargs):
-    # TODO: Check cache exists
-    r.zincrby(User.USERS_ZSET_KEY, instance.followee_id, -1)
+    counters.incr(User, 'popularity', [instance.followee_id], -1)
+
+    cache_events.emit('follow_changed', follower=instance.follower_id, followee=instance.followee_id)
+
+
+@receiver(post_save, sender=PinnedPosts, dispatch_uid='exclude_pinned_post')
+def exclude_pinned_post(sender, instance: PinnedPosts, created: bool, **kwargs):
+    if not created:
+        return
+
+    User.exclude_post(instance.user_id, instance.post_id)
+
+
+@receiver(post_delete, sender=PinnedPosts, dispatch_uid='include_unpinned_post')
+def include_unpinned_post(sender, instance: PinnedPosts, **kwargs):
+    # Post can be excluded by vote or hiding, so cache will be rebuilt
+    r.delete(User.redis_excluded_posts_key(instance.user_id))
+
+
+@receiver(m2m_changed, sender=User.hidden_posts.through, dispatch_uid='update_hidden_posts')
+def update_hidden_posts(sender, instance, action: str, reverse: bool, pk_set: set, **kwargs):
+    if action not in ('post_add', 'post_remove', 'pre_clear'):
+        return
+
+    if reverse:  # instance is post
+        post_ids = {instance.pk}
+        user_ids = pk_set or User.objects.filter(hidden_posts=instance.pk).values_list('pk', flat=True)
+    else:
+        post_ids = pk_set or set()
+        user_ids = {instance.pk}
+
+    if action == 'post_add':
+        for user_id in user_ids:
+            for post_id in post_ids:
+                User.exclude_post(user_id, post_id)
+    else:
+        # Post can be excluded by vote or pin, so cache will be rebuilt
+        for user_id in user_ids:
+            r.delete(User.redis_excluded_posts_key(user_id))
+
+
+@receiver(post_save, sender=BlockedUsers, dispatch_uid='update_blocked_cache_on_block')
+def update_blocked_on_block(sender, instance: BlockedUsers, created: bool, **kwargs):
+    if not created:
+        return
 
-    User.objects.filter(pk=instance.followee_id).update(popularity=F('popularity') - 1)
+    key = User.redis_blocked_key(instance.user_id)
+    if r.exists(key):
+        r.zadd(key, instance.blocked_id, instance.blocked_id)
 
-    # Updates followers cache
-    key = User.redis_followers_key(instance.followee_id)
-    r.zrem(key, instance.follower_id)
 
-    # Updates followees cache
-    key = User.redis_followees_key(instance.follower_id)
-    r.zrem(key, instance.followee_id)
+@receiver(post_delete, sender=BlockedUsers, dispatch_uid='update_blocked_cache_on_unblock')
+def update_blocked_on_unblock(sender, instance: BlockedUsers, **kwargs):
+    r.zrem(User.redis_blocked_key(instance.user_id), instance.blocked_id)
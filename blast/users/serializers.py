@@ -1,3 +1,5 @@
+from typing import Dict, Iterable
+
 from rest_framework import serializers
 
 from smsconfirmation.models import PhoneConfirmation
@@ -233,3 +235,20 @@ class OwnerSerializer(serializers.ModelSerializer):
     class Meta:
         model = User
         fields = ('id', 'username', 'avatar', 'is_private',)
+
+
+def get_author_cards(user_ids: Iterable[int], request,
+                     fields: tuple = OwnerSerializer.Meta.fields) -> Dict[int, Dict]:
+    """
+    Returns map of user id to author dictionary built from cached user cards
+    :param fields: fields of author dictionary, OwnerSerializer fields by default
+    """
+    result = {}
+    for pk, card in User.get_cards(user_ids).items():
+        author = {field: card[field] for field in fields}
+        if 'avatar' in author and author['avatar']:
+            author['avatar'] = request.build_absolute_uri(author['avatar'])
+
+        result[pk] = author
+
+    return result
@@ -1,7 +1,9 @@
 import json
 
 import redis
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 from django.core.urlresolvers import reverse_lazy, reverse
 from django.utils import timezone
 from push_notifications.models import APNSDevice
@@ -9,13 +11,14 @@ from rest_framework import status
 
 from countries.models import Country
 from notifications.models import FollowRequest, Notification
-from posts.models import Post
+from posts.models import Post, PostVote
 from reports.models import Report
 from smsconfirmation.models import PhoneConfirmation
 from tags.models import Tag
 from users.models import User, UserSettings, Follower, BlockedUsers
 from core.tests import BaseTestCase
 from users.utils import mark_followee, mark_requested
+from users.viewer import ViewerContext
 
 
 class CheckUsernameAndPasswordTest(BaseTestCase):
@@ -1069,3 +1072,52 @@ class TestPopularity(BaseTestCase):
 
         self.user.refresh_from_db()
         self.assertEqual(self.user.popularity, 0)
+
+
+class TestViewerContext(BaseTestCase):
+
+    def test_relations_loaded_once(self):
+        other = self.generate_user()
+        Follower.objects.create(follower=self.user, followee=other)
+        post = Post.objects.create(user=other, text='Hello')
+        PostVote.objects.create(user=self.user, post=post, is_positive=True)
+
+        viewer = ViewerContext(self.user)
+        self.assertIn(other.pk, viewer.followees)
+        self.assertEqual(viewer.requested([other.pk]), set())
+        self.assertEqual(viewer.votes([post.pk]), {post.pk: True})
+        self.assertEqual(viewer.pinned([post.pk]), set())
+
+        with CaptureQueriesContext(connection) as context:
+            self.assertIn(other.pk, viewer.followees)
+            self.assertEqual(viewer.requested([other.pk]), set())
+            self.assertEqual(viewer.votes([post.pk]), {post.pk: True})
+            self.assertEqual(viewer.pinned([post.pk]), set())
+
+        self.assertEqual(len(context), 0)
+
+    def test_requested_loaded_by_ids(self):
+        users = [self.generate_user() for _ in range(2)]
+        for it in users:
+            FollowRequest.objects.create(follower=self.user, followee=it)
+
+        viewer = ViewerContext(self.user)
+        self.assertEqual(viewer.requested([users[0].pk]), {users[0].pk})
+        self.assertEqual(viewer._requested, {users[0].pk})
+        self.assertEqual(viewer.requested(it.pk for it in users), {it.pk for it in users})
+
+
+class TestUserCards(BaseTestCase):
+
+    def test_card_invalidated_on_update(self):
+        cards = User.get_cards([self.user.pk])
+        self.assertEqual(cards[self.user.pk]['username'], self.user.username)
+        self.assertTrue(self.r.exists(User.redis_card_key(self.user.pk)))
+
+        url = reverse_lazy('user-profile')
+        response = self.patch_json(url, {'fullname': 'New Name'})
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertFalse(self.r.exists(User.redis_card_key(self.user.pk)))
+
+        cards = User.get_cards([self.user.pk])
+        self.assertEqual(cards[self.user.pk]['fullname'], 'New Name')
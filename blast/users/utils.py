@@ -1,33 +1,24 @@
 import itertools
-import redis
 
-from notifications.models import FollowRequest
 from posts.serializers import PreviewPostSerializer
 from posts.utils import mark_voted
-from users.models import User, Follower
+from users.models import User
+from users.viewer import ViewerContext, as_viewer, get_viewer
 from posts.models import Post
 
 from typing import List, Set, Dict, Iterable
 
-r = redis.StrictRedis(host='localhost', port=6379, db=0)
+from core.redis_client import r
 
 
-def filter_followee_users(user: User, user_ids: list or set):
-    if not user.is_authenticated():
-        return set()
-
-    result = Follower.objects.filter(follower=user,
-                                     followee_id__in=user_ids).values_list('followee_id', flat=True)
-    return set(result)
-
-
-def mark_followee(users: List[Dict], user: User) -> List[Dict]:
-    if not user.is_authenticated():
+def mark_followee(users: List[Dict], viewer: ViewerContext or User) -> List[Dict]:
+    viewer = as_viewer(viewer)
+    if not viewer.is_authenticated():
         for it in users:
             it['is_followee'] = False
         return users
 
-    followees = filter_followee_users(user, {it['id'] for it in users})
+    followees = viewer.followees
     for it in users:
         pk = it['id']
         it['is_followee'] = pk in followees
@@ -35,15 +26,15 @@ def mark_followee(users: List[Dict], user: User) -> List[Dict]:
     return users
 
 
-def mark_requested(users: List[Dict], user: User) -> List[Dict]:
-    if not user.is_authenticated():
+def mark_requested(users: List[Dict], viewer: ViewerContext or User) -> List[Dict]:
+    viewer = as_viewer(viewer)
+    if not viewer.is_authenticated():
         for it in users:
             it['is_requested'] = False
 
         return users
 
-    requests = FollowRequest.objects.filter(follower=user, followee_id__in={it['id'] for it in users})
-    requests = set(requests.values_list('followee_id', flat=True))
+    requests = viewer.requested(it['id'] for it in users)
     for it in users:
         it['is_requested'] = it['id'] in requests
 
@@ -55,8 +46,7 @@ def get_recent_posts(users: List[int] or Set[int], count: int) -> Dict:
     # users = User.objects.filter(id__in=users)
 
     post_ids = []
-    for it in users:
-        ids = User.get_recent_posts(it, 0, count - 1)
+    for ids in User.get_recent_posts.get_many(users, 0, count - 1).values():
         post_ids.extend(ids)
 
     posts = list(Post.objects.filter(id__in=post_ids))
@@ -83,7 +73,7 @@ def attach_recent_posts_to_users(data: Iterable, request):
     posts = user_to_posts.values()
     posts = [it for sublist in posts for it in sublist]  # Flat list of posts
 
-    mark_voted(posts, request.user)
+    mark_voted(posts, get_viewer(request))
 
     for it in data:
         pk = it['id']
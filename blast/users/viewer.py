@@ -0,0 +1,112 @@
+from typing import Dict, Iterable, Set
+
+from users.models import User, PinnedPosts
+
+
+class ViewerContext(object):
+    """
+    Relations of request user to other users and posts.
+    Each relation is loaded lazily and at most once per request.
+    """
+
+    def __init__(self, user: User):
+        self.user = user
+
+        self._followees = None
+        self._blocked = None
+
+        # Relations of other users and posts are loaded for requested ids only
+        self._requested = set()
+        self._requested_loaded = set()
+        self._pinned = set()
+        self._pinned_loaded = set()
+        self._votes = {}
+        self._votes_loaded = set()
+        self._excluded = set()
+        self._excluded_loaded = set()
+
+    def is_authenticated(self) -> bool:
+        return self.user.is_authenticated()
+
+    @property
+    def followees(self) -> Set[int]:
+        """Returns ids of users followed by viewer"""
+        if self._followees is None:
+            self._followees = set()
+            if self.is_authenticated():
+                self._followees = set(User.get_followees(self.user.pk, 0, -1))
+
+        return self._followees
+
+    def requested(self, user_ids: Iterable[int]) -> Set[int]:
+        """Returns subset of user_ids requested for following by viewer"""
+        user_ids = set(user_ids)
+        to_load = user_ids - self._requested_loaded
+        if to_load and self.is_authenticated():
+            from notifications.models import FollowRequest
+            requests = FollowRequest.objects.filter(follower=self.user.pk, followee_id__in=to_load)
+            self._requested |= set(requests.values_list('followee_id', flat=True))
+
+        self._requested_loaded |= to_load
+        return user_ids & self._requested
+
+    @property
+    def blocked(self) -> Set[int]:
+        """Returns ids of users blocked by viewer"""
+        if self._blocked is None:
+            self._blocked = set()
+            if self.is_authenticated():
+                self._blocked = set(User.get_blocked(self.user.pk, 0, -1))
+
+        return self._blocked
+
+    def pinned(self, post_ids: Iterable[int]) -> Set[int]:
+        """Returns subset of post_ids pinned by viewer"""
+        post_ids = set(post_ids)
+        to_load = post_ids - self._pinned_loaded
+        if to_load and self.is_authenticated():
+            pinned = PinnedPosts.objects.filter(user=self.user.pk, post_id__in=to_load)
+            self._pinned |= set(pinned.values_list('post_id', flat=True))
+
+        self._pinned_loaded |= to_load
+        return post_ids & self._pinned
+
+    def votes(self, post_ids: Iterable[int]) -> Dict[int, bool]:
+        """Returns map of voted post id to vote is_positive flag for post_ids"""
+        post_ids = set(post_ids)
+        to_load = post_ids - self._votes_loaded
+        if to_load and self.is_authenticated():
+            from posts.models import PostVote
+            votes = PostVote.objects.filter(user=self.user.pk, post_id__in=to_load)
+            self._votes.update(votes.values_list('post_id', 'is_positive'))
+
+        self._votes_loaded |= to_load
+        return {pk: self._votes[pk] for pk in post_ids if pk in self._votes}
+
+    def excluded(self, post_ids: Iterable[int]) -> Set[int]:
+        """Returns subset of post_ids voted, hidden or pinned by viewer"""
+        post_ids = set(post_ids)
+        to_load = post_ids - self._excluded_loaded
+        if to_load and self.is_authenticated():
+            self._excluded |= User.filter_excluded_posts(self.user.pk, list(to_load))
+
+        self._excluded_loaded |= to_load
+        return post_ids & self._excluded
+
+
+def as_viewer(viewer: ViewerContext or User) -> ViewerContext:
+    """Returns viewer context for user or viewer context itself"""
+    if isinstance(viewer, ViewerContext):
+        return viewer
+
+    return ViewerContext(viewer)
+
+
+def get_viewer(request) -> ViewerContext:
+    """Returns viewer context shared by all helpers within request"""
+    viewer = getattr(request, '_viewer_context', None)
+    if viewer is None:
+        viewer = ViewerContext(request.user)
+        request._viewer_context = viewer
+
+    return viewer
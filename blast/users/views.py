@@ -22,27 +22,21 @@ from users.serializers import (RegisterUserSerializer, PublicUserSerializer,
 
 from push_notifications.models import APNSDevice
 from notifications.tasks import send_push_notification_to_device
-from users.utils import filter_followee_users, mark_followee, mark_requested, attach_recent_posts_to_users
+from users.utils import mark_followee, mark_requested, attach_recent_posts_to_users
+from users.viewer import get_viewer
 
 logger = logging.getLogger(__name__)
 
 
 def extend_users_response(users: list, request):
-    user = request.user
+    viewer = get_viewer(request)
 
-    if not user.is_authenticated():
+    if not viewer.is_authenticated():
         return
 
-    user_ids = {it['id'] for it in users}
-    followees = filter_followee_users(user, user_ids)
-    follow_requests = FollowRequest.objects.filter(follower=user,
-                                                   followee__in=user_ids)
-    # TODO: use redis
-    follow_requests = {it.followee_id for it in follow_requests}
-
-    # TODO: Use redis
-    blocked_users = BlockedUsers.objects.filter(user=user, blocked__in=user_ids)
-    blocked_users = {it.blocked_id for it in blocked_users}
+    followees = viewer.followees
+    follow_requests = viewer.requested(it['id'] for it in users)
+    blocked_users = viewer.blocked
 
     for it in users:
         pk = it['id']
@@ -107,7 +101,7 @@ class UserViewSet(ExtendableModelMixin,
         serializer = ReportSerializer(data=request.data)
         serializer.is_valid(raise_exception=True)
         serializer.save(user=request.user, object_pk=user.pk,
-                        content_type=ContentType.objects.get(model='user'))
+                        content_type=ContentType.objects.get_for_model(User))
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
     @list_route(['get'])
@@ -173,8 +167,9 @@ class UserViewSet(ExtendableModelMixin,
         serializer = FollowersSerializer(page, many=True, context=context)
         data = serializer.data
 
-        mark_followee(data, self.request.user)
-        mark_requested(data, self.request.user)
+        viewer = get_viewer(self.request)
+        mark_followee(data, viewer)
+        mark_requested(data, viewer)
 
         attach_recent_posts_to_users(data, self.request)
 
@@ -356,8 +351,9 @@ class UserSearchView(ExtendableModelMixin,
     search_fields = ('username', 'fullname',)
 
     def extend_response_data(self, data):
-        mark_followee(data, self.request.user)
-        mark_requested(data, self.request.user)
+        viewer = get_viewer(self.request)
+        mark_followee(data, viewer)
+        mark_requested(data, viewer)
 
         attach_recent_posts_to_users(data, self.request)
 